@@ -0,0 +1,223 @@
+from __future__ import print_function
+
+import argparse, collections, gc, json, os, platform, random, subprocess, sys, tempfile, time
+import peewee as pw
+import peeweedbevolve
+
+
+# benchmarks calc_changes on synthetic schemas
+#
+#   python bench.py                          # 100 and 1k models on sqlite, plus postgres if it's running
+#   python bench.py --sizes 100,1000,10000
+#   python bench.py --compare old.json new.json
+#   python bench.py --catalog 1000000         # column metadata for a 1M column catalog, no database needed
+
+SCENARIOS = ['empty', 'up_to_date', 'drifted']
+INTROSPECTION = ['get_tables', 'get_indexes', 'get_columns', 'get_foreign_keys', 'get_partitions', 'get_table_options']
+
+FIELD_TYPES = [
+  lambda: pw.CharField(null=True),
+  lambda: pw.CharField(max_length=64),
+  lambda: pw.TextField(null=True),
+  lambda: pw.IntegerField(default=0),
+  lambda: pw.DateTimeField(null=True),
+  lambda: pw.DecimalField(max_digits=10, decimal_places=2, null=True),
+  lambda: pw.FloatField(null=True),
+]
+
+
+def make_models(db, count, seed=0, drift=False):
+  # count models averaging ~10 columns, ~2 indexes and ~1 foreign key each.  with drift, every 10th model
+  # gets an extra column and index the database doesn't have yet.
+  rng = random.Random(seed)
+  peeweedbevolve.clear()
+  models = []
+  for i in range(count):
+    attrs = {}
+    for j in range(rng.randint(4, 16)):
+      attrs['col_%i' % j] = rng.choice(FIELD_TYPES)()
+    for j in range(rng.choice([0, 0, 1, 1, 1, 2, 3])):
+      if models:
+        attrs['ref_%i' % j] = pw.ForeignKeyField(rng.choice(models), null=True, backref='+')
+    indexes = {}
+    columns = sorted(name for name in attrs if name.startswith('col_'))
+    for j in range(rng.randint(0, 2)):
+      indexes[tuple(rng.sample(columns, rng.randint(1, 2)))] = rng.random() < 0.2
+    if drift and i % 10 == 0:
+      attrs['drift'] = pw.CharField(null=True, index=True)
+    attrs['Meta'] = type('Meta', (), {'database': db, 'table_name': 'bench_model_%i' % i, 'indexes': tuple(sorted(indexes.items()))})
+    models.append(type('BenchModel%i' % i, (pw.Model,), attrs))
+  return models
+
+
+def measure(db):
+  # a cold cache every time - otherwise every run after the first would time sql generation on cache hits
+  peeweedbevolve.sql_cache.clear()
+  with peeweedbevolve.profile() as profiler:
+    start = time.time()
+    to_run = peeweedbevolve.calc_changes(db)
+    wall = time.time() - start
+  seconds = lambda phase: profiler.spans.get(phase, [0, 0.0])[1]
+  introspection = sum(seconds(phase) for phase in INTROSPECTION)
+  sql_generation = seconds('generate_sql')
+  return {
+    'wall': wall,
+    'introspection': introspection,
+    'sql_generation': sql_generation,
+    'diff': max(0.0, wall - introspection - sql_generation),
+    'catalog_queries': profiler.query_count,
+    'statements': len(to_run),
+  }
+
+
+def run_scenarios(backend, db, count, reset):
+  results = []
+  for scenario in SCENARIOS:
+    reset()
+    if scenario != 'empty':
+      db.create_tables(make_models(db, count))
+    make_models(db, count, drift=(scenario == 'drifted'))
+    result = measure(db)
+    result.update({'backend': backend, 'models': count, 'scenario': scenario})
+    results.append(result)
+    print('%-8s %6i %-11s %8.3fs wall  %8.3fs introspection  %8.3fs diff  %8.3fs sql  %7i queries  %7i statements' % (
+      backend, count, scenario, result['wall'], result['introspection'], result['diff'], result['sql_generation'],
+      result['catalog_queries'], result['statements'],
+    ))
+  return results
+
+
+def bench_sqlite(count):
+  fn = os.path.join(tempfile.mkdtemp(), 'peeweedbevolve_bench.db')
+  db = pw.SqliteDatabase(fn)
+  def reset():
+    db.close()
+    if os.path.exists(fn): os.remove(fn)
+    db.connect()
+  try:
+    return run_scenarios('sqlite', db, count, reset)
+  finally:
+    db.close()
+    if os.path.exists(fn): os.remove(fn)
+
+
+def bench_postgres(count, database):
+  db = pw.PostgresqlDatabase(database)
+  try:
+    db.connect()
+  except Exception as e:
+    print('skipping postgres (%s)' % str(e).strip())
+    return []
+  def reset():
+    db.execute_sql('drop schema public cascade')
+    db.execute_sql('create schema public')
+  try:
+    return run_scenarios('postgres', db, count, reset)
+  finally:
+    reset()
+    db.close()
+
+
+CATALOG_TYPES = [
+  ('character varying', 255, None, None), ('integer', None, 32, 0), ('text', None, None, None), ('boolean', None, None, None),
+  ('timestamp without time zone', None, None, None), ('numeric', None, 10, 2), ('bigint', None, 64, 0), ('jsonb', None, None, None),
+]
+COLUMN_NAMES = ['id', 'created_at', 'updated_at', 'name', 'status', 'owner_id', 'amount', 'notes']
+
+def catalog_rows(count, seed=0):
+  # rows shaped like _COLUMNS_SQL's, ~20 columns per table.  every string is a fresh object, like a driver returns.
+  rng = random.Random(seed)
+  fresh = lambda s: s.encode('utf8').decode('utf8')
+  rows = []
+  for i in range(count):
+    table, position = divmod(i, 20)
+    data_type, max_length, precision, scale = rng.choice(CATALOG_TYPES)
+    name = COLUMN_NAMES[position] if position < len(COLUMN_NAMES) else 'col_%i' % position
+    default = fresh('0') if data_type == 'integer' and rng.random() < 0.3 else None
+    rows.append((fresh(name), fresh(data_type), position > 0, position == 0, fresh('bench_model_%i' % table), default, max_length, precision, scale, fresh('public')))
+  return rows
+
+def load_catalog(rows):
+  columns_by_table = collections.defaultdict(list)
+  for row in rows:
+    column = peeweedbevolve._column_from_row(row)
+    columns_by_table[column.table].append(column)
+  return columns_by_table
+
+def bench_catalog(count):
+  import tracemalloc
+  rows = catalog_rows(count)
+  gc.collect()
+  start = time.time()
+  load_catalog(rows)
+  wall = time.time() - start
+  gc.collect()
+  tracemalloc.start()
+  columns_by_table = load_catalog(rows)
+  del rows
+  gc.collect()
+  retained = tracemalloc.get_traced_memory()[0]
+  tracemalloc.stop()
+  result = {'backend': 'catalog', 'models': count, 'scenario': 'metadata', 'wall': wall, 'retained_mb': retained / 1e6, 'tables': len(columns_by_table)}
+  print('%-8s %8i columns  %8.3fs wall  %8.1fMB retained' % ('catalog', count, wall, result['retained_mb']))
+  return [result]
+
+
+def git_commit():
+  try:
+    return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.STDOUT).decode('utf8').strip()
+  except Exception:
+    return None
+
+
+def compare(before_fn, after_fn):
+  with open(before_fn) as f: before = json.load(f)
+  with open(after_fn) as f: after = json.load(f)
+  key = lambda r: (r['backend'], r['models'], r['scenario'])
+  before_by_key = {key(r): r for r in before['results']}
+  print('%-8s %6s %-11s %10s %10s %8s   (%s -> %s)' % ('backend', 'models', 'scenario', 'before', 'after', 'ratio', before.get('commit'), after.get('commit')))
+  for r in after['results']:
+    b = before_by_key.get(key(r))
+    if not b: continue
+    print('%-8s %6i %-11s %9.3fs %9.3fs %7.2fx' % (r['backend'], r['models'], r['scenario'], b['wall'], r['wall'], r['wall'] / b['wall'] if b['wall'] else 0))
+
+
+def main():
+  parser = argparse.ArgumentParser(description='benchmark peewee-db-evolve on synthetic schemas')
+  parser.add_argument('--sizes', default='100,1000', help='comma separated model counts (default 100,1000)')
+  parser.add_argument('--backends', default='sqlite,postgres')
+  parser.add_argument('--postgres-db', default='peeweedbevolve_bench', help='must already exist - its public schema is wiped')
+  parser.add_argument('--output', help='where to write the JSON results (default bench-<commit>.json)')
+  parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'))
+  parser.add_argument('--catalog', type=int, metavar='COLUMNS', help='only benchmark loading column metadata for a synthetic catalog')
+  args = parser.parse_args()
+
+  if args.compare:
+    return compare(*args.compare)
+
+  commit = git_commit()
+  results = []
+  backends = args.backends.split(',')
+  if args.catalog:
+    results += bench_catalog(args.catalog)
+  else:
+    for count in [int(size) for size in args.sizes.split(',')]:
+      if 'sqlite' in backends:
+        results += bench_sqlite(count)
+      if 'postgres' in backends:
+        results += bench_postgres(count, args.postgres_db)
+
+  output = args.output or 'bench-%s.json' % (commit or 'unknown')
+  with open(output, 'w') as f:
+    json.dump({
+      'commit': commit,
+      'python': platform.python_version(),
+      'peewee': pw.__version__,
+      'peeweedbevolve': peeweedbevolve.__version__,
+      'results': results,
+    }, f, indent=2)
+  print('wrote', output)
+
+
+if __name__ == '__main__':
+  main()
@@ -1,6 +1,6 @@
 from __future__ import print_function
 
-import collections, re, sys, time, traceback
+import collections, contextlib, copy, datetime, decimal, functools, hashlib, heapq, itertools, json, multiprocessing.pool, os, re, shutil, sys, tempfile, threading, time, traceback, warnings
 
 try:
   import colorama
@@ -18,8 +18,10 @@ except ImportError:
 if sys.version_info >= (3,0):
   raw_input = input
   from collections.abc import Iterable
+  _intern = sys.intern
 else:
   from collections import Iterable
+  _intern = lambda s: intern(s) if isinstance(s, str) else s
 
 
 
@@ -29,6 +31,12 @@ PW3 = 'pw' in globals() and not hasattr(pw, 'Clause')
 # peewee doesn't do defaults in the database - doh!
 DIFF_DEFAULTS = False
 
+# add an index for every foreign key column no index leads with (see unindexed_foreign_keys)
+INDEX_FOREIGN_KEYS = False
+
+# don't create an index another (kept or planned) index already does the job of (see redundant_indexes)
+SKIP_REDUNDANT_INDEXES = False
+
 __version__ = '3.7.6'
 
 
@@ -38,12 +46,135 @@ except NameError:
   unicode = lambda s: str(s)
 
 
+###################
+# Profiling
+###################
+
+_profiling = threading.local()
+
+class _NullSpan(object):
+  def __enter__(self): return self
+  def __exit__(self, *exc_info): return False
+
+_NULL_SPAN = _NullSpan()
+
+def active_profiler():
+  return getattr(_profiling, 'profiler', None)
+
+def _span(name, **attrs):
+  profiler = getattr(_profiling, 'profiler', None)
+  return _NULL_SPAN if profiler is None else profiler.span(name, **attrs)
+
+def _profiled(name):
+  def decorator(fn):
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+      profiler = getattr(_profiling, 'profiler', None)
+      if profiler is None:
+        return fn(*args, **kwargs)
+      with profiler.span(name):
+        return fn(*args, **kwargs)
+    return wrapper
+  return decorator
+
+def _catalog_query(db, name, sql, params=None):
+  return _catalog_call(name, db.execute_sql, sql, params)
+
+def _catalog_call(name, fn, *args, **kwargs):
+  profiler = getattr(_profiling, 'profiler', None)
+  if profiler is None:
+    return fn(*args, **kwargs)
+  with profiler.query(name):
+    return fn(*args, **kwargs)
+
+# Collects how long each phase of an evolve took and how many catalog queries it ran.  Listeners (see
+# StatsdListener and OpenTelemetryListener) get a span(name, attrs) call around each phase and query too.
+class Profiler(object):
+
+  def __init__(self, listeners=None):
+    self.listeners = list(listeners or [])
+    self.spans = collections.OrderedDict()
+    self.queries = collections.OrderedDict()
+
+  def span(self, name, **attrs):
+    return self._timed(self.spans, name, attrs)
+
+  def query(self, name):
+    return self._timed(self.queries, name, {}, prefix='catalog.')
+
+  @contextlib.contextmanager
+  def _timed(self, totals, name, attrs, prefix=''):
+    listener_spans = [listener.span(prefix + name, attrs) for listener in self.listeners]
+    for listener_span in listener_spans:
+      listener_span.__enter__()
+    start = time.time()
+    try:
+      yield
+    finally:
+      duration = time.time() - start
+      calls_and_seconds = totals.setdefault(name, [0, 0.0])
+      calls_and_seconds[0] += 1
+      calls_and_seconds[1] += duration
+      exc_info = sys.exc_info()
+      for listener_span in reversed(listener_spans):
+        listener_span.__exit__(*exc_info)
+
+  @property
+  def query_count(self):
+    return sum(calls for calls, _ in self.queries.values())
+
+  def report(self):
+    lines = ['%-28s %8s %10s %10s' % ('phase', 'calls', 'total s', 'mean ms')]
+    for name, (calls, seconds) in self.spans.items():
+      lines.append('%-28s %8i %10.3f %10.2f' % (name, calls, seconds, seconds * 1000 / calls))
+    lines.append('')
+    lines.append('%-28s %8i %10.3f' % ('catalog queries', self.query_count, sum(seconds for _, seconds in self.queries.values())))
+    for name, (calls, seconds) in self.queries.items():
+      lines.append('  %-26s %8i %10.3f %10.2f' % (name, calls, seconds, seconds * 1000 / calls))
+    return '\n'.join(lines)
+
+@contextlib.contextmanager
+def profile(listeners=None, profiler=None):
+  # with peeweedbevolve.profile() as profiler: db.evolve(); print(profiler.report())
+  profiler = profiler or Profiler(listeners)
+  previous = active_profiler()
+  _profiling.profiler = profiler
+  try:
+    yield profiler
+  finally:
+    _profiling.profiler = previous
+
+class StatsdListener(object):
+
+  def __init__(self, client, prefix='peeweedbevolve'):
+    self.client = client
+    self.prefix = prefix
+
+  @contextlib.contextmanager
+  def span(self, name, attrs):
+    start = time.time()
+    try:
+      yield
+    finally:
+      self.client.timing('%s.%s' % (self.prefix, name), (time.time() - start) * 1000)
+
+class OpenTelemetryListener(object):
+
+  def __init__(self, tracer, prefix='peeweedbevolve'):
+    self.tracer = tracer
+    self.prefix = prefix
+
+  def span(self, name, attrs):
+    return self.tracer.start_as_current_span('%s.%s' % (self.prefix, name), attributes=attrs or None)
+
+
 ###################
 # Peewee 2 Shims
 ###################
 
 
 if PW3:
+  @_profiled('generate_sql')
   def extract_query_from_migration(migration):
     if isinstance(migration, Iterable):
       # Postgrsql has context first, MySql has context last :(
@@ -54,26 +185,17 @@ if PW3:
       return [ctx.query()]
     
     # sqlite3
-    method = getattr(migration.migrator, getattr(migration, 'method'))
-    nodelist = method(*getattr(migration, 'args'), with_context=True)
-
-    # don't actually execute    
-    orig_execute = ctx.migrator.database.execute
-    def dummy_execute(*args, **kwargs): pass
-    ctx.migrator.database.execute = dummy_execute
-    
-    try:
-      nodes = []
-      def execute(node):
-        state = pw.Context()
-        pw_ctx = node.__sql__(state)
-        sql, args = pw_ctx.query()
-        nodes.append((sql, args))
-      ctx.execute = execute
-      ctx.run()
-    finally:
-      ctx.migrator.database.execute = orig_execute
-    return nodes
+    return _operation_queries(migration)
+
+  def _operation_queries(result):
+    # what playhouse.migrate.Operation.run() would execute (including any operations it runs in turn), without
+    # executing it - so no need to swap out the database's execute() while we do
+    if isinstance(result, playhouse.migrate.Operation):
+      kwargs = dict(result.kwargs, with_context=True)
+      return _operation_queries(getattr(result.migrator, result.method)(*result.args, **kwargs))
+    if isinstance(result, (list, tuple)):
+      return [query for item in result for query in _operation_queries(item)]
+    return [result.__sql__(pw.Context()).query()]
 
   def _table_name(model):
     return model._meta.table_name
@@ -87,8 +209,44 @@ if PW3:
   def _is_foreign_key(field):
     return hasattr(field, 'rel_model')
 
-  def create_table(model):
-    manager = pw.SchemaManager(model)
+  class _SchemaManager(pw.SchemaManager):
+    # peewee's CREATE TABLE, minus the inline foreign keys.  evolve adds those with ALTER TABLE once every new table
+    # exists.  peewee leaves them out for deferred fields, but flipping field.deferred on shared models isn't thread safe.
+    def _create_table(self, safe=True, **options):
+      ctx = self._create_context()
+      ctx.literal('CREATE UNLOGGED TABLE ' if _is_unlogged(self.model, self.database) else 'CREATE TABLE ')
+      if safe:
+        ctx.literal('IF NOT EXISTS ')
+      ctx.sql(self.model).literal(' ')
+      meta = self.model._meta
+      columns = [field.ddl(ctx) for field in meta.sorted_fields]
+      constraints = []
+      if meta.composite_key:
+        pk_columns = [meta.fields[field_name].column for field_name in meta.primary_key.field_names]
+        constraints.append(pw.NodeList((pw.SQL('PRIMARY KEY'), pw.EnclosedNodeList(pk_columns))))
+      if meta.constraints:
+        constraints.extend(meta.constraints)
+      constraints.extend(self._create_table_option_sql(options))
+      ctx.sql(pw.EnclosedNodeList(columns + constraints))
+      partitioning = _partition_by(self.model, self.database)
+      if partitioning:
+        ctx.literal(' PARTITION BY ').literal(partitioning.key_sql(self.database, self.model))
+      table_options = _table_options_sql(self.model, self.database)
+      if table_options:
+        ctx.literal(' ').literal(table_options)
+      if meta.table_settings is not None:
+        for setting in pw.ensure_tuple(meta.table_settings):
+          ctx.literal(' ').literal(setting)
+      extra_opts = []
+      if getattr(meta, 'strict_tables', False): extra_opts.append('STRICT')
+      if getattr(meta, 'without_rowid', False): extra_opts.append('WITHOUT ROWID')
+      if extra_opts:
+        ctx.literal(' %s' % ', '.join(extra_opts))
+      return ctx
+
+  @_profiled('generate_sql')
+  def create_table(model, db=None):
+    manager = _SchemaManager(model, database=db)
     ctx = manager._create_table()
     return [(''.join(ctx._sql), ctx._values)]
 
@@ -100,19 +258,22 @@ if PW3:
     migration = migrator.make_context().literal('DROP TABLE ').sql(pw.Entity(name))
     return extract_query_from_migration(migration)
 
-  def create_index(model, fields, unique):
-    manager = pw.SchemaManager(model)
-    ctx = manager._create_index(pw.ModelIndex(model, fields, unique=unique))
+  @_profiled('generate_sql')
+  def create_index(model, index, db=None):
+    # index is a ModelIndex, from indexes_on_model
+    manager = pw.SchemaManager(model, database=db)
+    ctx = manager._create_index(index)
     return [(''.join(ctx._sql), ctx._values)]
 
   def drop_index(migrator, model, index):
     migration = migrator.make_context().literal('DROP INDEX ').sql(pw.Entity(index.name))
-    if is_mysql(model._meta.database):
+    if is_mysql(migrator.database):
       migration = migration.literal(' ON ').sql(pw.Entity(_table_name(model)))
     return extract_query_from_migration(migration)
 
-  def create_foreign_key(field):
-    manager = pw.SchemaManager(field.model)
+  @_profiled('generate_sql')
+  def create_foreign_key(field, db=None):
+    manager = pw.SchemaManager(field.model, database=db)
     ctx = manager._create_foreign_key(field)
     return [(''.join(ctx._sql), ctx._values)]
 
@@ -133,13 +294,15 @@ if PW3:
       .literal(' SET ').sql(pw.Expression(pw.Entity(column_name), pw.OP.EQ, field.db_value(default), flat=True))
       .literal(' WHERE ').sql(pw.Expression(pw.Entity(column_name), pw.OP.IS, pw.SQL('NULL'), flat=True))
     )
-    return extract_query_from_migration(migration)
+    return [Backfill(sql, params, table_name, column_name, field.db_value(default)) for sql, params in extract_query_from_migration(migration)]
 
   def alter_add_column(db, migrator, ntn, column_name, field):
-    migration = migrator.alter_add_column(ntn, column_name, field, with_context=True)
+    # playhouse flips the field to null (and can rename it) while it renders the column, so give it a copy - other
+    # threads may be reading the model's own field
+    migration = migrator.alter_add_column(ntn, column_name, copy.copy(field), with_context=True)
     to_run = extract_query_from_migration(migration)
     if is_mysql(db) and _is_foreign_key(field):
-      to_run += create_foreign_key(field)
+      to_run += create_foreign_key(field, db=db)
     return to_run
 
   def drop_not_null(migrator, ntn, defined_col):
@@ -167,7 +330,12 @@ if PW3:
     elif is_mysql(db):
       migration = migrator._alter_table(ctx, table_name).literal(' MODIFY COLUMN ').sql(field.ddl(ctx))
     elif is_sqlite(db):
-      migration = migrator.alter_column_type(table_name, column_name, field)
+      # a table rebuild with the column's whole new definition, NULL / NOT NULL included.  (peewee's alter_column_type
+      # puts the column's name in it twice.)
+      def column_definition(name, column_def):
+        ctx = migrator.make_context()
+        return ctx.sql(field.ddl(ctx)).query()[0]
+      migration = migrator._update_column(table_name, column_name, column_definition)
     else:
       raise Exception('how do i change a column type for %s?' % db)
     return extract_query_from_migration(migration)
@@ -184,11 +352,55 @@ if PW3:
       cmds += extract_query_from_migration(migration)
     return cmds
 
+  class CoveringIndex(pw.ModelIndex):
+    # a ModelIndex with non-key columns (postgres 11+), so queries reading only those can be index-only scans:
+    #   Order.add_index(CoveringIndex(Order, (Order.customer, Order.created_at), include=(Order.total,)))
+    def __init__(self, model, fields, include=(), **kwargs):
+      super(CoveringIndex, self).__init__(model, fields, **kwargs)
+      self._include = tuple(model._meta.combined[f] if hasattr(f, 'lower') else f for f in include)
+
+    def __sql__(self, ctx):
+      if not self._include:
+        return super(CoveringIndex, self).__sql__(ctx)
+      # INCLUDE goes between the key columns and WHERE
+      keys = self.clone()
+      keys._where = None
+      pw.ModelIndex.__sql__(keys, ctx)
+      with ctx.scope_values(subquery=True):
+        ctx.literal(' INCLUDE ').sql(pw.EnclosedNodeList(self._include))
+        if self._where is not None:
+          ctx.literal(' WHERE ').sql(self._where)
+      return ctx
+
   def indexes_on_model(model):
-    return [
-      pw.IndexMetadata('', '', [_column_name(f) for f in idx._expressions], idx._unique, _table_name(model))
-      for idx in model._meta.fields_to_index()
-    ]
+    # field indexes and Meta.indexes, either (field_names, unique) or ModelIndex (partial, expression, using=...)
+    return model._meta.fields_to_index()
+
+  def plain_index(model, fields):
+    return pw.ModelIndex(model, fields)
+
+  def index_metadata(db, model, index):
+    columns = [_column_name(e) for e in index._expressions if isinstance(e, pw.Field)]
+    if index._where is None and index._using is None and not getattr(index, '_include', None) and len(columns)==len(index._expressions):
+      return pw.IndexMetadata(index._name, None, columns, index._unique, _table_name(model))
+    # anything fancier is compared by its sql
+    sql, params = create_index(model, index, db=db)[0]
+    return pw.IndexMetadata(index._name, _inline_params(db, sql, params), columns, index._unique, _table_name(model))
+
+  def _index_fingerprint(index):
+    parts = []
+    for e in index._expressions:
+      if isinstance(e, pw.Field): parts.append(('field', e.name))
+      elif isinstance(e, pw.Ordering) and isinstance(e.node, pw.Field): parts.append(('ordering', e.node.name, e.direction, e.collation, e.nulls))
+      elif isinstance(e, pw.SQL): parts.append(('sql', e.sql, tuple(e.params or ())))
+      elif hasattr(e, 'lower'): parts.append(('sql', e, ()))
+      else: return None # an arbitrary expression, which has nothing stable to key on
+    where = index._where
+    if where is not None:
+      if not isinstance(where, pw.SQL): return None
+      where = (where.sql, tuple(where.params or ()))
+    include = tuple(e.name if isinstance(e, pw.Field) else e for e in getattr(index, '_include', ()))
+    return (index._name, index._unique, getattr(index, '_safe', True), index._using, tuple(parts), where, include)
 
 else:
   def normalize_op_to_clause(migrator, op):
@@ -212,9 +424,27 @@ else:
   def _is_foreign_key(field):
     return isinstance(field, pw.ForeignKeyField)
 
-  def create_table(cls):
-    compiler = cls._meta.database.compiler()
-    return [compiler.create_table(cls)]
+  _pw2_deferred_lock = threading.Lock()
+
+  def create_table(cls, db=None):
+    # peewee 2 only leaves inline foreign keys out for deferred fields, so defer them just while we generate the sql
+    compiler = (db or cls._meta.database).compiler()
+    partitioning = _partition_by(cls, db)
+    with _pw2_deferred_lock:
+      fks = [f for f in cls._meta.sorted_fields if _is_foreign_key(f) and not f.deferred]
+      for field in fks: field.deferred = True
+      try:
+        sql, params = compiler.create_table(cls)
+      finally:
+        for field in fks: field.deferred = False
+    if partitioning:
+      sql += ' PARTITION BY %s' % partitioning.key_sql(db or cls._meta.database, cls)
+    table_options = _table_options_sql(cls, db)
+    if table_options:
+      sql += ' ' + table_options
+    if _is_unlogged(cls, db):
+      sql = re.sub(r'^CREATE TABLE', 'CREATE UNLOGGED TABLE', sql, count=1, flags=re.I)
+    return [(sql, params)]
 
   def rename_table(migrator, before, after):
     compiler = migrator.database.compiler()
@@ -225,17 +455,19 @@ else:
     compiler = migrator.database.compiler()
     return [compiler.parse_node(pw.Clause(pw.SQL('DROP TABLE'), pw.Entity(table_name)))]
 
-  def create_index(model, fields, name):
-    compiler = model._meta.database.compiler()
-    return [compiler.create_index(model, fields, name)]
+  def create_index(model, index, db=None):
+    # index is (fields, unique), from indexes_on_model
+    fields, unique = index
+    compiler = (db or model._meta.database).compiler()
+    return [compiler.create_index(model, fields, unique)]
 
   def drop_index(migrator, model, index):
     compiler = migrator.database.compiler()
     op = migrator.drop_index(_table_name(model), index.name, generate=True)
     return normalize_whatever_junk_peewee_migrations_gives_you(migrator, op)
 
-  def create_foreign_key(field):
-    compiler = field.model_class._meta.database.compiler()
+  def create_foreign_key(field, db=None):
+    compiler = (db or field.model_class._meta.database).compiler()
     return [compiler.create_foreign_key(field.model_class, field)]
 
   def drop_foreign_key(db, migrator, table_name, fk_name):
@@ -256,10 +488,10 @@ else:
 
   def alter_add_column(db, migrator, ntn, column_name, field):
     compiler = migrator.database.compiler()
-    operation = migrator.alter_add_column(ntn, column_name, field, generate=True)
+    operation = migrator.alter_add_column(ntn, column_name, copy.copy(field), generate=True)
     to_run = normalize_whatever_junk_peewee_migrations_gives_you(migrator, operation)
     if is_mysql(db) and _is_foreign_key(field):
-      to_run += create_foreign_key(field)
+      to_run += create_foreign_key(field, db=db)
     return to_run
 
   def drop_not_null(migrator, ntn, defined_col):
@@ -323,30 +555,209 @@ else:
     raise Exception('how do i add a not null for %s?' % db)
 
   def indexes_on_model(model):
-    return [pw.IndexMetadata('', '', [_column_name(f)], f.unique, _table_name(model)) for f in model._fields_to_index()]
+    # (fields, unique) for field indexes and Meta.indexes
+    indexes = [([f], f.unique) for f in model._fields_to_index()]
+    for names, unique in model._meta.indexes:
+      indexes.append(([model._meta.fields[name] for name in names], unique))
+    return indexes
+
+  def plain_index(model, fields):
+    return (fields, False)
+
+  def index_metadata(db, model, index):
+    fields, unique = index
+    return pw.IndexMetadata('', None, [_column_name(f) for f in fields], unique, _table_name(model))
+
+  def _index_fingerprint(index):
+    fields, unique = index
+    return (tuple(f.name for f in fields), unique)
+
+
+###################
+# SQL generation cache
+###################
+
+# An LRU of generated statements, keyed by (operation, dialect, fingerprint of the model/field/table it was generated
+# from), so planning the same change for hundreds of shards (or on every deploy) only compiles it once.
+class SQLCache(object):
+
+  def __init__(self, maxsize=4096):
+    self.maxsize = maxsize
+    self.hits = 0
+    self.misses = 0
+    self._entries = collections.OrderedDict()
+    self._lock = threading.Lock()
+
+  def get(self, key, generate):
+    with self._lock:
+      if key in self._entries:
+        self.hits += 1
+        statements = self._entries.pop(key)
+        self._entries[key] = statements
+        return _copy_statements(statements)
+    statements = generate()
+    with self._lock:
+      self.misses += 1
+      if self.maxsize > 0:
+        self._entries[key] = _copy_statements(statements)
+        while len(self._entries) > self.maxsize:
+          self._entries.popitem(last=False)
+    return statements
+
+  def clear(self):
+    with self._lock:
+      self._entries.clear()
+      self.hits = 0
+      self.misses = 0
+
+  def __len__(self):
+    return len(self._entries)
+
+sql_cache = SQLCache(maxsize=16384)
+
+def _copy_statements(statements):
+  # params lists too, so a caller changing its statements can't change what the cache hands out next
+  copied = []
+  for stmt in statements:
+    sql, params = stmt
+    if isinstance(params, list): params = list(params)
+    copied.append(Backfill(sql, params, stmt.table, stmt.column, stmt.value) if isinstance(stmt, Backfill) else (sql, params))
+  return copied
+
+# models and databases don't change while a plan is being calculated, so their fingerprints are only worked out once
+# per calc_changes (a model's can cost more than generating one statement from it)
+_fingerprints = threading.local()
+
+@contextlib.contextmanager
+def _memoized_fingerprints():
+  outer = getattr(_fingerprints, 'memo', None)
+  if outer is None: _fingerprints.memo = {}
+  try:
+    yield
+  finally:
+    if outer is None: _fingerprints.memo = None
+
+def _memoized(fn):
+  @functools.wraps(fn)
+  def memoized(obj):
+    memo = getattr(_fingerprints, 'memo', None)
+    if memo is None: return fn(obj)
+    if obj not in memo: memo[obj] = fn(obj)
+    return memo[obj]
+  return memoized
+
+@_memoized
+def _dialect_fingerprint(db):
+  return (db.__class__.__module__, db.__class__.__name__, tuple(sorted((k, unicode(v)) for k, v in (getattr(db, 'field_types', None) or {}).items())))
+
+def _sql_fingerprint(nodes):
+  return tuple(getattr(node, 'sql', None) or repr(node) for node in (nodes or ()))
+
+def _field_fingerprint(field):
+  default = field.default
+  if callable(default): default = (default.__module__, getattr(default, '__name__', repr(default)))
+  rel = None
+  if _is_foreign_key(field):
+    rel_field = getattr(field, 'rel_field', None) or getattr(field, 'to_field', None)
+    rel = (_table_name(field.rel_model), rel_field and _column_name(rel_field), field.on_delete, field.on_update)
+  return (
+    type(field).__module__, type(field).__name__, field.name, _column_name(field), _field_type(field), field.null,
+    field.unique, field.index, bool(field.primary_key), repr(default),
+    getattr(field, 'max_length', None), getattr(field, 'max_digits', None), getattr(field, 'decimal_places', None),
+    _sql_fingerprint(getattr(field, 'constraints', None)), getattr(field, 'sequence', None), getattr(field, 'collation', None), rel,
+    tuple(getattr(field, option, None) for option in COLUMN_OPTIONS),
+  )
+
+@_memoized
+def _model_fingerprint(model):
+  meta = model._meta
+  pk = meta.primary_key
+  return (
+    _table_name(model), getattr(meta, 'schema', None),
+    tuple(_field_fingerprint(f) for f in meta.sorted_fields),
+    tuple(pk.field_names) if isinstance(pk, pw.CompositeKey) else None,
+    _sql_fingerprint(getattr(meta, 'constraints', None)), repr(getattr(meta, 'table_settings', None)), repr(sorted((getattr(meta, 'options', None) or {}).items())),
+    getattr(meta, 'without_rowid', False), getattr(meta, 'strict_tables', False), repr(getattr(meta, 'partition_by', None)),
+    repr(sorted((getattr(meta, 'storage_parameters', None) or {}).items())), getattr(meta, 'storage_parameters', None) is None, getattr(meta, 'unlogged', None),
+    tuple(repr(getattr(meta, name, None)) for name in MYSQL_TABLE_OPTIONS),
+  )
+
+def _cached_sql(operation, fingerprint):
+  # fingerprint gets the same arguments as the generator and returns the rest of the key, or None if the result
+  # can't be reused (sqlite table rebuilds depend on the live table, callable defaults are called per statement)
+  def decorator(fn):
+    @functools.wraps(fn)
+    def cached(*args, **kwargs):
+      key = fingerprint(*args, **kwargs)
+      try:
+        hash(key)
+      except TypeError:
+        key = None
+      if key is None:
+        return fn(*args, **kwargs)
+      return sql_cache.get((operation,) + key, lambda: fn(*args, **kwargs))
+    return cached
+  return decorator
+
+def _model_of(field):
+  return field.model_class if hasattr(field, 'model_class') else field.model
+
+def _column_change_fingerprint(db, migrator, table, column_name, field):
+  if is_sqlite(db) or callable(field.default): return None
+  return (_dialect_fingerprint(db), table, column_name, _field_fingerprint(field))
+
+create_table = _cached_sql('create_table', lambda model, db=None: (_dialect_fingerprint(db or model._meta.database), _model_fingerprint(model)))(create_table)
+def _create_index_fingerprint(model, index, db=None):
+  index_fingerprint = _index_fingerprint(index)
+  if index_fingerprint is None: return None
+  return (_dialect_fingerprint(db or model._meta.database), _model_fingerprint(model), index_fingerprint)
+
+create_index = _cached_sql('create_index', _create_index_fingerprint)(create_index)
+create_foreign_key = _cached_sql('create_foreign_key', lambda field, db=None: (
+  _dialect_fingerprint(db or _model_of(field)._meta.database), _model_fingerprint(_model_of(field)), field.name
+))(create_foreign_key)
+alter_add_column = _cached_sql('alter_add_column', _column_change_fingerprint)(alter_add_column)
+add_not_null = _cached_sql('add_not_null', _column_change_fingerprint)(add_not_null)
+change_column_type = _cached_sql('change_column_type', _column_change_fingerprint)(change_column_type)
+drop_not_null = _cached_sql('drop_not_null', lambda migrator, ntn, defined_col: (
+  None if is_sqlite(migrator.database) else (_dialect_fingerprint(migrator.database), ntn, defined_col)
+))(drop_not_null)
+rename_column = _cached_sql('rename_column', lambda db, migrator, table, ocn, ncn, field: (
+  None if is_sqlite(db) else (_dialect_fingerprint(db), table, ocn, ncn, _field_fingerprint(field))
+))(rename_column)
+drop_column = _cached_sql('drop_column', lambda db, migrator, table, column_name: (
+  None if is_sqlite(db) else (_dialect_fingerprint(db), table, column_name)
+))(drop_column)
 
 ####
 
-def mark_fks_as_deferred(table_names):
+def deferred_foreign_keys(table_names, models=None):
+  # new tables are created without their foreign keys (see create_table), which are added once they all exist
   add_fks = []
-  table_names_to_models = {_table_name(cls): cls for cls in all_models.keys() if _table_name(cls) in table_names}
+  if models is None: models = all_models.keys()
+  table_names_to_models = {_table_name(cls): cls for cls in models if _table_name(cls) in table_names}
 
   for model in table_names_to_models.values():
     for field in model._meta.sorted_fields:
       if _is_foreign_key(field):
         add_fks.append(field)
-        if not field.deferred:
-          field.__pwdbev__not_deferred = True
-          field.deferred = True
   return add_fks
 
-def calc_table_changes(existing_tables, ignore_tables=None):
-  if ignore_tables:
-    ignore_tables = set(ignore_tables) | globals()['ignore_tables']
-  else:
-    ignore_tables = globals()['ignore_tables']
+def mark_fks_as_deferred(table_names, models=None):
+  # deprecated - new tables are created without their foreign keys now, so nothing needs marking.  use deferred_foreign_keys()
+  warnings.warn('mark_fks_as_deferred() is deprecated, use deferred_foreign_keys()', DeprecationWarning, stacklevel=2)
+  return deferred_foreign_keys(table_names, models=models)
+
+@_profiled('calc_table_changes')
+def calc_table_changes(existing_tables, ignore_tables=None, models=None):
+  # with no models, diff the global registry (and respect its ignored tables)
+  ignore_tables = set(ignore_tables or [])
+  if models is None:
+    models = all_models.keys()
+    ignore_tables |= globals()['ignore_tables']
+  ignore_tables |= EVOLVE_TABLES
   existing_tables = set(existing_tables)
-  table_names_to_models = {unicode(_table_name(cls)):cls for cls in all_models.keys()}
+  table_names_to_models = {unicode(_table_name(cls)):cls for cls in models}
   defined_tables = set(table_names_to_models.keys())
   adds = defined_tables - existing_tables - ignore_tables
   deletes = existing_tables - defined_tables - ignore_tables
@@ -364,7 +775,9 @@ def calc_table_changes(existing_tables, ignore_tables=None):
           adds.remove(to_add)
           deletes.remove(a)
           break
-  add_fks = mark_fks_as_deferred(adds)
+  if deletes:
+    deletes -= _detached_partitions(deletes, models)
+  add_fks = deferred_foreign_keys(adds, models=models)
   return adds, add_fks, deletes, renames
 
 def is_postgres(db):
@@ -386,18 +799,30 @@ def auto_detect_migrator(db):
   raise Exception("could not auto-detect migrator for %s - please provide one via the migrator kwarg" % repr(db.__class__.__name__))
 
 _re_varchar = re.compile('^varchar[(]\\d+[)]$')
+_TYPE_ALIASES = {
+  'serial': 'integer', 'int': 'integer', 'integer auto_increment': 'integer', 'auto': 'integer',
+  'timestamp without time zone': 'timestamp', 'datetime': 'timestamp',
+  'timestamp with time zone': 'timestamptz', 'datetime_tz': 'timestamptz',
+  'time without time zone': 'time',
+  'character varying': 'varchar',
+  'decimal': 'numeric', 'real': 'numeric', 'float': 'numeric',
+  'boolean': 'bool',
+  'bytea': 'blob',
+}
+# raw type -> interned normalized type.  a catalog only has a handful of distinct types, so this stays small.
+_normalized_types = {}
+
 def normalize_column_type(t):
-  t = t.lower()
-  if t in ['serial', 'int', 'integer auto_increment', 'auto']: t = 'integer'
-  if t in ['timestamp without time zone', 'datetime']: t = 'timestamp'
-  if t in ['timestamp with time zone', 'datetime_tz']: t = 'timestamptz'
-  if t in ['time without time zone']: t = 'time'
-  if t in ['character varying']: t = 'varchar'
-  if _re_varchar.match(t): t = 'varchar'
-  if t in ['decimal', 'real', 'float']: t = 'numeric'
-  if t in ['boolean']: t = 'bool'
-  if t in ['bytea']: t = 'blob'
-  return unicode(t)
+  try:
+    return _normalized_types[t]
+  except KeyError:
+    pass
+  normalized = t.lower()
+  normalized = _TYPE_ALIASES.get(normalized, normalized)
+  if _re_varchar.match(normalized): normalized = 'varchar'
+  normalized = _intern(unicode(normalized))
+  _normalized_types[t] = normalized
+  return normalized
 
 
 def normalize_default(default):
@@ -423,8 +848,9 @@ def are_data_types_equal(db, type_a, type_b):
   if is_sqlite(db) and type_b.startswith('char(') and type_a=='char': return True
   return False
 
-def column_def_changed(db, a, b):
+def column_def_changed(db, a, b, diff_defaults=None):
   # b is the defined column
+  if diff_defaults is None: diff_defaults = DIFF_DEFAULTS
   return (
     a.null!=b.null or
     not are_data_types_equal(db, a.data_type, b.data_type) or
@@ -433,23 +859,29 @@ def column_def_changed(db, a, b):
     (not is_sqlite(db) and b.precision is not None and a.precision!=b.precision) or
     (not is_sqlite(db) and b.scale is not None and a.scale!=b.scale) or
     bool(a.primary_key)!=bool(b.primary_key) or
-    (DIFF_DEFAULTS and normalize_default(a.default)!=normalize_default(b.default))
+    (diff_defaults and normalize_default(a.default)!=normalize_default(b.default))
   )
 
 ColumnMetadata = collections.namedtuple('ColumnMetadata', (
   'name', 'data_type', 'null', 'primary_key', 'table', 'default', 'max_length', 'precision', 'scale'
 ))
 
-def get_columns_by_table(db, schema=None):
-  columns_by_table = collections.defaultdict(list)
-  if is_postgres(db) or is_mysql(db):
-    if schema is None and is_mysql(db):
-      schema_check = 'c.table_schema=DATABASE()'
-      params = []
-    else:
-      schema_check = 'c.table_schema=%s'
-      params = [schema or 'public']
-    sql = '''
+# column and table names repeat across a catalog (every table has an id), so they're interned rather than kept as a
+# fresh string per row.  data types are interned by normalize_column_type.
+
+def _column_from_row(row):
+  data_type = normalize_column_type(row[1])
+  max_length = None if row[6]==4294967295 else row[6] # MySQL returns 4294967295L for LONGTEXT fields
+  default = None if row[5] is not None and row[5].startswith('nextval') else row[5]
+  precision = row[7] if data_type=='numeric' else None
+  scale = row[8] if data_type=='numeric' else None
+  return ColumnMetadata(_intern(row[0]), data_type, row[2], row[3], _intern(row[4]), default, max_length, precision, scale)
+
+def _column_from_table_info(table_name, row):
+  # row from sqlite's pragma_table_info
+  return ColumnMetadata(_intern(row[0]), normalize_column_type(row[1]), not row[2], row[4], table_name, row[3], None, None, None)
+
+_COLUMNS_SQL = '''
         select
           c.column_name,
           c.data_type,
@@ -459,58 +891,67 @@ def get_columns_by_table(db, schema=None):
           c.column_default,
           c.character_maximum_length as max_length,
           c.numeric_precision,
-          c.numeric_scale
+          c.numeric_scale,
+          c.table_schema
         from information_schema.columns as c
         left join information_schema.key_column_usage as kcu
         on (c.table_name=kcu.table_name and c.table_schema=kcu.table_schema and c.column_name=kcu.column_name)
         left join information_schema.table_constraints as tc
         on (tc.table_name=kcu.table_name and tc.table_schema=kcu.table_schema and tc.constraint_name=kcu.constraint_name)
         where %s
-        order by c.ordinal_position
-    ''' % schema_check
-    cursor = db.execute_sql(sql, params)
+        order by %s
+'''
+
+@_profiled('get_columns')
+def get_columns_by_table(db, schema=None):
+  columns_by_table = collections.defaultdict(list)
+  if is_postgres(db) or is_mysql(db):
+    if schema is None and is_mysql(db):
+      schema_check = 'c.table_schema=DATABASE()'
+      params = []
+    else:
+      schema_check = 'c.table_schema=%s'
+      params = [schema or 'public']
+    cursor = _catalog_query(db, 'columns', _COLUMNS_SQL % (schema_check, 'c.ordinal_position'), params)
   elif is_sqlite(db):
-    for row in db.execute_sql("select name from sqlite_schema where type='table' and name NOT LIKE 'sqlite_%'"):
-      table_name = row[0]
-      for row in db.execute_sql('select name, type, "notnull", dflt_value, pk from pragma_table_info(?)', [table_name]):
-        data_type = normalize_column_type(row[1])
-        column = ColumnMetadata(row[0], data_type, not row[2], row[4], table_name, row[3], None, None, None)
-        columns_by_table[column.table].append(column)
+    for row in _catalog_query(db, 'tables', "select name from sqlite_schema where type='table' and name NOT LIKE 'sqlite_%'"):
+      table_name = _intern(row[0])
+      for row in _catalog_query(db, 'table_info', 'select name, type, "notnull", dflt_value, pk from pragma_table_info(?)', [table_name]):
+        columns_by_table[table_name].append(_column_from_table_info(table_name, row))
     return columns_by_table
   else:
     raise Exception("don't know how to get columns for %s" % db)
   for row in cursor.fetchall():
-    data_type = normalize_column_type(row[1])
-    max_length = None if row[6]==4294967295 else row[6] # MySQL returns 4294967295L for LONGTEXT fields
-    default = None if row[5] is not None and row[5].startswith('nextval') else row[5]
-    precision = row[7] if data_type=='numeric' else None
-    scale = row[8] if data_type=='numeric' else None
-    column = ColumnMetadata(row[0], data_type, row[2], row[3], row[4], default, max_length, precision, scale)
+    column = _column_from_row(row)
     columns_by_table[column.table].append(column)
   return columns_by_table
 
 ForeignKeyMetadata = collections.namedtuple('ForeignKeyMetadata', ('column', 'dest_table', 'dest_column', 'table', 'name'))
 
-def get_foreign_keys_by_table(db, schema=None):
-  fks_by_table = collections.defaultdict(list)
-  if is_postgres(db):
-    sql = """
-      select kcu.column_name, ccu.table_name, ccu.column_name, tc.table_name, tc.constraint_name
+_PG_FOREIGN_KEYS_SQL = """
+      select kcu.column_name, ccu.table_name, ccu.column_name, tc.table_name, tc.constraint_name, tc.table_schema
       from information_schema.table_constraints as tc
       join information_schema.key_column_usage as kcu
         on (tc.constraint_name = kcu.constraint_name and tc.constraint_schema = kcu.constraint_schema)
       join information_schema.constraint_column_usage as ccu
         on (ccu.constraint_name = tc.constraint_name and ccu.constraint_schema = tc.constraint_schema)
-      where tc.constraint_type = 'FOREIGN KEY' and tc.table_schema = %s
-    """
-    cursor = db.execute_sql(sql, (schema or 'public',))
+      where tc.constraint_type = 'FOREIGN KEY' and tc.table_schema = any(%s)
+"""
+
+@_profiled('get_foreign_keys')
+def get_foreign_keys_by_table(db, schema=None, table=None):
+  # all the foreign keys in schema, or just table's
+  fks_by_table = collections.defaultdict(list)
+  if is_postgres(db):
+    sql = _PG_FOREIGN_KEYS_SQL + (' and tc.table_name = %s' if table else '')
+    cursor = _catalog_query(db, 'foreign_keys', sql, [[schema or 'public']] + ([table] if table else []))
   elif is_mysql(db):
     sql = """
       select column_name, referenced_table_name, referenced_column_name, table_name, constraint_name
       from information_schema.key_column_usage
       where table_schema=database() and referenced_table_name is not null and referenced_column_name is not null
-    """
-    cursor = db.execute_sql(sql, [])
+    """ + (' and table_name = %s' if table else '')
+    cursor = _catalog_query(db, 'foreign_keys', sql, [table] if table else [])
   elif is_sqlite(db):
     # does not work
     sql = """
@@ -519,10 +960,10 @@ def get_foreign_keys_by_table(db, schema=None):
       FROM
           sqlite_master m
           JOIN pragma_foreign_key_list(m.name) p ON m.name != p."table"
-      WHERE m.type = 'table'
+      WHERE m.type = 'table'%s
       ORDER BY m.name
-    """
-    cursor = db.execute_sql(sql, [])
+    """ % (' AND m.name = ?' if table else '')
+    cursor = _catalog_query(db, 'foreign_keys', sql, [table] if table else [])
   else:
     raise Exception("don't know how to get FKs for %s" % db)
   for row in cursor.fetchall():
@@ -530,39 +971,209 @@ def get_foreign_keys_by_table(db, schema=None):
     fks_by_table[fk.table].append(fk)
   return fks_by_table
 
-def get_indexes_by_table(db, table, schema=None):
-  # peewee's get_indexes returns the columns in an index in arbitrary order
+# A postgres partitioned table: its key (as pg_get_partkeydef writes it, e.g. "RANGE (created_at)") and its
+# partitions, {name: bound}
+PartitionedTable = collections.namedtuple('PartitionedTable', ('table', 'key', 'partitions'))
+
+_PG_PARTITIONS_SQL = '''
+      select parent.relname, pg_catalog.pg_get_partkeydef(parent.oid), child.relname,
+        pg_catalog.pg_get_expr(child.relpartbound, child.oid), parent_namespace.nspname
+      from pg_catalog.pg_class parent
+      join pg_catalog.pg_namespace parent_namespace on parent_namespace.oid = parent.relnamespace
+      left join pg_catalog.pg_inherits inherits on inherits.inhparent = parent.oid
+      left join pg_catalog.pg_class child on child.oid = inherits.inhrelid
+      where parent.relkind = 'p' and parent_namespace.nspname = any(%s)
+      order by parent.relname, child.relname
+'''
+
+@_profiled('get_partitions')
+def get_partitions_by_table(db, schema=None, schemas=None):
+  # {table: PartitionedTable} - only postgres (10+) has declarative partitioning.  with schemas, {schema: {table: ...}}
+  by_schema = collections.defaultdict(dict)
+  if is_postgres(db) and (getattr(db, 'server_version', None) or 100000) >= 100000:
+    for table, key, child, bound, table_schema in _catalog_query(db, 'partitions', _PG_PARTITIONS_SQL, (schemas or [schema or 'public'],)).fetchall():
+      partitioned = by_schema[table_schema].setdefault(unicode(table), PartitionedTable(unicode(table), key, collections.OrderedDict()))
+      if child is not None:
+        partitioned.partitions[unicode(child)] = bound
+  if schemas is not None:
+    return {s: by_schema[s] for s in schemas}
+  return by_schema[schema or 'public']
+
+_PG_TABLES_SQL = '''
+      select table_namespace.nspname, table_class.relname
+      from pg_catalog.pg_class table_class
+      join pg_catalog.pg_namespace table_namespace on table_namespace.oid = table_class.relnamespace
+      where table_class.relkind in ('r', 'p') and table_namespace.nspname = any(%s)
+        and not exists (
+          select 1 from pg_catalog.pg_inherits inherits join pg_catalog.pg_class parent on parent.oid = inherits.inhparent
+          where inherits.inhrelid = table_class.oid and parent.relkind = 'p'
+        )
+      order by table_class.relname
+'''
+
+def get_tables(db, schema=None):
+  # like db.get_tables(), but the partitions of a partitioned table are part of it - not tables of their own
+  if is_postgres(db):
+    return [unicode(table) for _, table in _catalog_query(db, 'tables', _PG_TABLES_SQL, ([schema or 'public'],)).fetchall()]
+  return [unicode(t) for t in _catalog_call('tables', db.get_tables, **({'schema':schema} if schema else {}))]
+
+_PG_TABLE_OPTIONS_SQL = '''
+      select table_namespace.nspname, table_class.relname, table_class.reloptions, toast_class.reloptions, table_class.relpersistence
+      from pg_catalog.pg_class table_class
+      join pg_catalog.pg_namespace table_namespace on table_namespace.oid = table_class.relnamespace
+      left join pg_catalog.pg_class toast_class on toast_class.oid = table_class.reltoastrelid
+      where table_class.relkind in ('r', 'p') and table_namespace.nspname = any(%s)
+'''
+
+_MYSQL_TABLE_OPTIONS_SQL = '''
+      select table_name, engine, row_format, create_options
+      from information_schema.tables
+      where table_schema = coalesce(%s, DATABASE()) and table_type = 'BASE TABLE'
+'''
+_re_key_block_size = re.compile(r'\bKEY_BLOCK_SIZE=(\d+)', re.I)
+_re_page_compression = re.compile(r'''\bCOMPRESSION=["']?(\w+)''', re.I)
+
+@_profiled('get_table_options')
+def get_table_options_by_table(db, schema=None, schemas=None):
+  # {table: {option: value}} - on postgres its storage parameters (fillfactor, autovacuum_*...) and 'unlogged', on
+  # mysql its engine, row_format, key_block_size and page_compression, on sqlite whether it's without_rowid and strict.
+  # with schemas, {schema: {table: ...}}
+  by_schema = collections.defaultdict(dict)
   if is_postgres(db):
-    query = '''
+    for table_schema, table, reloptions, toast_reloptions, persistence in _catalog_query(db, 'table_options', _PG_TABLE_OPTIONS_SQL, (schemas or [schema or 'public'],)).fetchall():
+      # the toast.* parameters are kept on the table's toast table
+      options = dict(option.split('=', 1) for option in reloptions or [])
+      options.update(('toast.' + name, value) for name, value in (option.split('=', 1) for option in toast_reloptions or []))
+      options['unlogged'] = persistence=='u'
+      by_schema[table_schema][unicode(table)] = options
+  elif is_mysql(db):
+    for table, engine, row_format, create_options in _catalog_query(db, 'table_options', _MYSQL_TABLE_OPTIONS_SQL, (schema,)).fetchall():
+      key_block_size = _re_key_block_size.search(create_options or '')
+      compression = _re_page_compression.search(create_options or '')
+      by_schema[schema or 'public'][unicode(table)] = {
+        'engine': engine, 'row_format': row_format,
+        'key_block_size': int(key_block_size.group(1)) if key_block_size else 0,
+        'page_compression': compression.group(1) if compression else 'none',
+      }
+  elif is_sqlite(db):
+    try:
+      rows = _catalog_query(db, 'table_options', "select name, wr, strict from pragma_table_list where schema = 'main' and type = 'table' and name not like 'sqlite_%'").fetchall()
+    except pw.OperationalError:
+      # pragma_table_list is new in sqlite 3.37, so read the options off the end of the CREATE TABLE
+      rows = []
+      for table, sql in _catalog_query(db, 'table_options', "select name, sql from sqlite_schema where type = 'table' and name not like 'sqlite_%'").fetchall():
+        options = _sqlite_table_options_of(sql)
+        rows.append((table, options['without_rowid'], options['strict']))
+    for table, without_rowid, strict in rows:
+      by_schema[schema or 'public'][unicode(table)] = {'without_rowid': bool(without_rowid), 'strict': bool(strict)}
+  if schemas is not None:
+    return {s: by_schema[s] for s in schemas}
+  return by_schema[schema or 'public']
+
+# Everything calc_changes needs to know about the live schema, from the catalog queries above
+Introspection = collections.namedtuple('Introspection', (
+  'tables', 'indexes_by_table', 'columns_by_table', 'foreign_keys_by_table', 'partitions_by_table', 'table_options_by_table',
+))
+
+def introspect(db, schema=None):
+  with _span('get_tables'):
+    existing_tables = get_tables(db, schema=schema)
+  existing_indexes = {table:get_indexes_by_table(db, table, schema=schema) for table in existing_tables}
+  return Introspection(
+    existing_tables, existing_indexes, get_columns_by_table(db, schema=schema), get_foreign_keys_by_table(db, schema=schema),
+    get_partitions_by_table(db, schema=schema), get_table_options_by_table(db, schema=schema),
+  )
+
+def introspect_schemas(db, schemas):
+  # one set of catalog queries for any number of (postgres) schemas, instead of a set per schema and a query per table
+  if not is_postgres(db):
+    raise Exception("introspecting several schemas at once needs PostgreSQL, not %s" % db)
+  schemas = list(schemas)
+  tables = {schema: [] for schema in schemas}
+  indexes = {schema: collections.defaultdict(list) for schema in schemas}
+  columns = {schema: collections.defaultdict(list) for schema in schemas}
+  fks = {schema: collections.defaultdict(list) for schema in schemas}
+  with _span('get_tables'):
+    for schema, table in _catalog_query(db, 'tables', _PG_TABLES_SQL, (schemas,)).fetchall():
+      tables[schema].append(unicode(table))
+  with _span('get_indexes'):
+    for row in _catalog_query(db, 'indexes', _PG_INDEXES_SQL.format(where='true'), (['r', 'p'], schemas)).fetchall():
+      indexes[row[5]][row[4]].append(pw.IndexMetadata(*row[:5]))
+  with _span('get_columns'):
+    for row in _catalog_query(db, 'columns', _COLUMNS_SQL % ('c.table_schema = any(%s)', 'c.ordinal_position'), (schemas,)).fetchall():
+      column = _column_from_row(row)
+      columns[row[9]][column.table].append(column)
+  with _span('get_foreign_keys'):
+    for row in _catalog_query(db, 'foreign_keys', _PG_FOREIGN_KEYS_SQL, (schemas,)).fetchall():
+      fks[row[5]][row[3]].append(ForeignKeyMetadata(row[0], row[1], row[2], row[3], row[4]))
+  partitions = get_partitions_by_table(db, schemas=schemas)
+  table_options = get_table_options_by_table(db, schemas=schemas)
+  return collections.OrderedDict(
+    (schema, Introspection(
+      tables[schema], {table: indexes[schema][table] for table in tables[schema]}, columns[schema], fks[schema], partitions[schema], table_options[schema],
+    ))
+    for schema in schemas
+  )
+
+_PG_INDEXES_SQL = '''
       select index_class.relname,
         idxs.indexdef,
-        array_agg(table_attribute.attname order by array_position(index.indkey, table_attribute.attnum)),
+        array_remove(array_agg(table_attribute.attname order by array_position(index.indkey, table_attribute.attnum)), null),
         index.indisunique,
-        table_class.relname
+        table_class.relname,
+        idxs.schemaname
       from pg_catalog.pg_class index_class
       join pg_catalog.pg_index index on index_class.oid = index.indexrelid
       join pg_catalog.pg_class table_class on table_class.oid = index.indrelid
-      join pg_catalog.pg_attribute table_attribute on table_class.oid = table_attribute.attrelid and table_attribute.attnum = any(index.indkey)
-      join pg_catalog.pg_indexes idxs on idxs.tablename = table_class.relname and idxs.indexname = index_class.relname
-      where table_class.relname = %s and table_class.relkind = %s and idxs.schemaname = %s
-      group by index_class.relname, idxs.indexdef, index.indisunique, table_class.relname;
-    '''
-    cursor = db.execute_sql(query, (table, 'r', schema or 'public'))
-    return [pw.IndexMetadata(*row) for row in cursor.fetchall()]
+      join pg_catalog.pg_namespace table_namespace on table_namespace.oid = table_class.relnamespace
+      left join pg_catalog.pg_attribute table_attribute on table_class.oid = table_attribute.attrelid and table_attribute.attnum = any(index.indkey)
+      join pg_catalog.pg_indexes idxs on idxs.schemaname = table_namespace.nspname and idxs.tablename = table_class.relname and idxs.indexname = index_class.relname
+      where {where} and table_class.relkind = any(%s) and idxs.schemaname = any(%s)
+      group by index_class.relname, idxs.indexdef, index.indisunique, table_class.relname, idxs.schemaname;
+'''
+
+@_profiled('get_indexes')
+def get_indexes_by_table(db, table, schema=None):
+  # peewee's get_indexes returns the columns in an index in arbitrary order
+  if is_postgres(db):
+    cursor = _catalog_query(db, 'indexes', _PG_INDEXES_SQL.format(where='table_class.relname = %s'), (table, ['r', 'p'], [schema or 'public']))
+    return [pw.IndexMetadata(*row[:5]) for row in cursor.fetchall()]
   if is_sqlite(db):
     # pks are indexes too
-    pk_indexes = [pw.IndexMetadata('', '', db.get_primary_keys(table, schema=schema), True, table)]
-    return pk_indexes + db.get_indexes(table, schema=schema)
+    pk_indexes = [pw.IndexMetadata('', '', _catalog_call('primary_keys', db.get_primary_keys, table, schema=schema), True, table)]
+    return pk_indexes + _catalog_call('indexes', db.get_indexes, table, schema=schema)
+  if is_mysql(db):
+    return _get_mysql_indexes(db, table)
   else:
-    return db.get_indexes(table, schema=schema)
+    return _catalog_call('indexes', db.get_indexes, table, schema=schema)
 
-def calc_column_changes(db, migrator, etn, ntn, existing_columns, defined_fields, existing_fks_by_column):
+def _get_mysql_indexes(db, table):
+  # like peewee's, but with descending and functional (mysql 8) key parts written out as sql so index_identity sees them
+  cursor = _catalog_query(db, 'indexes', 'SHOW INDEX FROM %s' % _quote(db, table))
+  names = [d[0].lower() for d in cursor.description]
+  parts, columns, unique = collections.OrderedDict(), collections.defaultdict(list), {}
+  for row in cursor.fetchall():
+    row = dict(zip(names, row))
+    name = row['key_name']
+    part = '(%s)' % row['expression'] if row.get('expression') else _quote(db, row['column_name'])
+    if row.get('collation')=='D': part += ' DESC'
+    parts.setdefault(name, []).append(part)
+    if row['column_name']: columns[name].append(row['column_name'])
+    unique[name] = not int(row['non_unique'])
+  return [
+    pw.IndexMetadata(name, 'CREATE INDEX %s ON %s (%s)' % (_quote(db, name), _quote(db, table), ', '.join(parts[name])), columns[name], unique[name], table)
+    for name in parts
+  ]
+
+@_profiled('calc_column_changes')
+def calc_column_changes(db, migrator, etn, ntn, existing_columns, defined_fields, existing_fks_by_column, diff_defaults=None):
+  if diff_defaults is None: diff_defaults = DIFF_DEFAULTS
   defined_fields_by_column_name = {unicode(_column_name(f)):f for f in defined_fields}
   defined_columns = [ColumnMetadata(
     unicode(_column_name(f)),
     normalize_column_type(_field_type(f)),
     f.null,
-    f.primary_key,
+    _is_primary_key(f),
     unicode(ntn),
     f.default,
     f.max_length if hasattr(f, 'max_length') else None,
@@ -598,25 +1209,32 @@ def calc_column_changes(db, migrator, etn, ntn, existing_columns, defined_fields
     existing_col = existing_cols_by_name[renames_new_to_old.get(col_name, col_name)]
     defined_col = defined_cols_by_name[col_name]
     field = defined_fields_by_column_name[defined_col.name]
-    if column_def_changed(db, existing_col, defined_col):
+    if column_def_changed(db, existing_col, defined_col, diff_defaults=diff_defaults):
       len_alter_statements = len(alter_statements)
 
       different_type = existing_col.data_type != defined_col.data_type
-      different_length = defined_col.max_length is not None and existing_col.max_length != defined_col.max_length
-      different_precision = defined_col.precision is not None and existing_col.precision != defined_col.precision
-      different_scale = defined_col.scale is not None and existing_col.scale != defined_col.scale
+      # sqlite doesn't enforce lengths, precisions or scales (see column_def_changed)
+      sized = not is_sqlite(db)
+      different_length = sized and defined_col.max_length is not None and existing_col.max_length != defined_col.max_length
+      different_precision = sized and defined_col.precision is not None and existing_col.precision != defined_col.precision
+      different_scale = sized and defined_col.scale is not None and existing_col.scale != defined_col.scale
 
       should_cast = different_type and can_convert(existing_col.data_type, defined_col.data_type)
       should_recast = not different_type and (different_length or different_precision or different_scale)
+      # on sqlite every one of these rebuilds the table, and the type change's rebuild takes care of NULL too
+      rebuilt = is_sqlite(db) and (should_cast or should_recast)
 
       if existing_col.null and not defined_col.null:
-        alter_statements += add_not_null(db, migrator, ntn, defined_col.name, field)
-      if not existing_col.null and defined_col.null:
+        if rebuilt:
+          alter_statements += set_default(db, migrator, ntn, defined_col.name, field) if field.default is not None else []
+        else:
+          alter_statements += add_not_null(db, migrator, ntn, defined_col.name, field)
+      if not existing_col.null and defined_col.null and not rebuilt:
         alter_statements += drop_not_null(migrator, ntn, defined_col)
       if should_cast or should_recast:
         stmts = change_column_type(db, migrator, ntn, defined_col.name, field)
         alter_statements += stmts
-      if DIFF_DEFAULTS:
+      if diff_defaults:
         if normalize_default(existing_col.default) is not None and normalize_default(defined_col.default) is None:
           alter_statements += drop_default(db, migrator, ntn, defined_col.name, field)
         elif normalize_default(existing_col.default) != normalize_default(defined_col.default):
@@ -637,37 +1255,73 @@ def calc_column_changes(db, migrator, etn, ntn, existing_columns, defined_fields
     existing_fk = existing_fks_by_column.get(existing_column_name)
     foreign_key = _is_foreign_key(defined_field)
     if foreign_key and not existing_fk and not (hasattr(defined_field, 'fake') and defined_field.fake):
-      alter_statements += create_foreign_key(defined_field)
+      alter_statements += create_foreign_key(defined_field, db=db)
     if not foreign_key and existing_fk:
       alter_statements += drop_foreign_key(db, migrator, ntn, existing_fk.name)
   return new_cols, delete_cols, rename_cols, alter_statements
 
 
-def calc_changes(db, ignore_tables=None, schema=None):
+def _is_primary_key(field):
+  # composite keys do not come from peewee w/ the primary key bit set
+  pk = field.model_class._meta.primary_key if hasattr(field, 'model_class') else field.model._meta.primary_key
+  return bool(field.primary_key) or (isinstance(pk, pw.CompositeKey) and field.name in pk.field_names)
+
+@_profiled('calc_changes')
+def calc_changes(db, ignore_tables=None, schema=None, models=None, diff_defaults=None, introspection=None, index_foreign_keys=None, skip_redundant_indexes=None):
+  if introspection is None:
+    introspection = introspect(db, schema=schema)
+  with _memoized_fingerprints():
+    return _calc_changes(
+      db, introspection, ignore_tables=ignore_tables, schema=schema, models=models, diff_defaults=diff_defaults,
+      index_foreign_keys=index_foreign_keys, skip_redundant_indexes=skip_redundant_indexes,
+    )
+
+@_profiled('calc_changes_by_schema')
+def calc_changes_by_schema(db, schemas, ignore_tables=None, models=None, diff_defaults=None, index_foreign_keys=None, skip_redundant_indexes=None):
+  # {schema: to_run} for each of schemas, from one introspection pass over all of them
+  introspected = introspect_schemas(db, schemas)
+  with _memoized_fingerprints():
+    return collections.OrderedDict(
+      (schema, _calc_changes(
+        db, introspection, ignore_tables=ignore_tables, schema=schema, models=models, diff_defaults=diff_defaults,
+        index_foreign_keys=index_foreign_keys, skip_redundant_indexes=skip_redundant_indexes,
+      ))
+      for schema, introspection in introspected.items()
+    )
+
+def _calc_changes(db, introspection, ignore_tables=None, schema=None, models=None, diff_defaults=None, index_foreign_keys=None, skip_redundant_indexes=None):
   migrator = None # expose eventually?
   if migrator is None:
     migrator = auto_detect_migrator(db)
 
-  existing_tables = [unicode(t) for t in (db.get_tables(schema=schema) if schema else db.get_tables())]
-  existing_indexes = {table:get_indexes_by_table(db, table, schema=schema) for table in existing_tables}
-  existing_columns_by_table = get_columns_by_table(db, schema=schema)
-  foreign_keys_by_table = get_foreign_keys_by_table(db, schema=schema)
+  existing_tables, existing_indexes, existing_columns_by_table, foreign_keys_by_table, partitions_by_table, table_options_by_table = introspection
 
-  table_names_to_models = {_table_name(cls): cls for cls in all_models.keys()}
+  if models is None:
+    models = models_for(db, schema=schema)
+    ignore_tables = set(ignore_tables or []) | globals()['ignore_tables']
+  table_names_to_models = {_table_name(cls): cls for cls in models}
 
   to_run = []
 
-  table_adds, add_fks, table_deletes, table_renames = calc_table_changes(existing_tables, ignore_tables=ignore_tables)
+  table_adds, add_fks, table_deletes, table_renames = calc_table_changes(existing_tables, ignore_tables=ignore_tables, models=models)
   table_renamed_from = {v: k for k, v in table_renames.items()}
   for tbl in table_adds:
-    to_run += create_table(table_names_to_models[tbl])
+    to_run += create_table(table_names_to_models[tbl], db=db)
+    to_run += calc_column_option_changes(db, table_names_to_models[tbl], None)
+    to_run += calc_partition_changes(db, table_names_to_models[tbl], PartitionedTable(tbl, None, {}))
   for field in add_fks:
-    if hasattr(field, '__pwdbev__not_deferred') and field.__pwdbev__not_deferred:
-      field.deferred = False
-    to_run += create_foreign_key(field)
+    to_run += create_foreign_key(field, db=db)
   for k, v in table_renames.items():
     to_run += rename_table(migrator, k, v)
-
+  for ntn, model in table_names_to_models.items():
+    if ntn not in table_adds:
+      etn = table_renamed_from.get(ntn, ntn)
+      to_run += calc_table_option_changes(db, model, table_options_by_table.get(etn, {}))
+      to_run += calc_partition_changes(db, model, partitions_by_table.get(etn))
+  # only read for the tables whose models ask for them - there's a row per column
+  column_options_by_table = get_column_options_by_table(db, [
+    table_renamed_from.get(ntn, ntn) for ntn, model in table_names_to_models.items() if ntn not in table_adds and _declares_column_options(db, model)
+  ], schema=schema)
 
   rename_cols_by_table = {}
   deleted_cols_by_table = {}
@@ -676,47 +1330,18 @@ def calc_changes(db, ignore_tables=None, schema=None):
     ntn = table_renames.get(etn, etn)
     model = table_names_to_models.get(ntn)
     if not model: continue
-    defined_fields = model._meta.sorted_fields
-    
-    # composite keys do not come from peewee w/ the primary key bit set
-    if isinstance(model._meta.primary_key, pw.CompositeKey):
-      for field_name in model._meta.primary_key.field_names:
-        for field in defined_fields:
-          if field_name==field.name and not field.primary_key:
-            field.primary_key = True
-    
-    defined_column_name_to_field = {unicode(_column_name(f)):f for f in defined_fields}
-    existing_fks_by_column = {fk.column:fk for fk in foreign_keys_by_table[etn]}
-    adds, deletes, renames, alter_statements = calc_column_changes(db, migrator, etn, ntn, ecols, defined_fields, existing_fks_by_column)
-    for column_name in adds:
-      field = defined_column_name_to_field[column_name]
-      to_run += alter_add_column(db, migrator, ntn, column_name, field)
-      if not field.null:
-        # alter_add_column strips null constraints
-        # add them back after setting any defaults
-        if field.default is not None:
-          to_run += set_default(db, migrator, ntn, column_name, field)
-        else:
-          to_run.append(('-- adding a not null column without a default will fail if the table is not empty',[]))
-        to_run += add_not_null(db, migrator, ntn, column_name, field)
-
-    for column_name in deletes:
-      fk = existing_fks_by_column.get(column_name)
-      if fk:
-        to_run += drop_foreign_key(db, migrator, ntn, fk.name)
-      to_run += drop_column(db, migrator, ntn, column_name)
-    for ocn, ncn in renames.items():
-      field = defined_column_name_to_field[ncn]
-      to_run += rename_column(db, migrator, ntn, ocn, ncn, field)
-    to_run += alter_statements
+    stmts, deletes, renames = _table_column_changes(db, migrator, etn, ntn, model, ecols, foreign_keys_by_table[etn], diff_defaults)
+    to_run += _keep_sqlite_table_options(db, model, table_options_by_table.get(etn, {}), stmts)
+    to_run += calc_column_option_changes(db, model, column_options_by_table.get(etn, {}), renames)
     rename_cols_by_table[ntn] = renames
     deleted_cols_by_table[ntn] = deletes
 
   for ntn, model in table_names_to_models.items():
     etn = table_renamed_from.get(ntn, ntn)
-    deletes = deleted_cols_by_table.get(ntn,set())
-    existing_indexes_for_table = [i for i in existing_indexes.get(etn, []) if not any([(c in deletes) for c in i.columns])]
-    to_run += calc_index_changes(db, migrator, existing_indexes_for_table, model, rename_cols_by_table.get(ntn, {}))
+    to_run += _table_index_changes(
+      db, migrator, model, existing_indexes.get(etn, []), deleted_cols_by_table.get(ntn,set()), rename_cols_by_table.get(ntn, {}),
+      index_foreign_keys=index_foreign_keys, skip_redundant_indexes=skip_redundant_indexes,
+    )
 
   '''
   to_run += calc_perms_changes($schema_tables, noop) unless $check_perms_for.empty?
@@ -725,79 +1350,1251 @@ def calc_changes(db, ignore_tables=None, schema=None):
     to_run += drop_table(migrator, tbl)
   return to_run
 
+UnindexedForeignKey = collections.namedtuple('UnindexedForeignKey', ('table', 'column', 'references', 'field'))
+
+def unindexed_foreign_keys(db, models=None, schema=None, introspection=None):
+  # the models' foreign keys whose column no index (existing or declared) leads with.  on postgres every DELETE from
+  # the referenced table, or update of its key, then has to scan the whole referencing table.  mysql always indexes them.
+  if introspection is None:
+    introspection = introspect(db, schema=schema)
+  if models is None:
+    models = models_for(db, schema=schema)
+  unindexed = []
+  for model in models:
+    table = _table_name(model)
+    identities = [index_identity(db, index) for index in introspection.indexes_by_table.get(table, [])]
+    identities += [index_identity(db, index_metadata(db, model, index)) for index in indexes_on_model(model)]
+    leading = _leading_index_columns(model, identities)
+    for field in model._meta.sorted_fields:
+      if _is_foreign_key(field) and unicode(_column_name(field)).lower() not in leading:
+        unindexed.append(UnindexedForeignKey(table, _column_name(field), _table_name(field.rel_model), field))
+  return unindexed
+
+def _leading_column(identity):
+  # the first column of an index that can find the rows for a key - not partial, and not gin, brin... - or None
+  if identity.columns and identity.where is None and identity.method in ('btree', 'hash'):
+    return identity.columns[0].split(' ')[0]
+  return None
+
+def _leading_index_columns(model, identities):
+  leading = set(_leading_column(identity) for identity in identities) - set([None])
+  pk = [f for f in model._meta.sorted_fields if _is_primary_key(f)]
+  if pk: leading.add(unicode(_column_name(pk[0])).lower())
+  return leading
+
+RedundantIndex = collections.namedtuple('RedundantIndex', ('table', 'name', 'covered_by', 'reason', 'size', 'exists'))
+
+def redundant_indexes(db, models=None, schema=None, introspection=None):
+  # the models' indexes (existing or declared) that another index on the table already does the job of: a 'duplicate'
+  # (the same key, or a unique index on it) or a 'prefix' of a longer btree index.  every write to the table pays for
+  # them anyway.  size is in bytes, None if it's unknown or the index doesn't exist yet.
+  if introspection is None:
+    introspection = introspect(db, schema=schema)
+  if models is None:
+    models = models_for(db, schema=schema)
+  sizes = get_index_sizes(db, schema=schema)
+  redundant = []
+  for model in models:
+    table = _table_name(model)
+    pk = _primary_key_identity(db, model)
+    entries = [(index_identity(db, index), index.name or 'PRIMARY KEY', True) for index in introspection.indexes_by_table.get(table, [])]
+    existing = set(identity for identity, _, _ in entries)
+    names = set(name for _, name, _ in entries)
+    for index in indexes_on_model(model):
+      metadata = index_metadata(db, model, index)
+      identity = index_identity(db, metadata)
+      # a declared copy of the primary key matches it, but is another index all the same
+      if identity not in existing or (identity==pk and metadata.name not in names):
+        entries.append((identity, metadata.name, False))
+        existing.add(identity)
+    if pk and pk not in existing:
+      entries.append((pk, 'PRIMARY KEY', table in introspection.tables))
+    # the primary key, longer and unique indexes first, so they're the ones kept
+    pk_names = ('PRIMARY KEY', 'PRIMARY', '%s_pkey' % table)
+    entries.sort(key=lambda entry: (not (entry[0]==pk and entry[1] in pk_names), -len(entry[0].columns), not entry[0].unique, not entry[2], entry[1]))
+    reported = set()
+    for i, (identity, name, exists) in enumerate(entries):
+      for j, (other, other_name, _) in enumerate(entries):
+        if i==j or j in reported: continue
+        reason = _index_redundancy(identity, other)
+        if reason=='duplicate' and j>i and other.unique==identity.unique: continue
+        if reason:
+          reported.add(i)
+          redundant.append(RedundantIndex(table, name, other_name, reason, sizes.get((table, name)) if exists else None, exists))
+          break
+  return redundant
+
+def _index_redundancy(identity, other):
+  # 'duplicate' or 'prefix' if other can do everything identity does, otherwise None
+  if identity.table!=other.table or identity.where!=other.where or identity.method!=other.method or not identity.columns: return None
+  if identity.unique and not (other.unique and other.columns==identity.columns): return None
+  if not set(identity.include) <= set([c.split(' ')[0] for c in other.columns]) | set(other.include): return None
+  if identity.columns==other.columns: return 'duplicate'
+  if identity.method=='btree' and other.columns[:len(identity.columns)]==identity.columns: return 'prefix'
+  return None
+
+def _primary_key_identity(db, model):
+  pk = model._meta.primary_key
+  fields = [model._meta.fields[name] for name in pk.field_names] if isinstance(pk, pw.CompositeKey) else [pk] if pk else []
+  if not fields: return None
+  return IndexIdentity(unicode(_table_name(model)), tuple(unicode(_column_name(f)).lower() for f in fields), True, 'btree', None, ())
+
+def get_index_sizes(db, schema=None):
+  # {(table, index name): bytes}, as far as the database will say
+  if is_postgres(db):
+    cursor = _catalog_query(db, 'index_sizes', '''
+      select table_class.relname, index_class.relname, pg_relation_size(index_class.oid)
+      from pg_catalog.pg_index index
+      join pg_catalog.pg_class index_class on index_class.oid = index.indexrelid
+      join pg_catalog.pg_class table_class on table_class.oid = index.indrelid
+      join pg_catalog.pg_namespace table_namespace on table_namespace.oid = table_class.relnamespace
+      where table_namespace.nspname = %s
+    ''', (schema or 'public',))
+  elif is_mysql(db):
+    try:
+      # needs select on the mysql schema
+      cursor = _catalog_query(db, 'index_sizes', '''
+        select table_name, index_name, stat_value * @@innodb_page_size from mysql.innodb_index_stats
+        where database_name = coalesce(%s, DATABASE()) and stat_name = 'size'
+      ''', (schema,))
+    except Exception:
+      return {}
+  elif is_sqlite(db):
+    try:
+      # needs sqlite built with the dbstat virtual table
+      cursor = _catalog_query(db, 'index_sizes', '''
+        select m.tbl_name, m.name, sum(s.pgsize) from sqlite_master m join dbstat s on s.name = m.name
+        where m.type = 'index' group by m.tbl_name, m.name
+      ''')
+    except Exception:
+      return {}
+  else:
+    return {}
+  return {(unicode(table), unicode(name)): int(size) for table, name, size in cursor.fetchall()}
+
+IndexUsage = collections.namedtuple('IndexUsage', ('table', 'name', 'scans', 'last_used', 'size', 'since'))
+
+def index_usage(db, schema=None):
+  # {(table, index name): IndexUsage} - how often each index has been scanned (since the statistics were reset, or the
+  # server started), when it was last used (postgres 16+) and its size.  empty where the database doesn't keep count.
+  if is_postgres(db):
+    cursor = _catalog_query(db, 'index_usage', '''
+      select s.relname, s.indexrelname, s.idx_scan, (to_jsonb(s) ->> 'last_idx_scan')::timestamptz,
+        pg_relation_size(s.indexrelid), d.stats_reset
+      from pg_catalog.pg_stat_user_indexes s
+      join pg_catalog.pg_stat_database d on d.datname = current_database()
+      where s.schemaname = %s
+    ''', (schema or 'public',))
+    rows = cursor.fetchall()
+  elif is_mysql(db):
+    try:
+      # what sys.schema_unused_indexes is built on, with the counts left in
+      cursor = _catalog_query(db, 'index_usage', '''
+        select object_name, index_name, count_star from performance_schema.table_io_waits_summary_by_index_usage
+        where object_schema = coalesce(%s, DATABASE()) and index_name is not null
+      ''', (schema,))
+      counts = cursor.fetchall()
+      since = _catalog_query(db, 'index_usage', '''
+        select now() - interval variable_value second from performance_schema.global_status where variable_name = 'Uptime'
+      ''').fetchone()
+    except Exception:
+      return {}
+    sizes = get_index_sizes(db, schema=schema)
+    rows = [(table, name, scans, None, sizes.get((unicode(table), unicode(name))), since[0] if since else None) for table, name, scans in counts]
+  else:
+    return {}
+  return {
+    (unicode(table), unicode(name)): IndexUsage(unicode(table), unicode(name), int(scans or 0), last_used, None if size is None else int(size), since)
+    for table, name, scans, last_used, size, since in rows
+  }
+
+_re_drop_index = re.compile(r'''^\s*DROP\s+INDEX\s+(?:CONCURRENTLY\s+)?(?:IF\s+EXISTS\s+)?("(?:[^"]|"")+"|`[^`]+`|[^\s;]+)(?:\s+ON\s+("(?:[^"]|"")+"|`[^`]+`|[^\s;]+))?''', re.I)
+_re_created_index = re.compile(r'''^\s*CREATE\s+(?:UNIQUE\s+)?INDEX\s+(?:CONCURRENTLY\s+)?(?:IF\s+NOT\s+EXISTS\s+)?("(?:[^"]|"")+"|`[^`]+`|[^\s(]+)''', re.I)
+
+def annotate_index_usage(db, to_run, schema=None):
+  # to_run with a comment before each DROP INDEX saying how much the index is used, and how big it is - so you don't
+  # drop one a hot query needs, and can see what dropping the unused ones gets back
+  drops = [_re_drop_index.match(stmt[0]) for stmt in to_run]
+  if not any(drops): return to_run
+  usage = index_usage(db, schema=schema)
+  usage_by_name = {name: stats for (_, name), stats in usage.items()}
+  created = set(_unquote(m.group(1)) for m in [_re_created_index.match(stmt[0]) for stmt in to_run] if m)
+  annotated = []
+  for stmt, drop in zip(to_run, drops):
+    if drop:
+      name = _unquote(drop.group(1))
+      stats = usage.get((_unquote(drop.group(2)), name)) if drop.group(2) else usage_by_name.get(name)
+      if stats:
+        annotated.append((_index_usage_comment(stats, replaced=(name in created)), []))
+    annotated.append(stmt)
+  return annotated
+
+def _unquote(name):
+  if name[:1] in '"`' and name[-1:]==name[:1]:
+    return name[1:-1].replace(name[0]*2, name[0])
+  return name
+
+def _index_usage_comment(stats, replaced=False):
+  used = '%i scan%s' % (stats.scans, '' if stats.scans==1 else 's') if stats.scans else 'never used'
+  if stats.since: used += ' since %s' % _format_time(stats.since)
+  details = [used]
+  if stats.last_used: details.append('last used %s' % _format_time(stats.last_used))
+  if stats.size is not None: details.append(_format_size(stats.size))
+  return '-- %s index %s on %s: %s' % ('replacing' if replaced else 'dropping', stats.name, stats.table, ', '.join(details))
+
+def _format_time(t):
+  return t.strftime('%Y-%m-%d %H:%M') if hasattr(t, 'strftime') else unicode(t)
+
+def _format_size(size):
+  return '%.1f MB' % (size / MB) if size >= MB else '%i kB' % (size // 1024)
+
+def annotate_rewrite_cost(db, to_run, schema=None, estimator=None):
+  # to_run with a comment before each statement that rewrites a whole table (type changes, ROW_FORMAT, SET LOGGED...)
+  # saying how big the table is and about how long the rewrite will take, from CostEstimator
+  if not any(classify_statement(stmt[0])=='rewrite' for stmt in to_run): return to_run
+  if estimator is None:
+    estimator = CostEstimator(db, schema=schema)
+  annotated = []
+  for stmt in to_run:
+    if classify_statement(stmt[0])=='rewrite':
+      table = statement_table(stmt[0])
+      if table in estimator.sizes:
+        annotated.append(('-- rewrites %s (%s): ~%.1fs' % (table, _format_size(estimator.sizes[table]), estimator(stmt[0])), []))
+    annotated.append(stmt)
+  return annotated
+
+_re_create_index = re.compile(r'^(\s*CREATE\s+(?:UNIQUE\s+)?INDEX)\s+(?:IF\s+NOT\s+EXISTS\s+)?', re.I)
+_re_concurrently = re.compile(r'^\s*(?:CREATE\s+(?:UNIQUE\s+)?|DROP\s+)INDEX\s+CONCURRENTLY\b', re.I)
+
+def create_index_concurrently(model, index, db=None):
+  # without blocking writes to the table, on postgres.  _execute runs these after the rest of the plan has committed,
+  # since postgres won't build an index concurrently inside a transaction.
+  to_run = create_index(model, index, db=db)
+  # nor concurrently on a partitioned table
+  if not is_postgres(db or model._meta.database) or _partition_by(model, db): return to_run
+  return [(_re_create_index.sub(r'\1 CONCURRENTLY ', sql, count=1), params) for sql, params in to_run]
+
+def _runs_outside_transaction(sql):
+  return bool(_re_concurrently.match(sql))
+
+def _table_column_changes(db, migrator, etn, ntn, model, ecols, existing_fks, diff_defaults=None):
+  # the statements that bring table etn's columns in line with model (as table ntn), and the columns deleted and renamed
+  to_run = []
+  defined_fields = model._meta.sorted_fields
+  defined_column_name_to_field = {unicode(_column_name(f)):f for f in defined_fields}
+  existing_fks_by_column = {fk.column:fk for fk in existing_fks}
+  adds, deletes, renames, alter_statements = calc_column_changes(db, migrator, etn, ntn, ecols, defined_fields, existing_fks_by_column, diff_defaults=diff_defaults)
+  for column_name in adds:
+    field = defined_column_name_to_field[column_name]
+    to_run += alter_add_column(db, migrator, ntn, column_name, field)
+    if not field.null:
+      # alter_add_column strips null constraints
+      # add them back after setting any defaults
+      if field.default is not None:
+        to_run += set_default(db, migrator, ntn, column_name, field)
+      else:
+        to_run.append(('-- adding a not null column without a default will fail if the table is not empty',[]))
+      to_run += add_not_null(db, migrator, ntn, column_name, field)
+
+  for column_name in deletes:
+    fk = existing_fks_by_column.get(column_name)
+    if fk:
+      to_run += drop_foreign_key(db, migrator, ntn, fk.name)
+    to_run += drop_column(db, migrator, ntn, column_name)
+  for ocn, ncn in renames.items():
+    field = defined_column_name_to_field[ncn]
+    to_run += rename_column(db, migrator, ntn, ocn, ncn, field)
+  to_run += alter_statements
+  return to_run, deletes, renames
+
+def _table_index_changes(db, migrator, model, existing_indexes, deleted_cols, renamed_cols, index_foreign_keys=None, skip_redundant_indexes=None):
+  existing_indexes = [i for i in existing_indexes if not any([(c in deleted_cols) for c in i.columns])]
+  return calc_index_changes(
+    db, migrator, existing_indexes, model, renamed_cols, index_foreign_keys=index_foreign_keys, skip_redundant_indexes=skip_redundant_indexes,
+  )
+
 def indexes_are_same(i1, i2):
   return unicode(i1.table)==unicode(i2.table) and i1.columns==i2.columns and i1.unique==i2.unique
 
 def normalize_indexes(indexes):
   return [(unicode(idx.table), tuple(unicode(c) for c in idx.columns), idx.unique) for idx in indexes]
 
+# What makes two indexes the same.  columns holds each key part - a column, or an expression - with any ordering or
+# opclass, normalized so a definition compares equal to what the database echoes back (pg_get_indexdef adds casts and
+# parentheses, and drops quotes).  method is the access method (btree, hash, gin, gist, brin...) and where the
+# predicate of a partial index; both are only compared on postgres.  include is the sorted non-key columns of a
+# covering index - their order doesn't matter.
+IndexIdentity = collections.namedtuple('IndexIdentity', ('table', 'columns', 'unique', 'method', 'where', 'include'))
+
+def index_identity(db, index):
+  parsed = _parse_index_sql(index.sql) if index.sql else None
+  if parsed is None:
+    columns, method, where, include = tuple(unicode(c).lower() for c in index.columns), None, None, ()
+  else:
+    columns, method, where, include = parsed
+  if not is_postgres(db): method = None
+  return IndexIdentity(unicode(index.table), columns, bool(index.unique), method or 'btree', where, include)
+
+_re_index_header = re.compile(r'''^\s*create\s+(?:unique\s+)?index\s.*?\son\s+(?:only\s+)?(?:"(?:[^"]|"")*"|`[^`]*`|[^\s(."`]+)(?:\.(?:"(?:[^"]|"")*"|`[^`]*`|[^\s(."`]+))?\s*(?:using\s+\w+\s*)?\(''', re.I | re.S)
+_re_index_using = re.compile(r'\busing\s+(\w+)', re.I)
+_re_index_include = re.compile(r'\s*include\s*\(', re.I)
+_re_index_where = re.compile(r'\bwhere\b(.*)$', re.I | re.S)
+_re_index_ordering = re.compile(r'\s+(asc|desc)?\s*(?:nulls\s+(first|last))?\s*$', re.I)
+_re_plain_index_columns = re.compile(r'\s*((?:"[^"]*"|`[^`]*`|\w+)(?:\s*,\s*(?:"[^"]*"|`[^`]*`|\w+))*)\s*\)')
+_re_index_column = re.compile(r'"[^"]*"|`[^`]*`|\w+')
+_re_quoted_identifier = re.compile(r'"((?:[^"]|"")*)"|`([^`]*)`')
+_re_sql_cast = re.compile(r'::[a-z_][\w$]*(?:\([\d,]*\))?(?:\[\])*')
+
+def _parse_index_sql(sql):
+  # CREATE [UNIQUE] INDEX ... ON table [USING method] (parts) [INCLUDE (columns)] [WHERE predicate]
+  #   -> (parts, method, where, include)
+  header = _re_index_header.match(sql)
+  if not header: return None
+  start = header.end() - 1
+  plain = _re_plain_index_columns.match(sql, start + 1)
+  if plain:
+    # just columns - the usual case, and much quicker to pick apart
+    end = plain.end() - 1
+    columns = tuple(_normalize_sql_text(part) for part in _re_index_column.findall(plain.group(1)))
+  else:
+    end = _closing_paren(sql, start)
+    if end is None: return None
+    columns = tuple(_normalize_index_part(part) for part in _split_sql_list(sql[start+1:end]))
+  using = _re_index_using.search(sql[:start]) or _re_index_using.match(sql[end+1:].strip())
+  include = ()
+  include_start = _re_index_include.match(sql, end + 1)
+  if include_start:
+    include_end = _closing_paren(sql, include_start.end() - 1)
+    if include_end is None: return None
+    include = tuple(sorted(_normalize_sql_text(part) for part in _split_sql_list(sql[include_start.end():include_end])))
+    end = include_end
+  where = _re_index_where.search(sql[end+1:])
+  return columns, using.group(1).lower() if using else None, _normalize_sql_text(where.group(1)) if where else None, include
+
+def _closing_paren(sql, start):
+  depth, quote = 0, None
+  for i in range(start, len(sql)):
+    c = sql[i]
+    if quote:
+      if c==quote: quote = None
+    elif c in '\'"`': quote = c
+    elif c=='(': depth += 1
+    elif c==')':
+      depth -= 1
+      if depth==0: return i
+  return None
+
+def _split_sql_list(sql):
+  parts, depth, quote, start = [], 0, None, 0
+  for i, c in enumerate(sql):
+    if quote:
+      if c==quote: quote = None
+    elif c in '\'"`': quote = c
+    elif c=='(': depth += 1
+    elif c==')': depth -= 1
+    elif c==',' and depth==0:
+      parts.append(sql[start:i])
+      start = i + 1
+  parts.append(sql[start:])
+  return [part.strip() for part in parts if part.strip()]
+
+def _normalize_index_part(part):
+  # ASC, and NULLS LAST (FIRST for DESC), are the defaults so they're left off
+  ordering = _re_index_ordering.search(part)
+  direction, nulls = 'asc', None
+  if ordering:
+    part, direction, nulls = part[:ordering.start()], (ordering.group(1) or 'asc').lower(), (ordering.group(2) or '').lower() or None
+  suffix = ' desc' if direction=='desc' else ''
+  if nulls and nulls!=('first' if direction=='desc' else 'last'): suffix += ' nulls %s' % nulls
+  return _normalize_sql_text(part) + suffix
+
+# operators postgres deparses differently from how they're usually written
+_SQL_OPERATOR_SPELLINGS = [
+  (re.compile(r'\bnot\s+ilike\b'), ' !~~* '), (re.compile(r'\bilike\b'), ' ~~* '),
+  (re.compile(r'\bnot\s+like\b'), ' !~~ '), (re.compile(r'\blike\b'), ' ~~ '), (re.compile(r'!='), '<>'),
+]
+_re_any_array = re.compile(r'=any\(?array\[([^\]]*)\]\)?')
+
+def _normalize_sql_text(sql):
+  # loose on purpose: no quotes, case, whitespace, casts or parentheses
+  sql = _re_quoted_identifier.sub(lambda m: m.group(1) if m.group(1) is not None else m.group(2), sql.strip().rstrip(';'))
+  sql = sql.lower()
+  for operator, spelling in _SQL_OPERATOR_SPELLINGS:
+    sql = operator.sub(spelling, sql)
+  sql = re.sub(r'\s+', '', sql)
+  sql = _re_sql_cast.sub('', sql)
+  sql = _re_any_array.sub(r'in(\1)', sql)
+  return sql.replace('(', '').replace(')', '')
+
+def _sql_literal(value):
+  if value is None: return 'NULL'
+  if isinstance(value, bool): return 'TRUE' if value else 'FALSE'
+  if isinstance(value, (int, float, decimal.Decimal)): return unicode(value)
+  return "'%s'" % unicode(value).replace("'", "''")
+
+def _inline_params(db, sql, params):
+  # the index's sql with its parameters filled in, to compare against the database's copy
+  if not params: return sql
+  pieces = sql.split(getattr(db, 'param', None) or getattr(db, 'interpolation', '%s'))
+  if len(pieces)!=len(params)+1: return sql
+  return pieces[0] + ''.join(_sql_literal(param) + piece for param, piece in zip(params, pieces[1:]))
+
+
+@_profiled('calc_index_changes')
+def calc_index_changes(db, migrator, existing_indexes, model, renamed_cols, index_foreign_keys=None, skip_redundant_indexes=None):
+  to_run = []
+  pk_cols = set([unicode(_column_name(f)).lower() for f in model._meta.sorted_fields if _is_primary_key(f)])
+  existing_indexes_by_identity = {}
+  for index in existing_indexes:
+    identity = index_identity(db, index)
+    if identity.where is None and identity.columns and all([(c in pk_cols) for c in identity.columns]): continue
+    existing_indexes_by_identity[identity] = index
+  try:
+    indexes = indexes_on_model(model)
+  except KeyError as e:
+    raise Exception("An index on %s references field %s, but that field doesn't exist. (Be sure to use the field name, not the db_column name, when specifying a multi-column index.)" % (model.__name__, repr(e.args[0])))
+  defined_indexes_by_identity = {}
+  for index in indexes:
+    defined_indexes_by_identity.setdefault(index_identity(db, index_metadata(db, model, index)), index)
+  # with index_foreign_keys, an index for each foreign key none of the model's indexes leads with counts as declared
+  foreign_key_indexes = {}
+  if INDEX_FOREIGN_KEYS if index_foreign_keys is None else index_foreign_keys:
+    leading = _leading_index_columns(model, defined_indexes_by_identity)
+    existing_leading = {}
+    for identity in existing_indexes_by_identity:
+      existing_leading.setdefault(_leading_column(identity), identity)
+    for field in model._meta.sorted_fields:
+      column = unicode(_column_name(field)).lower()
+      if not _is_foreign_key(field) or column in leading: continue
+      if column in existing_leading:
+        # an index only the database has already leads with it - keep that, rather than drop it and build another
+        identity = existing_leading[column]
+        defined_indexes_by_identity.setdefault(identity, existing_indexes_by_identity[identity])
+      else:
+        index = plain_index(model, [field])
+        foreign_key_indexes[defined_indexes_by_identity.setdefault(index_identity(db, index_metadata(db, model, index)), index)] = index
+  to_add = set(defined_indexes_by_identity) - set(existing_indexes_by_identity)
+  to_del = set(existing_indexes_by_identity) - set(defined_indexes_by_identity)
+  if SKIP_REDUNDANT_INDEXES if skip_redundant_indexes is None else skip_redundant_indexes:
+    # the primary key, or another declared index, already does what these would
+    pk = _primary_key_identity(db, model)
+    kept = set(defined_indexes_by_identity) | set([pk] if pk else [])
+    to_add = set(i for i in to_add if i!=pk and not any([_index_redundancy(i, other) for other in kept if other!=i]))
+  for identity in to_del:
+    to_run += drop_index(migrator, model, existing_indexes_by_identity[identity])
+  for identity in to_add:
+    index = defined_indexes_by_identity[identity]
+    to_run += (create_index_concurrently if identity in foreign_key_indexes else create_index)(model, index, db=db)
+  return to_run
 
-def calc_index_changes(db, migrator, existing_indexes, model, renamed_cols):
+
+# Declares a postgres partitioned table, as Meta.partition_by:
+#
+#   Partitioning('range', 'created_at', interval='month', ahead=3, detach_after=12)
+#   Partitioning('hash', 'account_id', partitions=8)
+#   Partitioning('list', 'region')
+#
+# key is a field (or column) name, or a list of them.  evolve keeps range partitions for the current interval (day,
+# week, month or year) and the next `ahead` of them, and detaches those more than `detach_after` intervals old.  hash
+# tables get `partitions` partitions.  list partitions are left to you.  default adds a partition for everything else.
+class Partitioning(object):
+
+  STRATEGIES = ('range', 'list', 'hash')
+  INTERVALS = ('day', 'week', 'month', 'year')
+
+  def __init__(self, strategy, key, interval=None, ahead=3, detach_after=None, partitions=None, default=False):
+    strategy = strategy.lower()
+    if strategy not in self.STRATEGIES:
+      raise Exception("partitioning strategy must be one of %s, not %s" % (', '.join(self.STRATEGIES), repr(strategy)))
+    if interval is not None and (strategy!='range' or interval not in self.INTERVALS):
+      raise Exception("only range partitioning takes an interval, one of %s" % ', '.join(self.INTERVALS))
+    if partitions is not None and strategy!='hash':
+      raise Exception("only hash partitioning takes a number of partitions")
+    self.strategy = strategy
+    self.key = [key] if hasattr(key, 'lower') else list(key)
+    self.interval = interval
+    self.ahead = ahead
+    self.detach_after = detach_after
+    self.partitions = partitions
+    self.default = default
+
+  def __repr__(self):
+    return 'Partitioning(%r, %r, interval=%r, ahead=%r, detach_after=%r, partitions=%r, default=%r)' % (
+      self.strategy, self.key, self.interval, self.ahead, self.detach_after, self.partitions, self.default,
+    )
+
+  def columns(self, model):
+    return [unicode(_column_name(model._meta.fields[name])) if name in model._meta.fields else name for name in self.key]
+
+  def key_sql(self, db, model):
+    return '%s (%s)' % (self.strategy.upper(), ', '.join(_quote(db, column) for column in self.columns(model)))
+
+def _partition_by(model, db=None):
+  # Meta.partition_by, where the database can partition
+  partitioning = getattr(model._meta, 'partition_by', None)
+  return partitioning if partitioning and is_postgres(db or model._meta.database) else None
+
+def _shift_period(start, interval, n):
+  if interval=='year': return datetime.date(start.year + n, 1, 1)
+  if interval=='month':
+    years, month = divmod(start.month - 1 + n, 12)
+    return datetime.date(start.year + years, month + 1, 1)
+  return start + datetime.timedelta(days=n * (7 if interval=='week' else 1))
+
+def _period_start(day, interval):
+  if interval=='year': return datetime.date(day.year, 1, 1)
+  if interval=='month': return datetime.date(day.year, day.month, 1)
+  if interval=='week': return day - datetime.timedelta(days=day.weekday())
+  return day
+
+def _range_partition_name(table, start, interval):
+  return '%s_p%s' % (table, start.strftime({'year': '%Y', 'month': '%Y_%m'}.get(interval, '%Y_%m_%d')))
+
+_re_range_partition_suffix = re.compile(r'_p(\d{4})(?:_(\d{2}))?(?:_(\d{2}))?$')
+
+def _range_partition_start(table, name):
+  # the start of a partition _range_partition_name named, or None
+  match = _re_range_partition_suffix.match(name[len(table):]) if name.startswith(table) else None
+  if not match: return None
+  return datetime.date(int(match.group(1)), int(match.group(2) or 1), int(match.group(3) or 1))
+
+@_profiled('calc_partition_changes')
+def calc_partition_changes(db, model, existing, today=None):
+  # existing is the table's PartitionedTable (with no key if it's being created), or None if it isn't partitioned
+  partitioning = _partition_by(model, db)
+  if not partitioning: return []
+  table = _table_name(model)
+  schema = getattr(model._meta, 'schema', None)
+  entity = lambda name: '.'.join(_quote(db, part) for part in ([schema] if schema else []) + [name])
+  if existing is None:
+    return [('-- %s is not partitioned.  postgres can\'t partition an existing table - create a partitioned copy (PARTITION BY %s) and move the rows over' % (
+      table, partitioning.key_sql(db, model)), [])]
+  if existing.key is not None and _normalize_sql_text(existing.key)!=_normalize_sql_text(partitioning.key_sql(db, model)):
+    return [('-- %s is partitioned by %s, not %s.  postgres can\'t change that - create a partitioned copy and move the rows over' % (
+      table, existing.key, partitioning.key_sql(db, model)), [])]
+  wanted = collections.OrderedDict()
+  to_detach = []
+  if partitioning.strategy=='range' and partitioning.interval:
+    interval = partitioning.interval
+    current = _period_start(today or datetime.date.today(), interval)
+    for i in range(partitioning.ahead + 1):
+      start = _shift_period(current, interval, i)
+      wanted[_range_partition_name(table, start, interval)] = "FOR VALUES FROM ('%s') TO ('%s')" % (start.isoformat(), _shift_period(start, interval, 1).isoformat())
+    if partitioning.detach_after is not None:
+      cutoff = _shift_period(current, interval, -partitioning.detach_after)
+      for name in existing.partitions:
+        start = _range_partition_start(table, name)
+        if start is not None and start < cutoff:
+          to_detach.append(name)
+  elif partitioning.strategy=='hash' and partitioning.partitions:
+    for i in range(partitioning.partitions):
+      wanted['%s_p%i' % (table, i)] = 'FOR VALUES WITH (MODULUS %i, REMAINDER %i)' % (partitioning.partitions, i)
+  if partitioning.default:
+    wanted['%s_default' % table] = 'DEFAULT'
   to_run = []
-  fields = list(model._meta.sorted_fields)
-  fields_by_column_name = {_column_name(f):f for f in fields}
-  pk_cols = set([unicode(_column_name(f)) for f in fields if f.primary_key])
-  existing_indexes = [i for i in existing_indexes if not all([(unicode(c) in pk_cols) for c in i.columns])]
-  normalized_existing_indexes = normalize_indexes(existing_indexes)
-  existing_indexes_by_normalized_existing_indexes = dict(zip(normalized_existing_indexes, existing_indexes))
-  normalized_existing_indexes = set(normalized_existing_indexes)
-  defined_indexes = indexes_on_model(model)
-  for fields, unique in model._meta.indexes:
-    try:
-      columns = [_column_name(model._meta.fields[fname]) for fname in fields]
-    except KeyError as e:
-      raise Exception("Index %s on %s references field %s in a multi-column index, but that field doesn't exist. (Be sure to use the field name, not the db_column name, when specifying a multi-column index.)" % ((fields, unique), model.__name__, repr(e.message)))
-    defined_indexes.append(pw.IndexMetadata('', '', columns, unique, _table_name(model)))
-  normalized_defined_indexes = set(normalize_indexes(defined_indexes))
-  to_add = normalized_defined_indexes - normalized_existing_indexes
-  to_del = normalized_existing_indexes - normalized_defined_indexes
-  for index in to_del:
-    index = existing_indexes_by_normalized_existing_indexes[index]
-    to_run += drop_index(migrator, model, index)
-  for index in to_add:
-    to_run += create_index(model, [fields_by_column_name[col] for col in index[1]], index[2])
+  for name, bound in wanted.items():
+    if name not in existing.partitions:
+      to_run.append(('CREATE TABLE IF NOT EXISTS %s PARTITION OF %s %s' % (entity(name), entity(table), bound), []))
+  for name in to_detach:
+    to_run.append(('ALTER TABLE %s DETACH PARTITION %s' % (entity(table), entity(name)), []))
   return to_run
 
-def evolve(db, interactive=True, ignore_tables=None, schema=None):
+def _detached_partitions(existing_tables, models):
+  # range partitions evolve detached (see Partitioning) are tables of their own now, but not stray ones
+  detached = set()
+  for model in models:
+    partitioning = getattr(model._meta, 'partition_by', None)
+    if partitioning and partitioning.interval:
+      table = unicode(_table_name(model))
+      detached |= set(t for t in existing_tables if _range_partition_start(table, t) is not None)
+  return detached
+
+
+# Table options, in the model's Meta.  On postgres:
+#
+#   storage_parameters = {'fillfactor': 70, 'autovacuum_vacuum_scale_factor': 0.01}
+#   unlogged = True
+#
+# once a model declares storage_parameters (even {}) they're the table's only ones - the rest are reset.  tables whose
+# models don't declare them are left alone, as are tables that don't say whether they're unlogged.  on mysql:
+#
+#   engine = 'InnoDB'
+#   row_format = 'COMPRESSED'
+#   key_block_size = 8
+#   page_compression = 'zlib'
+#
+# each one a model leaves out is left alone.  changing any but page_compression rebuilds the table, and page_compression
+# only applies to pages written afterwards (OPTIMIZE TABLE recompresses the rest).  on sqlite, peewee's own:
+#
+#   without_rowid = True
+#   strict_tables = True
+#
+# sqlite can't ALTER either, so changing them rebuilds the table (see _rebuild_sqlite_table).  without_rowid defaults to
+# False like it does in peewee, while tables whose models don't set strict_tables keep whatever they have.
+MYSQL_TABLE_OPTIONS = ('engine', 'row_format', 'key_block_size', 'page_compression')
+
+_re_storage_parameter = re.compile(r'^[a-z_][a-z0-9_]*(?:\.[a-z_][a-z0-9_]*)?$')
+_re_simple_storage_value = re.compile(r'^[\w.+-]+$')
+
+def _table_options(db, model):
+  # {option: value} for the options model declares, or None if it doesn't declare any
+  meta = model._meta
+  db = db or meta.database
+  if is_mysql(db):
+    options = {}
+    for name in MYSQL_TABLE_OPTIONS:
+      value = getattr(meta, name, None)
+      if value is None: continue
+      if not re.match(r'^\w+$', unicode(value)):
+        raise Exception("%s isn't a valid %s (in %s's Meta)" % (repr(value), name, model.__name__))
+      options[name] = int(value) if name=='key_block_size' else unicode(value)
+    return options or None
+  if is_sqlite(db):
+    options = {'without_rowid': bool(getattr(meta, 'without_rowid', False))}
+    if getattr(meta, 'strict_tables', None) is not None:
+      options['strict'] = bool(meta.strict_tables)
+    return options
+  if not is_postgres(db): return None
+  parameters = getattr(meta, 'storage_parameters', None)
+  if parameters is None and not hasattr(meta, 'unlogged'): return None
+  options = {}
+  for name, value in (parameters or {}).items():
+    if not _re_storage_parameter.match(name.lower()):
+      raise Exception("%s isn't a storage parameter (in %s's Meta.storage_parameters)" % (repr(name), model.__name__))
+    options[name.lower()] = value
+  if hasattr(meta, 'unlogged'):
+    options['unlogged'] = bool(meta.unlogged)
+  return options
+
+def _normalize_option_value(value):
+  if isinstance(value, bool): return 'true' if value else 'false'
+  value = unicode(value).strip().strip("'").lower()
+  if value in ('on', 'true', 'yes'): return 'true'
+  if value in ('off', 'false', 'no'): return 'false'
+  try:
+    return unicode(float(value))
+  except ValueError:
+    return value
+
+def _storage_parameter_sql(name, value):
+  if isinstance(value, bool): value = 'true' if value else 'false'
+  value = unicode(value)
+  return '%s = %s' % (name, value if _re_simple_storage_value.match(value) else _sql_literal(value))
+
+def _mysql_table_option_sql(name, value):
+  if name=='page_compression': return 'COMPRESSION=%s' % _sql_literal(value)
+  return '%s=%s' % (name.upper(), value)
+
+def _table_options_sql(model, db=None):
+  # what to create model's table with - WITH (...) on postgres, ENGINE=... ROW_FORMAT=... on mysql - or None
+  options = _table_options(db, model) or {}
+  if is_mysql(db or model._meta.database):
+    return ' '.join(_mysql_table_option_sql(name, options[name]) for name in MYSQL_TABLE_OPTIONS if name in options) or None
+  if not is_postgres(db or model._meta.database): return None
+  parameters = sorted((name, value) for name, value in options.items() if name!='unlogged')
+  if not parameters: return None
+  return 'WITH (%s)' % ', '.join(_storage_parameter_sql(name, value) for name, value in parameters)
+
+def _is_unlogged(model, db=None):
+  return bool((_table_options(db, model) or {}).get('unlogged'))
+
+@_profiled('calc_table_option_changes')
+def calc_table_option_changes(db, model, existing):
+  # existing is the live table's options, from get_table_options_by_table
+  defined = _table_options(db, model)
+  if defined is None: return []
+  table = _table_name(model)
+  schema = getattr(model._meta, 'schema', None)
+  entity = '.'.join(_quote(db, part) for part in ([schema] if schema else []) + [table])
+  to_run = []
+  if is_postgres(db):
+    parameters = dict((name, value) for name, value in defined.items() if name!='unlogged')
+    to_set = sorted(name for name, value in parameters.items() if name not in existing or _normalize_option_value(existing[name])!=_normalize_option_value(value))
+    to_reset = sorted(name for name in existing if name!='unlogged' and name not in parameters) if getattr(model._meta, 'storage_parameters', None) is not None else []
+    if to_set:
+      to_run.append(('ALTER TABLE %s SET (%s)' % (entity, ', '.join(_storage_parameter_sql(name, parameters[name]) for name in to_set)), []))
+    if to_reset:
+      to_run.append(('ALTER TABLE %s RESET (%s)' % (entity, ', '.join(to_reset)), []))
+    if 'unlogged' in defined and defined['unlogged']!=existing.get('unlogged', False):
+      # rewrites the table (and with SET LOGGED, all of it goes through the WAL)
+      to_run.append(('ALTER TABLE %s SET %s' % (entity, 'UNLOGGED' if defined['unlogged'] else 'LOGGED'), []))
+  elif is_mysql(db):
+    changed = [name for name in MYSQL_TABLE_OPTIONS if name in defined and _normalize_option_value(defined[name])!=_normalize_option_value(existing.get(name))]
+    if changed:
+      # one ALTER, so the table is rebuilt at most once
+      to_run.append(('ALTER TABLE %s %s' % (entity, ' '.join(_mysql_table_option_sql(name, defined[name]) for name in changed)), []))
+  elif is_sqlite(db):
+    if any(defined[name]!=existing.get(name, False) for name in defined):
+      to_run += _rebuild_sqlite_table(db, table, dict(existing, **defined))
+  return to_run
+
+_re_sqlite_table_options = re.compile(r'\)((?:\s*,?\s*(?:WITHOUT\s+ROWID|STRICT))*)\s*;?\s*$', re.I)
+_re_sqlite_create_table = re.compile(r'''^(\s*CREATE\s+TABLE\s+(?:IF\s+NOT\s+EXISTS\s+)?)("(?:[^"]|"")+"|`[^`]+`|\[[^\]]+\]|[^\s(]+)\s*''', re.I)
+
+def _sqlite_table_options_of(sql):
+  # {without_rowid, strict} from the end of a CREATE TABLE
+  m = _re_sqlite_table_options.search(sql or '')
+  tail = re.sub(r'\s+', ' ', m.group(1).upper()) if m else ''
+  return {'without_rowid': 'WITHOUT ROWID' in tail, 'strict': 'STRICT' in tail}
+
+def _with_sqlite_table_options(sql, options):
+  # a CREATE TABLE with options instead of whichever it had
+  tail = ', '.join(option for option, on in (('STRICT', options.get('strict')), ('WITHOUT ROWID', options.get('without_rowid'))) if on)
+  return _re_sqlite_table_options.sub(lambda m: ') ' + tail if tail else ')', sql.rstrip(), count=1)
+
+def _sqlite_rebuilt_table(sql):
+  # the table a CREATE TABLE of one of peewee's rebuilds (for column changes sqlite can't ALTER) is for, or None
+  m = _re_sqlite_create_table.match(sql)
+  if not m: return None
+  name = _unquote(m.group(2))
+  return name[:-len('__tmp__')] if name.endswith('__tmp__') else None
+
+def _rebuild_sqlite_table(db, table, options):
+  # the statements that rebuild table with options, the way peewee does for column changes: create a copy with them,
+  # fill it, drop the table, rename the copy to it, then recreate its indexes and triggers
+  rows = db.execute_sql("select type, sql from sqlite_schema where tbl_name = ? and sql is not null", [table]).fetchall()
+  create = [sql for type, sql in rows if type=='table']
+  # a table being renamed in the same plan isn't there yet - the next evolve rebuilds it
+  if not create: return []
+  create = create[0]
+  temp = table + '__tmp__'
+  create = _re_sqlite_create_table.sub(lambda m: m.group(1) + _quote(db, temp) + ' ', create, count=1)
+  return [
+    ('DROP TABLE IF EXISTS %s' % _quote(db, temp), []),
+    (_with_sqlite_table_options(create, options), []),
+    ('INSERT INTO %s SELECT * FROM %s' % (_quote(db, temp), _quote(db, table)), []),
+    ('DROP TABLE %s' % _quote(db, table), []),
+    ('ALTER TABLE %s RENAME TO %s' % (_quote(db, temp), _quote(db, table)), []),
+  ] + [(sql, []) for type, sql in rows if type in ('index', 'trigger')]
+
+def _keep_sqlite_table_options(db, model, existing, stmts):
+  # peewee's sqlite rebuilds for column changes (see _sqlite_rebuilt_table) drop WITHOUT ROWID and STRICT
+  if not is_sqlite(db): return stmts
+  options = dict(existing, **(_table_options(db, model) or {}))
+  table = _table_name(model)
+  # statements it leaves alone are passed through as they are, so a Backfill stays a Backfill
+  return [
+    (_with_sqlite_table_options(stmt[0], options), stmt[1]) if _sqlite_rebuilt_table(stmt[0])==table else stmt
+    for stmt in stmts
+  ]
+
+
+# Column options, as field kwargs (like aka).  On postgres:
+#
+#   payload = BinaryJSONField(compression='lz4', storage='external')
+#   status = CharField(statistics=1000)
+#
+# compression (pglz, lz4 or default - postgres 14+) and storage (plain, external, extended or main) only apply to
+# values written from then on, and statistics to the next ANALYZE, so none of them rewrite the table.  columns that
+# don't declare an option keep whatever they have.
+COLUMN_OPTIONS = ('compression', 'storage', 'statistics')
+COLUMN_COMPRESSION_METHODS = {'pglz': 'p', 'lz4': 'l', 'default': ''}
+COLUMN_STORAGE_MODES = {'plain': 'p', 'external': 'e', 'extended': 'x', 'main': 'm'}
+
+def _check_column_option(option, value):
+  if value is None: return None
+  if option=='compression' and value.lower() not in COLUMN_COMPRESSION_METHODS:
+    raise Exception("compression must be one of %s, not %s" % (', '.join(sorted(COLUMN_COMPRESSION_METHODS)), repr(value)))
+  if option=='storage' and value.lower() not in COLUMN_STORAGE_MODES:
+    raise Exception("storage must be one of %s, not %s" % (', '.join(sorted(COLUMN_STORAGE_MODES)), repr(value)))
+  return int(value) if option=='statistics' else value.lower()
+
+def _declares_column_options(db, model):
+  return is_postgres(db) and any([getattr(f, option, None) is not None for f in model._meta.sorted_fields for option in COLUMN_OPTIONS])
+
+@_profiled('get_column_options')
+def get_column_options_by_table(db, tables, schema=None):
+  # {table: {column: {'compression': ..., 'storage': ..., 'statistics': ...}}} for tables, as pg_attribute codes them
+  options_by_table = collections.defaultdict(dict)
+  if not is_postgres(db) or not tables: return options_by_table
+  compression = 'attribute.attcompression' if (getattr(db, 'server_version', None) or 140000) >= 140000 else "''"
+  cursor = _catalog_query(db, 'column_options', '''
+      select table_class.relname, attribute.attname, %s, attribute.attstorage, coalesce(attribute.attstattarget, -1)
+      from pg_catalog.pg_attribute attribute
+      join pg_catalog.pg_class table_class on table_class.oid = attribute.attrelid
+      join pg_catalog.pg_namespace table_namespace on table_namespace.oid = table_class.relnamespace
+      where table_namespace.nspname = %%s and table_class.relname = any(%%s) and attribute.attnum > 0 and not attribute.attisdropped
+  ''' % compression, (schema or 'public', list(tables)))
+  for table, column, compression, storage, statistics in cursor.fetchall():
+    options_by_table[unicode(table)][unicode(column)] = {'compression': compression or '', 'storage': storage, 'statistics': statistics}
+  return options_by_table
+
+@_profiled('calc_column_option_changes')
+def calc_column_option_changes(db, model, existing, renamed_cols=None):
+  # existing is {column: options} for the live table, from get_column_options_by_table - None if it's being created
+  if not _declares_column_options(db, model): return []
+  renamed_from = {ncn: ocn for ocn, ncn in (renamed_cols or {}).items()}
+  changes = []
+  for field in model._meta.sorted_fields:
+    column = unicode(_column_name(field))
+    current = (existing or {}).get(renamed_from.get(column, column), {})
+    compression, storage, statistics = [getattr(field, option, None) for option in COLUMN_OPTIONS]
+    if compression is not None and current.get('compression')!=COLUMN_COMPRESSION_METHODS[compression]:
+      changes.append('ALTER COLUMN %s SET COMPRESSION %s' % (_quote(db, column), compression))
+    if storage is not None and current.get('storage')!=COLUMN_STORAGE_MODES[storage]:
+      changes.append('ALTER COLUMN %s SET STORAGE %s' % (_quote(db, column), storage.upper()))
+    if statistics is not None and current.get('statistics')!=statistics:
+      changes.append('ALTER COLUMN %s SET STATISTICS %i' % (_quote(db, column), statistics))
+  if not changes: return []
+  schema = getattr(model._meta, 'schema', None)
+  entity = '.'.join(_quote(db, part) for part in ([schema] if schema else []) + [_table_name(model)])
+  # one statement, so one lock
+  return [('ALTER TABLE %s %s' % (entity, ', '.join(changes)), [])]
+
+def evolve(db, interactive=True, ignore_tables=None, schema=None, budget=None, throttle=None, journal=False, history=False, models=None, diff_defaults=None, introspection=None, index_foreign_keys=None, skip_redundant_indexes=None):
   if interactive:
     print((colorama.Style.BRIGHT + colorama.Fore.RED + 'Making updates to database: {}'.format(db.database) + colorama.Style.RESET_ALL))
-  to_run = calc_changes(db, ignore_tables=ignore_tables, schema=schema)
+  to_run = calc_changes(
+    db, ignore_tables=ignore_tables, schema=schema, models=models, diff_defaults=diff_defaults, introspection=introspection,
+    index_foreign_keys=index_foreign_keys, skip_redundant_indexes=skip_redundant_indexes,
+  )
   if not to_run:
     if interactive:
       print('Nothing to do... Your database is up to date!')
+    if budget is not None and _meta_table_exists(db, SCHEDULE_TABLE):
+      # nothing's deferred any more - but don't create the table just to say so
+      with db.atomic():
+        _record_schedule(db, [])
     return
+  if interactive:
+    to_run = annotate_rewrite_cost(db, annotate_index_usage(db, to_run, schema=schema), schema=schema)
+
+  window = None
+  if budget is not None:
+    plan = schedule(db, to_run, budget, schema=schema)
+    window = MaintenanceWindow(db, plan, budget)
+    to_run = [stmt.statement for stmt in plan.run]
+    if interactive and plan.deferred:
+      print_deferred(plan.deferred)
 
   commit = True
-  if interactive:
+  if interactive and to_run:
     commit = _confirm(db, to_run)
-  _execute(db, to_run, interactive=interactive, commit=commit)
+  journal = Journal(db, to_run) if journal else None
+  history = History(db) if history else None
+  _execute(db, to_run, interactive=interactive, commit=commit, window=window, throttle=throttle, journal=journal, history=history)
+
+
+def resume(db, interactive=True, ignore_tables=None, schema=None, throttle=None, history=False, models=None, diff_defaults=None, index_foreign_keys=None, skip_redundant_indexes=None):
+  journal = Journal.incomplete(db)
+  if journal is None:
+    if interactive:
+      print('Nothing to resume... The last journaled evolve ran to completion.')
+    return
+  # the diff between the models and the live schema must be exactly what the journal has left to do - no more (the
+  # schema has drifted), and no less (some of it was done some other way, and running it again could fail or destroy)
+  remaining = collections.Counter(sql for sql, _ in journal.to_run if not sql.strip().startswith('--'))
+  to_run = calc_changes(
+    db, ignore_tables=ignore_tables, schema=schema, models=models, diff_defaults=diff_defaults,
+    index_foreign_keys=index_foreign_keys, skip_redundant_indexes=skip_redundant_indexes,
+  )
+  needed = collections.Counter(sql for sql, _ in to_run if not sql.strip().startswith('--'))
+  if not needed:
+    # already up to date, so there's nothing left to resume
+    journal.resolve()
+    if interactive:
+      print('Nothing to resume... The schema already matches the models, so the rest of evolve %s is marked skipped.' % journal.plan_hash)
+    return
+  if needed != remaining:
+    raise Exception("Can't resume evolve %s - the schema isn't in the state its journal expects.\nIt would also need:\n%s\nIt no longer needs:\n%s" % (
+      journal.plan_hash, '\n'.join((needed - remaining).elements()) or '(nothing)', '\n'.join((remaining - needed).elements()) or '(nothing)',
+    ))
+  if interactive:
+    print((colorama.Style.BRIGHT + colorama.Fore.RED + 'Resuming evolve {} at step {}'.format(journal.plan_hash, journal.offset + 1) + colorama.Style.RESET_ALL))
+  commit = True
+  if interactive:
+    commit = _confirm(db, journal.to_run)
+  history = History(db) if history else None
+  _execute(db, journal.to_run, interactive=interactive, commit=commit, throttle=throttle, journal=journal, history=history)
 
 
-def _execute(db, to_run, interactive=True, commit=True):
+@_profiled('execute')
+def _execute(db, to_run, interactive=True, commit=True, window=None, throttle=None, journal=None, history=None):
   if interactive: print()
+  step = None
+  committed = False
+  # CREATE INDEX CONCURRENTLY can't run in a transaction, so those wait until the rest has committed
+  after_commit = [i for i, (sql, _) in enumerate(to_run) if _runs_outside_transaction(sql)]
+  # waiting on replicas while holding the locks of the DDL run so far would stall the application (and on mysql a
+  # transaction only replicates once it commits), so a throttled plan commits statement by statement - and backfills
+  # batch by batch - instead of all at once.  a test run is rolled back, so there's nothing to wait for.
+  if not commit: throttle = None
+  search_path = _SearchPath(db) if throttle or (after_commit and commit) else None
   try:
-    with db.atomic() as txn:
-      for sql, params in to_run:
+    if commit and (journal or history):
+      # committed before the plan starts, so a failed plan's rollback can't take them (or the journal's steps) with it
+      with db.atomic():
+        if journal: journal.open()
+        if history: history.open()
+    with (_no_transaction() if throttle else db.atomic()) as txn:
+      if window: window.open()
+      if journal and not commit: journal.open()
+      if history and not commit: history.open()
+      for i, stmt in enumerate(to_run):
+        step = i
+        sql, params = stmt
+        if i in after_commit: continue
         if interactive or DEBUG: print_sql(' %s; %s' % (sql, params or ''))
-        if sql.strip().startswith('--'): continue
-        db.execute_sql(sql, params)
-      if interactive:
-        print()
-        print(
-          (colorama.Style.BRIGHT + 'SUCCESS!' + colorama.Style.RESET_ALL) if commit else 'TEST PASSED - ROLLING BACK',
-          colorama.Style.DIM + '-',
-          'https://github.com/keredson/peewee-db-evolve' + colorama.Style.RESET_ALL
-        )
-        print()
+        if sql.strip().startswith('--'):
+          if journal: journal.mark(i, 'done')
+          continue
+        if throttle and search_path.sets(sql):
+          # SET LOCAL would be gone by the next statement
+          search_path.set(sql)
+          if journal: journal.mark(i, 'done')
+          continue
+        if throttle and i: throttle.wait(db)
+        if journal: journal.mark(i, 'running')
+        start = time.time()
+        execute = lambda: _execute_statement(db, stmt, throttle=throttle)
+        if history: execute = history.measure(sql, execute, in_transaction=not throttle)
+        if window:
+          ran = window.run(i, sql, execute)
+          if history and not ran: history.record_failure('timeout')
+        else:
+          execute()
+          ran = True
+        if journal: journal.mark(i, 'done' if ran else 'skipped', duration=time.time() - start)
+        committed = bool(throttle)
+      step = None
+      if window: window.close()
       if not commit:
         txn.rollback()
+    committed = commit
+    for i in (after_commit if commit else []):
+      step = i
+      sql, params = to_run[i]
+      if interactive or DEBUG: print_sql(' %s; %s' % (sql, params or ''))
+      # the SET LOCAL search_path it was planned under went with the transaction
+      search_path.set_as_of(to_run, i)
+      if throttle: throttle.wait(db)
+      if journal: journal.mark(i, 'running')
+      start = time.time()
+      execute = lambda: _execute_concurrently(db, to_run[i])
+      if history: execute = history.measure(sql, execute, in_transaction=False)
+      if window:
+        ran = window.run(i, sql, execute, in_transaction=False)
+        if history and not ran: history.record_failure('timeout')
+      else:
+        execute()
+        ran = True
+      if journal: journal.mark(i, 'done' if ran else 'skipped', duration=time.time() - start)
+    if window and commit: window.record()
+    step = None
+    if interactive:
+      if after_commit and not commit:
+        print(' (skipped %i CONCURRENTLY statement%s, which can\'t be rolled back)' % (len(after_commit), '' if len(after_commit)==1 else 's'))
+      print()
+      print(
+        (colorama.Style.BRIGHT + 'SUCCESS!' + colorama.Style.RESET_ALL) if commit else 'TEST PASSED - ROLLING BACK',
+        colorama.Style.DIM + '-',
+        'https://github.com/keredson/peewee-db-evolve' + colorama.Style.RESET_ALL
+      )
+      print()
   except Exception as e:
     print()
     print('------------------------------------------')
-    print(colorama.Style.BRIGHT + colorama.Fore.RED + ' SQL EXCEPTION - ROLLING BACK ALL CHANGES' + colorama.Style.RESET_ALL)
+    if committed:
+      print(colorama.Style.BRIGHT + colorama.Fore.RED + ' SQL EXCEPTION - EARLIER CHANGES COMMITTED' + colorama.Style.RESET_ALL)
+    else:
+      print(colorama.Style.BRIGHT + colorama.Fore.RED + ' SQL EXCEPTION - ROLLING BACK ALL CHANGES' + colorama.Style.RESET_ALL)
     print('------------------------------------------')
     print()
+    if journal and step is not None and (not isinstance(journal, Journal) or _meta_table_exists(db, JOURNAL_TABLE)):
+      # the steps before it only stay done where DDL isn't transactional (MySQL) - elsewhere they were rolled back too
+      journal.mark(step, 'failed', error=unicode(e))
+    if history:
+      history.record_failure('failed')
     raise e
+  finally:
+    if search_path: search_path.restore()
+
+_re_concurrent_index_name = re.compile(r'^\s*CREATE\s+(?:UNIQUE\s+)?INDEX\s+CONCURRENTLY\s+(?:IF\s+NOT\s+EXISTS\s+)?("(?:[^"]|"")+"|\S+)', re.I)
+
+def _execute_concurrently(db, stmt):
+  try:
+    db.execute_sql(*stmt)
+  except Exception:
+    # a failed concurrent build leaves an invalid index behind, which would still slow down every write
+    name = _re_concurrent_index_name.match(stmt[0])
+    if name:
+      db.execute_sql('DROP INDEX CONCURRENTLY IF EXISTS %s' % name.group(1))
+    raise
+
+def _execute_statement(db, stmt, throttle=None):
+  # with a throttle, outside of any transaction (see _execute) - so each batch commits before we wait on the replicas
+  if throttle and throttle.batch_size and isinstance(stmt, Backfill):
+    sql, params = stmt.batch(db, throttle.batch_size)
+    while db.execute_sql(sql, params).rowcount >= throttle.batch_size:
+      throttle.wait(db)
+  else:
+    db.execute_sql(*stmt)
+
+@contextlib.contextmanager
+def _no_transaction():
+  yield None
+
+_re_set_search_path = re.compile(r'^\s*SET\s+(?:LOCAL\s+)?search_path\b', re.I)
+
+class _SearchPath(object):
+  # evolve_schemas' plans SET LOCAL search_path before each schema's statements.  for statements run outside the
+  # plan's transaction it has to be set for the session instead, and put back afterwards.
+  def __init__(self, db):
+    self.db = db
+    self.original = None
+    self.current = None
+
+  def sets(self, sql):
+    return bool(_re_set_search_path.match(sql))
+
+  def set_as_of(self, to_run, i):
+    # the search_path in effect at step i of to_run, if it sets one at all
+    sql = next((sql for sql, _ in reversed(to_run[:i]) if self.sets(sql)), None)
+    if sql: self.set(sql)
+
+  def set(self, sql):
+    sql = _re_set_search_path.sub('SET search_path', sql, count=1)
+    if sql == self.current: return
+    if self.original is None:
+      self.original = self.db.execute_sql('SHOW search_path').fetchone()[0]
+    self.db.execute_sql(sql)
+    self.current = sql
+
+  def restore(self):
+    if self.original is not None:
+      self.db.execute_sql('SET search_path TO %s' % self.original)
+      self.original = self.current = None
+
+
+class Backfill(tuple):
+  # an UPDATE setting a column's NULLs to its default.  it's a (sql, params) tuple like every other statement,
+  # but remembers enough to re-run itself in batches.
+  def __new__(cls, sql, params, table, column, value):
+    self = tuple.__new__(cls, (sql, params))
+    self.table = table
+    self.column = column
+    self.value = value
+    return self
+
+  def batch(self, db, batch_size):
+    table, column = _quote(db, self.table), _quote(db, self.column)
+    if is_mysql(db):
+      sql = 'UPDATE %s SET %s = %s WHERE %s IS NULL LIMIT %i' % (table, column, db.param, column, batch_size)
+    else:
+      # sqlite WITHOUT ROWID tables have no rowid, but every table has a primary key (or a rowid, which is what the
+      # pragma's pk columns are then)
+      key = ['ctid'] if is_postgres(db) else self._sqlite_key(db)
+      sql = 'UPDATE %s SET %s = %s WHERE %s IN (SELECT %s FROM %s WHERE %s IS NULL LIMIT %i)' % (
+        # several columns make a row value, sqlite 3.15+
+        table, column, db.param, key[0] if len(key)==1 else '(%s)' % ', '.join(key), ', '.join(key), table, column, batch_size
+      )
+    return sql, [self.value]
+
+  def _sqlite_key(self, db):
+    columns = sorted(row for row in db.execute_sql('select pk, name from pragma_table_info(?)', [self.table]).fetchall() if row[0])
+    return [_quote(db, name) for _, name in columns] or ['rowid']
+
+
+###################
+# Streaming diff
+###################
+
+# For catalogs too big to hold in memory:  iter_changes() yields the same statements as calc_changes(), but
+# introspects and diffs one table at a time, so memory is bounded by the biggest table rather than the whole schema.
+# Columns come from one query ordered by table (through a server-side cursor on postgres), and each table's foreign
+# keys and indexes are looked up as it's reached.  Statements come out table by table rather than grouped by kind.
+
+_cursor_ids = itertools.count()
+
+def _stream_query(db, name, sql, params=None, itersize=2000):
+  if is_postgres(db):
+    # WITH HOLD, since peewee runs psycopg2 in autocommit mode
+    cursor = db.connection().cursor(name='peeweedbevolve_%s_%i' % (name, next(_cursor_ids)), withhold=True)
+    cursor.itersize = itersize
+    _catalog_call(name, cursor.execute, sql, params)
+  else:
+    cursor = _catalog_query(db, name, sql, params)
+  try:
+    while True:
+      rows = cursor.fetchmany(itersize)
+      if not rows: break
+      for row in rows:
+        yield row
+  finally:
+    cursor.close()
+
+def iter_columns_by_table(db, schema=None, itersize=2000):
+  # (table, [ColumnMetadata]), one table at a time
+  if is_sqlite(db):
+    # table names are read up front, so a sink can alter tables without tripping over an open cursor
+    for (table_name,) in _catalog_query(db, 'tables', "select name from sqlite_schema where type='table' and name NOT LIKE 'sqlite_%' order by name").fetchall():
+      table_name = _intern(unicode(table_name))
+      columns = [
+        _column_from_table_info(table_name, row)
+        for row in _catalog_query(db, 'table_info', 'select name, type, "notnull", dflt_value, pk from pragma_table_info(?)', [table_name])
+      ]
+      yield table_name, columns
+    return
+  if schema is None and is_mysql(db):
+    schema_check, params = 'c.table_schema=DATABASE()', []
+  else:
+    schema_check, params = 'c.table_schema=%s', [schema or 'public']
+  rows = _stream_query(db, 'columns', _COLUMNS_SQL % (schema_check, 'c.table_name, c.ordinal_position'), params, itersize=itersize)
+  for table_name, table_rows in itertools.groupby(rows, key=lambda row: row[4]):
+    yield unicode(table_name), [_column_from_row(row) for row in table_rows]
+
+def iter_changes(db, ignore_tables=None, schema=None, models=None, diff_defaults=None):
+  migrator = auto_detect_migrator(db)
+  if models is None:
+    models = models_for(db, schema=schema)
+    ignore_tables = set(ignore_tables or []) | globals()['ignore_tables']
+  table_names_to_models = {_table_name(cls): cls for cls in models}
+
+  with _span('get_tables'):
+    existing_tables = get_tables(db, schema=schema)
+  table_adds, add_fks, table_deletes, table_renames = calc_table_changes(existing_tables, ignore_tables=ignore_tables, models=models)
+  table_renamed_from = {v: k for k, v in table_renames.items()}
+
+  for tbl in sorted(table_adds):
+    model = table_names_to_models[tbl]
+    stmts = create_table(model, db=db) + calc_column_option_changes(db, model, None) + calc_partition_changes(db, model, PartitionedTable(tbl, None, {}))
+    for stmt in stmts + _table_index_changes(db, migrator, model, [], set(), {}):
+      yield stmt
+  for field in add_fks:
+    for stmt in create_foreign_key(field, db=db):
+      yield stmt
+  for k, v in table_renames.items():
+    for stmt in rename_table(migrator, k, v):
+      yield stmt
+  table_options_by_table = {}
+  if any(_partition_by(model, db) or _table_options(db, model) for model in models):
+    partitions_by_table = get_partitions_by_table(db, schema=schema)
+    table_options_by_table = get_table_options_by_table(db, schema=schema)
+    for ntn, model in sorted(table_names_to_models.items()):
+      if ntn not in table_adds:
+        etn = table_renamed_from.get(ntn, ntn)
+        stmts = calc_table_option_changes(db, model, table_options_by_table.get(etn, {}))
+        for stmt in stmts + calc_partition_changes(db, model, partitions_by_table.get(etn)):
+          yield stmt
+
+  for etn, ecols in iter_columns_by_table(db, schema=schema):
+    if etn in table_deletes: continue
+    ntn = table_renames.get(etn, etn)
+    model = table_names_to_models.get(ntn)
+    if not model: continue
+    existing_fks = get_foreign_keys_by_table(db, schema=schema, table=etn)[etn]
+    stmts, deletes, renames = _table_column_changes(db, migrator, etn, ntn, model, ecols, existing_fks, diff_defaults)
+    stmts = _keep_sqlite_table_options(db, model, table_options_by_table.get(etn, {}), stmts)
+    if _declares_column_options(db, model):
+      stmts += calc_column_option_changes(db, model, get_column_options_by_table(db, [etn], schema=schema).get(etn, {}), renames)
+    stmts += _table_index_changes(db, migrator, model, get_indexes_by_table(db, etn, schema=schema), deletes, renames)
+    for stmt in stmts:
+      yield stmt
+
+  for tbl in sorted(table_deletes):
+    for stmt in drop_table(migrator, tbl):
+      yield stmt
+
+def stream_changes(db, sink, ignore_tables=None, schema=None, models=None, diff_defaults=None):
+  # hands each statement to sink(stmt) as soon as it's planned.  returns how many there were.
+  count = 0
+  for stmt in iter_changes(db, ignore_tables=ignore_tables, schema=schema, models=models, diff_defaults=diff_defaults):
+    sink(stmt)
+    count += 1
+  return count
+
+class SQLFileSink(object):
+  # writes the plan to a file as a SQL script
+  def __init__(self, f):
+    self.f = f
+  def __call__(self, stmt):
+    sql, params = stmt
+    self.f.write('%s;%s\n' % (sql, ' -- %s' % (params,) if params else ''))
+
+def print_sink(stmt):
+  sql, params = stmt
+  print_sql(' %s; %s' % (sql, params or ''))
+
+class ExecuteSink(object):
+  # runs each statement as it's planned.  for all-or-nothing, wrap stream_changes() in db.atomic() (postgres).
+  def __init__(self, db, throttle=None, interactive=False):
+    self.db = db
+    self.throttle = throttle
+    self.interactive = interactive
+  def __call__(self, stmt):
+    if self.interactive: print_sink(stmt)
+    if stmt[0].strip().startswith('--'): return
+    if self.throttle: self.throttle.wait(self.db)
+    _execute_statement(self.db, stmt, throttle=self.throttle)
+
+
+###################
+# Replication lag throttling
+###################
+
+# Pauses evolve between statements (and between batches of a backfill) while replicas are more than
+# max_lag seconds behind.  Lag comes from the lag callable if given, else from the replicas (peewee
+# databases connected to MySQL or PostgreSQL replicas), else from pg_stat_replication on the primary.
+class Throttle(object):
+
+  def __init__(self, max_lag=10, lag=None, replicas=None, interval=1, timeout=None, batch_size=10000):
+    self.max_lag = max_lag
+    self.lag = lag
+    self.replicas = replicas or []
+    self.interval = interval
+    self.timeout = timeout
+    self.batch_size = batch_size
+
+  def current_lag(self, db):
+    if self.lag is not None:
+      return self.lag()
+    if self.replicas:
+      lags = [replica_lag(replica) for replica in self.replicas]
+      lags = [lag for lag in lags if lag is not None]
+      return max(lags) if lags else None
+    if is_postgres(db):
+      return primary_replication_lag(db)
+    return None
+
+  def wait(self, db):
+    start = time.time()
+    while True:
+      lag = self.current_lag(db)
+      if lag is None or lag <= self.max_lag:
+        return
+      waited = time.time() - start
+      if self.timeout is not None and waited > self.timeout:
+        raise Exception('replication lag is still %ss (max %ss) after waiting %is' % (lag, self.max_lag, waited))
+      if DEBUG: print('replication lag is %ss (max %ss), waiting...' % (lag, self.max_lag))
+      time.sleep(self.interval)
+
+def primary_replication_lag(db):
+  cursor = db.execute_sql('select coalesce(max(extract(epoch from replay_lag)), 0) from pg_stat_replication')
+  return float(cursor.fetchone()[0])
+
+def replica_lag(replica):
+  if is_postgres(replica):
+    # an idle primary makes pg_last_xact_replay_timestamp() look old, so check we've replayed all we've received
+    cursor = replica.execute_sql('''
+      select case when pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() then 0
+        else extract(epoch from now() - pg_last_xact_replay_timestamp()) end
+    ''')
+    lag = cursor.fetchone()[0]
+    return None if lag is None else float(lag)
+  if is_mysql(replica):
+    for sql in ('SHOW REPLICA STATUS', 'SHOW SLAVE STATUS'):
+      try:
+        cursor = replica.execute_sql(sql)
+      except pw.ProgrammingError:
+        continue # SHOW REPLICA STATUS is new in MySQL 8.0.22
+      row = cursor.fetchone()
+      if row is None: return None # not a replica
+      status = dict(zip([d[0] for d in cursor.description], row))
+      lag = status.get('Seconds_Behind_Source', status.get('Seconds_Behind_Master'))
+      # NULL means replication is broken, which is as lagged as it gets
+      return float('inf') if lag is None else float(lag)
+  raise Exception("don't know how to get replication lag for %s" % replica)
+
 
 COLORED_WORDS = None
 
@@ -849,9 +2646,847 @@ def _confirm(db, to_run):
 
 
 
+###################
+# Evolve's own tables
+###################
+
+SCHEDULE_TABLE = 'peeweedbevolve_schedule'
+JOURNAL_TABLE = 'peeweedbevolve_journal'
+HISTORY_TABLE = 'peeweedbevolve_history'
+EVOLVE_TABLES = set([SCHEDULE_TABLE, JOURNAL_TABLE, HISTORY_TABLE])
+
+_META_COLUMN_TYPES = {
+  'postgres': {'id':'serial primary key', 'text':'text', 'int':'bigint', 'float':'double precision', 'timestamp':'timestamp'},
+  'mysql': {'id':'integer auto_increment primary key', 'text':'longtext', 'int':'bigint', 'float':'double', 'timestamp':'datetime'},
+  'sqlite': {'id':'integer primary key', 'text':'text', 'int':'integer', 'float':'real', 'timestamp':'timestamp'},
+}
+
+def _dialect(db):
+  if is_postgres(db): return 'postgres'
+  if is_mysql(db): return 'mysql'
+  if is_sqlite(db): return 'sqlite'
+  raise Exception("don't know how to store evolve metadata in %s" % db)
+
+def _quote(db, name):
+  return db.get_sql_context().sql(pw.Entity(name)).query()[0]
+
+def _create_meta_table(db, name, columns):
+  types = _META_COLUMN_TYPES[_dialect(db)]
+  cols = ', '.join('%s %s' % (_quote(db, column), types[kind]) for column, kind in columns)
+  db.execute_sql('CREATE TABLE IF NOT EXISTS %s (%s)' % (_quote(db, name), cols))
+
+def _insert_meta_row(db, name, row):
+  sql = 'INSERT INTO %s (%s) VALUES (%s)' % (
+    _quote(db, name), ', '.join(_quote(db, column) for column, _ in row), ', '.join([db.param] * len(row))
+  )
+  db.execute_sql(sql, [value for _, value in row])
+
+def _meta_table_exists(db, name):
+  return name in db.get_tables()
+
+
+###################
+# Execution journal
+###################
+
+JOURNAL_COLUMNS = [
+  ('id', 'id'), ('plan_hash', 'text'), ('step', 'int'), ('sql', 'text'), ('params', 'text'), ('status', 'text'),
+  ('duration', 'float'), ('error', 'text'), ('started_at', 'timestamp'), ('finished_at', 'timestamp'),
+]
+
+def hash_plan(to_run):
+  return hashlib.sha1(json.dumps([[sql, list(params or [])] for sql, params in to_run], default=unicode).encode('utf8')).hexdigest()
+
+# Records each step of an evolve as it runs (pending -> running -> done/skipped/failed), so that when DDL
+# isn't transactional and a step fails part way through a plan, resume() can pick up where it stopped.
+class Journal(object):
+
+  def __init__(self, db, to_run, plan_hash=None, offset=0):
+    self.db = db
+    self.to_run = to_run
+    self.resuming = plan_hash is not None
+    self.plan_hash = plan_hash or hash_plan(to_run)
+    self.offset = offset
+
+  @classmethod
+  def incomplete(cls, db):
+    if not _meta_table_exists(db, JOURNAL_TABLE): return None
+    table = _quote(db, JOURNAL_TABLE)
+    row = db.execute_sql('SELECT plan_hash FROM %s WHERE status NOT IN (%s, %s) ORDER BY id DESC LIMIT 1' % (table, db.param, db.param), ['done', 'skipped']).fetchone()
+    if row is None: return None
+    plan_hash = row[0]
+    steps = db.execute_sql('SELECT step, sql, params, status FROM %s WHERE plan_hash = %s ORDER BY step' % (table, db.param), [plan_hash]).fetchall()
+    offset = next(step for step, _, _, status in steps if status not in ('done', 'skipped'))
+    to_run = [(sql, json.loads(params)) for step, sql, params, _ in steps if step >= offset]
+    return cls(db, to_run, plan_hash=plan_hash, offset=offset)
+
+  def open(self):
+    if self.resuming: return
+    _create_meta_table(self.db, JOURNAL_TABLE, JOURNAL_COLUMNS)
+    self.db.execute_sql('DELETE FROM %s WHERE plan_hash = %s' % (_quote(self.db, JOURNAL_TABLE), self.db.param), [self.plan_hash])
+    for i, (sql, params) in enumerate(self.to_run):
+      _insert_meta_row(self.db, JOURNAL_TABLE, [
+        ('plan_hash', self.plan_hash), ('step', i), ('sql', sql), ('params', json.dumps(list(params or []), default=unicode)),
+        ('status', 'pending'),
+      ])
+
+  def resolve(self):
+    # nothing of what's left needs running any more
+    self.db.execute_sql("UPDATE %s SET status = %s WHERE plan_hash = %s AND status NOT IN ('done', 'skipped')" % (
+      _quote(self.db, JOURNAL_TABLE), self.db.param, self.db.param,
+    ), ['skipped', self.plan_hash])
+
+  def mark(self, i, status, duration=None, error=None):
+    now = datetime.datetime.now()
+    times = [('started_at', now)] if status=='running' else [('finished_at', now), ('duration', duration), ('error', error)]
+    assignments = [('status', status)] + times
+    self.db.execute_sql('UPDATE %s SET %s WHERE plan_hash = %s AND step = %s' % (
+      _quote(self.db, JOURNAL_TABLE), ', '.join('%s = %s' % (_quote(self.db, column), self.db.param) for column, _ in assignments),
+      self.db.param, self.db.param,
+    ), [value for _, value in assignments] + [self.plan_hash, self.offset + i])
+
+
+###################
+# Execution history
+###################
+
+HISTORY_COLUMNS = [
+  ('id', 'id'), ('sql', 'text'), ('table_name', 'text'), ('kind', 'text'),
+  ('rows_before', 'int'), ('rows_after', 'int'), ('size_before', 'int'), ('size_after', 'int'),
+  ('lock_wait', 'float'), ('duration', 'float'), ('outcome', 'text'), ('error', 'text'), ('executed_at', 'timestamp'),
+]
+
+HistoryEntry = collections.namedtuple('HistoryEntry', [column for column, _ in HISTORY_COLUMNS])
+TableStats = collections.namedtuple('TableStats', ('table', 'statements', 'total_duration', 'max_duration', 'last_duration', 'last_seconds_per_mb'))
+
+def relation_stats(db, table):
+  # (estimated rows, bytes) or None if the table doesn't exist
+  if table is None: return None
+  if is_postgres(db):
+    row = db.execute_sql('select reltuples, pg_total_relation_size(oid) from pg_catalog.pg_class where oid = to_regclass(%s)', [_quote(db, table)]).fetchone()
+  elif is_mysql(db):
+    row = db.execute_sql('''
+      select table_rows, coalesce(data_length,0) + coalesce(index_length,0)
+      from information_schema.tables where table_schema = DATABASE() and table_name = %s
+    ''', [table]).fetchone()
+  elif is_sqlite(db):
+    if table not in db.get_tables(): return None
+    # sqlite keeps no row estimate of its own, only ANALYZE's (counting them would read the whole table)
+    try:
+      stat = db.execute_sql('select stat from sqlite_stat1 where tbl = ? limit 1', [table]).fetchone()
+    except pw.OperationalError:
+      stat = None
+    rows = int(stat[0].split()[0]) if stat and stat[0] else None
+    try:
+      size = db.execute_sql('select sum(pgsize) from dbstat where name = ?', [table]).fetchone()[0]
+    except pw.OperationalError:
+      size = None
+    row = (rows, size)
+  else:
+    return None
+  if row is None: return None
+  return (None if row[0] is None else int(row[0]), None if row[1] is None else int(row[1]))
+
+def _lock_mode(sql):
+  kind = classify_statement(sql)
+  if kind == 'index': return 'SHARE'
+  if kind == 'backfill': return 'ROW EXCLUSIVE'
+  if 'FOREIGN KEY' in sql.upper(): return 'SHARE ROW EXCLUSIVE'
+  return 'ACCESS EXCLUSIVE'
+
+# Measures every statement evolve runs (row estimates and relation size before and after, time spent waiting for
+# locks, time spent executing and how it ended) into the history table.
+class History(object):
+
+  def __init__(self, db):
+    self.db = db
+    self.failure = None
+
+  def open(self):
+    _create_meta_table(self.db, HISTORY_TABLE, HISTORY_COLUMNS)
+
+  def measure(self, sql, execute, in_transaction=True):
+    def measured():
+      table = statement_table(sql)
+      before = relation_stats(self.db, table)
+      lock_wait = None
+      # outside a transaction the lock would be let go straight away (or refused), and a CONCURRENTLY build is run
+      # that way precisely so it doesn't block writes like the SHARE lock would
+      lockable = in_transaction and not _runs_outside_transaction(sql)
+      if is_postgres(self.db) and lockable and before is not None and not sql.strip().upper().startswith('CREATE TABLE'):
+        # take the lock the statement needs ourselves, so we can tell waiting for it apart from doing the work
+        start = time.time()
+        self.db.execute_sql('LOCK TABLE %s IN %s MODE' % (_quote(self.db, table), _lock_mode(sql)))
+        lock_wait = time.time() - start
+      start = time.time()
+      try:
+        execute()
+      except Exception as e:
+        self.failure = [('sql', sql), ('table_name', table), ('kind', classify_statement(sql))] + self._stats('before', before) + [
+          ('lock_wait', lock_wait), ('duration', time.time() - start), ('error', unicode(e)), ('executed_at', datetime.datetime.now()),
+        ]
+        raise
+      duration = time.time() - start
+      after = relation_stats(self.db, table)
+      _insert_meta_row(self.db, HISTORY_TABLE, [('sql', sql), ('table_name', table), ('kind', classify_statement(sql))] +
+        self._stats('before', before) + self._stats('after', after) + [
+        ('lock_wait', lock_wait), ('duration', duration), ('outcome', 'ok'), ('executed_at', datetime.datetime.now()),
+      ])
+    return measured
+
+  def _stats(self, when, stats):
+    rows, size = stats or (None, None)
+    return [('rows_%s' % when, rows), ('size_%s' % when, size)]
+
+  def record_failure(self, outcome):
+    # called once the failed statement has been rolled back
+    if self.failure is None: return
+    self.open()
+    _insert_meta_row(self.db, HISTORY_TABLE, self.failure + [('outcome', outcome)])
+    self.failure = None
+
+
+def get_history(db, table=None, kind=None, outcome=None, limit=None):
+  if not _meta_table_exists(db, HISTORY_TABLE): return []
+  filters = [(column, value) for column, value in (('table_name', table), ('kind', kind), ('outcome', outcome)) if value is not None]
+  sql = 'SELECT %s FROM %s' % (', '.join(_quote(db, column) for column in HistoryEntry._fields), _quote(db, HISTORY_TABLE))
+  if filters:
+    sql += ' WHERE ' + ' AND '.join('%s = %s' % (_quote(db, column), db.param) for column, _ in filters)
+  sql += ' ORDER BY id DESC'
+  if limit is not None:
+    sql += ' LIMIT %i' % limit
+  return [HistoryEntry(*row) for row in db.execute_sql(sql, [value for _, value in filters]).fetchall()]
+
+def get_table_stats(db, kind=None):
+  # per table DDL timings, slowest first - last_seconds_per_mb growing over time is the thing to watch
+  by_table = collections.OrderedDict()
+  for entry in reversed(get_history(db, kind=kind, outcome='ok')):
+    if entry.table_name is None or entry.kind == 'metadata': continue
+    by_table.setdefault(entry.table_name, []).append(entry)
+  stats = []
+  for table, entries in by_table.items():
+    durations = [entry.duration for entry in entries]
+    last = entries[-1]
+    stats.append(TableStats(
+      table, len(entries), sum(durations), max(durations), last.duration,
+      last.duration / (last.size_before / MB) if last.size_before else None,
+    ))
+  return sorted(stats, key=lambda s: s.max_duration, reverse=True)
+
+
+###################
+# Maintenance window scheduling
+###################
+
+SCHEDULE_COLUMNS = [
+  ('id', 'id'), ('sql', 'text'), ('params', 'text'), ('kind', 'text'), ('table_name', 'text'),
+  ('relation_size', 'int'), ('estimate', 'float'), ('status', 'text'), ('created_at', 'timestamp'),
+]
+
+# rough throughput assumptions, used until we've timed a statement kind on this database
+DEFAULT_SECONDS_PER_MB = {'metadata': 0.0, 'validate': 0.01, 'index': 0.02, 'rewrite': 0.05, 'backfill': 0.1}
+STATEMENT_OVERHEAD = 0.05
+MB = 1024.0 * 1024.0
+
+ScheduledStatement = collections.namedtuple('ScheduledStatement', ('sql', 'params', 'kind', 'table', 'relation_size', 'estimate', 'statement'))
+Schedule = collections.namedtuple('Schedule', ('run', 'deferred'))
+
+_re_statement_object = re.compile(r'\b(TABLE|ON|INTO|UPDATE|REFERENCES|INDEX|TO)\s+(?:IF\s+(?:NOT\s+)?EXISTS\s+)?([`"][^`"]+[`"](?:\.[`"][^`"]+[`"])?)', re.I)
+_re_identifier = re.compile(r'[`"]([^`"]+)[`"]')
+
+def _statement_objects(sql):
+  return [(m.group(1).upper(), _re_identifier.findall(m.group(2))[-1]) for m in _re_statement_object.finditer(sql)]
+
+def statement_objects(sql):
+  # every table and index a statement touches - statements sharing one must keep their relative order
+  return set(name for _, name in _statement_objects(sql))
+
+def statement_table(sql):
+  for keyword, name in _statement_objects(sql):
+    if keyword in ('TABLE', 'ON', 'INTO', 'UPDATE'):
+      return name
+  return None
+
+def classify_statement(sql):
+  s = sql.strip().upper()
+  if s.startswith('--'): return 'comment'
+  if s.startswith('CREATE TABLE') or s.startswith('DROP '): return 'metadata'
+  if s.startswith('CREATE INDEX') or s.startswith('CREATE UNIQUE INDEX'): return 'index'
+  if s.startswith('UPDATE '): return 'backfill'
+  if s.startswith('INSERT '): return 'rewrite'
+  if 'FOREIGN KEY' in s or 'SET NOT NULL' in s: return 'validate'
+  if ' TYPE ' in s or ' MODIFY ' in s or ' CHANGE ' in s or s.endswith(' SET LOGGED') or s.endswith(' SET UNLOGGED'): return 'rewrite'
+  if ' ENGINE=' in s or ' ROW_FORMAT=' in s or ' KEY_BLOCK_SIZE=' in s: return 'rewrite'
+  return 'metadata'
+
+def get_table_sizes(db, schema=None):
+  if is_postgres(db):
+    cursor = db.execute_sql('''
+      select c.relname, pg_total_relation_size(c.oid)
+      from pg_catalog.pg_class c
+      join pg_catalog.pg_namespace n on n.oid = c.relnamespace
+      where n.nspname = %s and c.relkind in ('r', 'p')
+    ''', (schema or 'public',))
+  elif is_mysql(db):
+    cursor = db.execute_sql('''
+      select table_name, coalesce(data_length,0) + coalesce(index_length,0)
+      from information_schema.tables
+      where table_schema = coalesce(%s, DATABASE())
+    ''', (schema,))
+  elif is_sqlite(db):
+    try:
+      cursor = db.execute_sql('select name, sum(pgsize) from dbstat group by name')
+    except pw.OperationalError:
+      # sqlite wasn't compiled w/ SQLITE_ENABLE_DBSTAT_VTAB
+      return {}
+  else:
+    return {}
+  return {unicode(name): int(size or 0) for name, size in cursor.fetchall()}
+
+def _past_timings(db):
+  if not _meta_table_exists(db, HISTORY_TABLE): return []
+  cursor = db.execute_sql('select kind, table_name, size_before, duration from %s where outcome = %s order by id' % (
+    _quote(db, HISTORY_TABLE), db.param
+  ), ['ok'])
+  return cursor.fetchall()
+
+def _deferred_sql(db):
+  if not _meta_table_exists(db, SCHEDULE_TABLE): return []
+  cursor = db.execute_sql('select sql from %s where status = %s' % (_quote(db, SCHEDULE_TABLE), db.param), ['deferred'])
+  return [row[0] for row in cursor.fetchall()]
+
+
+# Estimates how many seconds a statement will take from the size of the table it touches, preferring
+# what the same kind of statement actually took on this database before (from the history table).
+class CostEstimator(object):
+
+  def __init__(self, db, schema=None, sizes=None):
+    self.sizes = get_table_sizes(db, schema=schema) if sizes is None else sizes
+    self.rates = dict(DEFAULT_SECONDS_PER_MB)
+    self.last = {}
+    totals = collections.defaultdict(lambda: [0.0, 0.0])
+    for kind, table, size, duration in _past_timings(db):
+      self.last[(table, kind)] = (size or 0, duration)
+      if size and kind in self.rates:
+        totals[kind][0] += duration
+        totals[kind][1] += size / MB
+    for kind, (duration, mbs) in totals.items():
+      if kind != 'metadata' and mbs:
+        self.rates[kind] = duration / mbs
+
+  def __call__(self, sql):
+    kind = classify_statement(sql)
+    if kind == 'comment': return 0.0
+    table = statement_table(sql)
+    size = self.sizes.get(table, 0)
+    if (table, kind) in self.last:
+      past_size, past_duration = self.last[(table, kind)]
+      if past_size and size:
+        return past_duration * size / float(past_size)
+      return past_duration
+    return STATEMENT_OVERHEAD + self.rates.get(kind, 0.0) * size / MB
+
+
+def _schedule_units(sqls):
+  # the statements scheduled (and run, or deferred) together, as lists of indexes into sqls.  most are on their own,
+  # but a sqlite table rebuild - drop any old copy, create the copy, fill it, drop the table, rename the copy to it,
+  # recreate its indexes - has to happen whole: stop part way and the table (or its data) is gone.
+  units = []
+  i = 0
+  while i < len(sqls):
+    end = i
+    temp = statement_table(sqls[i])
+    if temp and temp.endswith('__tmp__') and re.match(r'\s*(CREATE|DROP)\s+TABLE\b', sqls[i], re.I):
+      table = temp[:-len('__tmp__')]
+      rename = next((k for k in range(i + 1, len(sqls)) if re.match(r'\s*ALTER\s+TABLE\b', sqls[k], re.I)
+                     and statement_table(sqls[k])==temp and statement_objects(sqls[k])==set([temp, table])), None)
+      if rename is not None:
+        end = rename
+        while end + 1 < len(sqls) and classify_statement(sqls[end + 1])=='index' and statement_table(sqls[end + 1])==table:
+          end += 1
+    units.append(list(range(i, end + 1)))
+    i = end + 1
+  return units
+
+# Picks the statements of to_run that fit in budget seconds, cheapest first, without ever running a
+# statement before one it depends on.  Returns a Schedule of the statements to run and those deferred.
+def schedule(db, to_run, budget, schema=None, estimator=None, margin=0.1):
+  sizes = get_table_sizes(db, schema=schema)
+  if estimator is None:
+    estimator = CostEstimator(db, schema=schema, sizes=sizes)
+  previously_deferred = set(_deferred_sql(db))
+
+  stmts = []
+  for stmt in to_run:
+    sql, params = stmt
+    table = statement_table(sql)
+    stmts.append(ScheduledStatement(sql, params, classify_statement(sql), table, sizes.get(table, 0), estimator(sql), stmt))
+
+  objects = [statement_objects(stmt.sql) for stmt in stmts]
+  # comments describe the statement that follows them
+  for i in reversed(range(len(stmts) - 1)):
+    if stmts[i].kind == 'comment':
+      objects[i] = objects[i + 1]
+  units = _schedule_units([stmt.sql for stmt in stmts])
+  objects = [set().union(*[objects[i] for i in unit]) for unit in units]
+
+  # a unit depends on every earlier unit touching the same table or index
+  waiting_on = [0] * len(units)
+  dependents = [[] for _ in units]
+  for u in range(len(units)):
+    for v in range(u):
+      if objects[u] & objects[v]:
+        waiting_on[u] += 1
+        dependents[v].append(u)
+
+  def priority(u):
+    return (sum(stmts[i].estimate for i in units[u]), stmts[units[u][0]].sql not in previously_deferred, u)
+
+  ready = [priority(u) for u in range(len(units)) if not waiting_on[u]]
+  heapq.heapify(ready)
+  available = budget * (1 - margin)
+  spent = 0.0
+  run = []
+  scheduled = set()
+  while ready:
+    estimate, _, u = heapq.heappop(ready)
+    if spent + estimate > available:
+      break
+    spent += estimate
+    run += [stmts[i] for i in units[u]]
+    scheduled.update(units[u])
+    for k in dependents[u]:
+      waiting_on[k] -= 1
+      if not waiting_on[k]:
+        heapq.heappush(ready, priority(k))
+  deferred = [stmt for i, stmt in enumerate(stmts) if i not in scheduled]
+  return Schedule(run, deferred)
+
+
+# Runs a Schedule against the clock.  Statements that no longer fit in the time remaining (or that Postgres
+# cancels with statement_timeout) are rolled back to their savepoint and deferred along with everything
+# depending on them, so the window's other work still commits.  Elsewhere nothing can stop a statement once
+# it's started, so the window stops at the first statement that doesn't fit.
+class MaintenanceWindow(object):
+
+  def __init__(self, db, plan, budget):
+    self.db = db
+    self.plan = plan
+    self.budget = budget
+    self.deadline = None
+    self.ran = []
+    self.deferred = list(plan.deferred)
+    self.blocked = set()
+    self.stopped = False
+    self.timeout = None
+    # a rebuild runs under one savepoint, and is deferred whole (see _schedule_units)
+    self.units = {}
+    for unit in _schedule_units([stmt.sql for stmt in plan.run]):
+      for i in unit:
+        self.units[i] = unit
+    self.unit = None
+
+  def open(self):
+    self.deadline = time.time() + self.budget
+
+  def run(self, i, sql, execute, in_transaction=True):
+    # in_transaction=False for the statements run after the plan's transaction commits (CREATE INDEX CONCURRENTLY)
+    unit = self.units.get(i, [i])
+    if i == unit[0]:
+      stmts = [self.plan.run[k] for k in unit]
+      remaining = self.deadline - time.time()
+      if self.stopped or any(statement_objects(stmt.sql) & self.blocked for stmt in stmts) or sum(stmt.estimate for stmt in stmts) > remaining:
+        if not is_postgres(self.db): self.stopped = True
+        return self._defer(unit)
+      savepoint = self.db.atomic() if in_transaction else None
+      if savepoint: savepoint.__enter__()
+      self.unit = (unit, savepoint, time.time())
+      self._limit(remaining, in_transaction)
+    elif self.unit is None or self.unit[0] is not unit:
+      # the rest of a unit that was deferred
+      return False
+    _, savepoint, start = self.unit
+    try:
+      execute()
+    except Exception as e:
+      self.unit = None
+      if savepoint: savepoint.__exit__(*sys.exc_info())
+      if not in_transaction: self._unlimit()
+      if 'statement timeout' not in str(e): raise
+      return self._defer(unit)
+    if i == unit[-1]:
+      self.unit = None
+      if savepoint: savepoint.__exit__(None, None, None)
+      if not in_transaction: self._unlimit()
+      self.ran += [(self.plan.run[k], time.time() - start) for k in unit]
+    return True
+
+  def _limit(self, remaining, in_transaction):
+    if not is_postgres(self.db): return
+    # SET LOCAL lasts until the plan's transaction ends, outside of one it's set (and put back) for the session
+    if not in_transaction:
+      self.timeout = self.db.execute_sql('SHOW statement_timeout').fetchone()[0]
+    self.db.execute_sql('SELECT set_config(%s, %s, %s)', ['statement_timeout', str(max(1, int(remaining * 1000))), in_transaction])
+
+  def _unlimit(self):
+    if not is_postgres(self.db): return
+    self.db.execute_sql('SELECT set_config(%s, %s, false)', ['statement_timeout', self.timeout])
+
+  def _defer(self, unit):
+    for k in unit:
+      self.blocked |= statement_objects(self.plan.run[k].sql)
+      self.deferred.append(self.plan.run[k])
+    return False
+
+  def close(self):
+    # at the end of the plan's transaction
+    if is_postgres(self.db) and self.db.in_transaction():
+      self.db.execute_sql('SET LOCAL statement_timeout TO DEFAULT')
+
+  def record(self):
+    # once the statements run after the transaction have had their turn too
+    with self.db.atomic():
+      _record_schedule(self.db, self.deferred)
+
+
+def _record_schedule(db, deferred):
+  # how long things took is in the history table - we only need to remember what's still to do
+  _create_meta_table(db, SCHEDULE_TABLE, SCHEDULE_COLUMNS)
+  db.execute_sql('DELETE FROM %s WHERE status = %s' % (_quote(db, SCHEDULE_TABLE), db.param), ['deferred'])
+  now = datetime.datetime.now()
+  for stmt in deferred:
+    _insert_meta_row(db, SCHEDULE_TABLE, [
+      ('sql', stmt.sql), ('params', json.dumps(list(stmt.params or []), default=unicode)), ('kind', stmt.kind),
+      ('table_name', stmt.table), ('relation_size', stmt.relation_size), ('estimate', stmt.estimate),
+      ('status', 'deferred'), ('created_at', now),
+    ])
+
+def print_deferred(deferred):
+  print()
+  print(colorama.Style.BRIGHT + colorama.Fore.YELLOW + "Deferring %i statement%s (~%is) to the next maintenance window:" % (
+    len(deferred), '' if len(deferred)==1 else 's', sum(stmt.estimate for stmt in deferred)
+  ) + colorama.Style.RESET_ALL)
+  for stmt in deferred:
+    print(colorama.Style.DIM + '  ~%.1fs ' % stmt.estimate + colorama.Style.RESET_ALL, end='')
+    print_sql(stmt.sql)
+
+
+
+###################
+# Fleets
+###################
+
+ShardResult = collections.namedtuple('ShardResult', ('shard', 'status', 'plan', 'plan_hash', 'error'))
+
+# The outcome of evolve_fleet(), per shard:  up_to_date, pending (planned but not applied - a dry run, or halted
+# after a failure), applied or failed.  groups maps each distinct plan's hash to the shards that share it.
+class FleetReport(object):
+
+  STATUSES = ('up_to_date', 'pending', 'applied', 'failed')
+
+  def __init__(self, results):
+    self.results = results
+    self.groups = collections.OrderedDict()
+    for result in results:
+      if result.plan:
+        self.groups.setdefault(result.plan_hash, []).append(result.shard)
+
+  def with_status(self, status):
+    return [result.shard for result in self.results if result.status==status]
+
+  up_to_date = property(lambda self: self.with_status('up_to_date'))
+  pending = property(lambda self: self.with_status('pending'))
+  applied = property(lambda self: self.with_status('applied'))
+  failed = property(lambda self: self.with_status('failed'))
+
+  @property
+  def ok(self):
+    return not self.failed
+
+  def report(self):
+    counts = collections.Counter(result.status for result in self.results)
+    lines = ['%i shards: %s' % (len(self.results), ', '.join('%i %s' % (counts[status], status) for status in self.STATUSES))]
+    results_by_shard = {_shard_label(result.shard): result for result in self.results}
+    for plan_hash, shards in self.groups.items():
+      plan = results_by_shard[_shard_label(shards[0])].plan
+      lines.append('')
+      lines.append('plan %s (%i statements) on %i shards: %s' % (plan_hash[:12], len(plan), len(shards), ', '.join(_shard_label(shard) for shard in shards)))
+    for result in self.results:
+      if result.status=='failed':
+        lines.append('')
+        lines.append('failed %s: %s' % (_shard_label(result.shard), result.error))
+    return '\n'.join(lines)
+
+def _shard_label(shard):
+  return unicode(shard.database if isinstance(shard, pw.Database) else shard)
+
+@contextlib.contextmanager
+def _shard_database(shard, factory):
+  # connections are per thread, so close whatever we opened on this one before handing the thread back to the pool
+  db = factory(shard) if factory else shard
+  was_closed = db.is_closed()
+  try:
+    yield db
+  finally:
+    if was_closed and not db.is_closed():
+      db.close()
+
+def evolve_fleet(shards, factory=None, models=None, ignore_tables=None, schema=None, workers=8, canary=1, wave_size=10, dry_run=False, diff_defaults=None, **kwargs):
+  # Plans every shard concurrently (workers threads), then applies the plans in waves: canary shards first, then
+  # wave_size at a time, stopping at the first wave with a failure.  shards are databases, or anything factory turns
+  # into one (a path, a DSN...) so that thousands of them needn't all be open at once.  kwargs go on to evolve().
+  if factory and models is None:
+    # the databases factory makes aren't the ones any model is bound to, so nothing would say what belongs on them
+    raise Exception("evolve_fleet() needs models when shards are made by a factory")
+  options = dict(ignore_tables=ignore_tables, schema=schema, models=models, diff_defaults=diff_defaults)
+
+  def plan(shard):
+    try:
+      with _shard_database(shard, factory) as db:
+        to_run = Evolver(db, **options).calc_changes()
+    except Exception as e:
+      return ShardResult(shard, 'failed', None, None, unicode(e))
+    if not to_run:
+      return ShardResult(shard, 'up_to_date', [], None, None)
+    return ShardResult(shard, 'pending', to_run, hash_plan(to_run), None)
+
+  def apply(result):
+    try:
+      with _shard_database(result.shard, factory) as db:
+        Evolver(db, **options).evolve(interactive=False, **kwargs)
+    except Exception as e:
+      return result._replace(status='failed', error=unicode(e))
+    return result._replace(status='applied')
+
+  pool = multiprocessing.pool.ThreadPool(max(1, workers))
+  try:
+    results = pool.map(plan, list(shards))
+    pending = [i for i, result in enumerate(results) if result.status=='pending']
+    if not dry_run and pending:
+      waves = [pending[:canary]] if canary else []
+      rest = pending[canary:] if canary else pending
+      waves += [rest[i:i+wave_size] for i in range(0, len(rest), max(1, wave_size))]
+      for wave in waves:
+        for i, result in zip(wave, pool.map(apply, [results[i] for i in wave])):
+          results[i] = result
+        if any(results[i].status=='failed' for i in wave):
+          break
+  finally:
+    pool.close()
+    pool.join()
+  return FleetReport(results)
+
+class _StepTracker(object):
+  # stands in for a Journal, just to find out which statement of a batch failed
+  def __init__(self):
+    self.failed = None
+  def open(self): pass
+  def mark(self, i, status, duration=None, error=None):
+    if status=='failed': self.failed = i
+
+def evolve_schemas(db, schemas, interactive=True, ignore_tables=None, models=None, diff_defaults=None, batch_size=50, throttle=None, index_foreign_keys=None, skip_redundant_indexes=None):
+  # Evolves many (postgres) schemas with the same models - schema-per-tenant - from one introspection pass.  Each
+  # schema's plan runs unqualified under its own search_path, batch_size schemas to a transaction, stopping at the
+  # first batch that fails.  Returns a FleetReport keyed by schema.
+  plans = calc_changes_by_schema(
+    db, schemas, ignore_tables=ignore_tables, models=models, diff_defaults=diff_defaults,
+    index_foreign_keys=index_foreign_keys, skip_redundant_indexes=skip_redundant_indexes,
+  )
+  results = [
+    ShardResult(schema, 'pending', to_run, hash_plan(to_run), None) if to_run else ShardResult(schema, 'up_to_date', [], None, None)
+    for schema, to_run in plans.items()
+  ]
+  report = FleetReport(results)
+  pending = [i for i, result in enumerate(results) if result.status=='pending']
+  if not pending:
+    if interactive:
+      print('Nothing to do... All %i schemas are up to date!' % len(results))
+    return report
+
+  commit = True
+  if interactive:
+    preview = []
+    for plan_hash, group in report.groups.items():
+      preview.append(('-- %i schema%s: %s' % (len(group), '' if len(group)==1 else 's', ', '.join(group)), []))
+      preview += plans[group[0]]
+    commit = _confirm(db, preview)
+
+  # each tenant's schema goes in front of the usual search_path rather than replacing it, so types and functions from
+  # extensions installed in public (hstore, citext, uuid-ossp...) still resolve
+  search_path = db.execute_sql('SHOW search_path').fetchone()[0].strip()
+  batch_size = max(1, batch_size)
+  for start in range(0, len(pending), batch_size):
+    batch = pending[start:start+batch_size]
+    to_run, schema_at_step = [], []
+    for i in batch:
+      path = ', '.join([_quote(db, results[i].shard)] + ([search_path] if search_path else []))
+      statements = [('SET LOCAL search_path TO %s' % path, [])] + list(results[i].plan)
+      to_run += statements
+      schema_at_step += [i] * len(statements)
+    tracker = _StepTracker()
+    try:
+      _execute(db, to_run, interactive=interactive, commit=commit, throttle=throttle, journal=tracker)
+    except Exception as e:
+      failed = schema_at_step[tracker.failed] if tracker.failed is not None else batch[0]
+      results[failed] = results[failed]._replace(status='failed', error=unicode(e))
+      break
+    if commit:
+      for i in batch:
+        results[i] = results[i]._replace(status='applied')
+  return FleetReport(results)
+
+
+###################
+# Test databases
+###################
+
+def models_fingerprint(models):
+  # changes whenever evolving the models could produce a different schema (or a new peeweedbevolve could)
+  fingerprints = sorted(repr(_model_fingerprint(model)) for model in models)
+  return hashlib.sha1(json.dumps([__version__] + fingerprints).encode('utf8')).hexdigest()
+
+# Evolves a template database once per model fingerprint, then copies it for each test - CREATE DATABASE ... TEMPLATE
+# on postgres, a file copy or the backup API (for :memory:) on sqlite.  A template whose models have changed is
+# rebuilt under a new name, and the stale one dropped.  setup(db) runs on a new template before it's evolved (to
+# create extensions, say) - it isn't part of the fingerprint, so pass a different prefix if it changes.
+class DatabaseTemplate(object):
+
+  def __init__(self, db, models=None, ignore_tables=None, setup=None, prefix=None, directory=None):
+    self.db = db
+    self._models = models
+    self.ignore_tables = ignore_tables
+    self.setup = setup
+    self.directory = directory or tempfile.gettempdir()
+    if prefix is None:
+      prefix = db.database if not is_sqlite(db) else 'peeweedbevolve' if db.database==':memory:' else os.path.splitext(os.path.basename(db.database))[0]
+    self.prefix = '%s_template_' % prefix
+
+  @property
+  def models(self):
+    return self._models if self._models is not None else models_for(self.db)
+
+  @property
+  def fingerprint(self):
+    return models_fingerprint(self.models)
+
+  def _evolve(self, template_db):
+    if self.setup: self.setup(template_db)
+    Evolver(template_db, models=self.models, ignore_tables=self.ignore_tables).evolve(interactive=False, history=False)
+
+  def template(self):
+    # the template's name (a path on sqlite), building it first if need be
+    if is_postgres(self.db): return self._postgres_template()
+    if is_sqlite(self.db): return self._sqlite_template()
+    raise Exception("don't know how to clone databases in %s" % self.db)
+
+  def clone(self, db=None):
+    # replaces db (by default the one the template was made for) with a fresh copy of the template, and returns it
+    db = db or self.db
+    template = self.template()
+    if is_postgres(db):
+      db.close()
+      if hasattr(db, 'close_all'): db.close_all() # pooled connections would keep the database busy
+      with self._maintenance() as maintenance:
+        maintenance.execute_sql('DROP DATABASE IF EXISTS %s' % _quote(db, db.database))
+        maintenance.execute_sql('CREATE DATABASE %s TEMPLATE %s' % (_quote(db, db.database), _quote(db, template)))
+    elif is_sqlite(db):
+      if db.database == ':memory:':
+        import sqlite3
+        source = sqlite3.connect(template)
+        try:
+          source.backup(db.connection())
+        finally:
+          source.close()
+      else:
+        db.close()
+        shutil.copyfile(template, db.database)
+    else:
+      raise Exception("don't know how to clone databases in %s" % db)
+    return db
+
+  def drop(self):
+    # drops every template with this prefix, current or not
+    if is_postgres(self.db):
+      with self._maintenance() as maintenance:
+        for name in self._postgres_templates(maintenance):
+          maintenance.execute_sql('DROP DATABASE IF EXISTS %s' % _quote(self.db, name))
+    elif is_sqlite(self.db):
+      for name in self._sqlite_templates():
+        os.remove(os.path.join(self.directory, name))
+
+  @contextlib.contextmanager
+  def _maintenance(self):
+    # CREATE / DROP DATABASE can't be run from the database being replaced
+    maintenance = pw.PostgresqlDatabase('postgres', **self.db.connect_params)
+    maintenance.connect()
+    try:
+      yield maintenance
+    finally:
+      maintenance.close()
+
+  def _postgres_templates(self, maintenance):
+    cursor = maintenance.execute_sql('SELECT datname FROM pg_database')
+    return [row[0] for row in cursor.fetchall() if row[0].startswith(self.prefix)]
+
+  def _postgres_template(self):
+    name = self.prefix + self.fingerprint[:16]
+    with self._maintenance() as maintenance:
+      # other test processes wait here rather than building the same template
+      maintenance.execute_sql('SELECT pg_advisory_lock(hashtext(%s))', [self.prefix])
+      try:
+        existing = self._postgres_templates(maintenance)
+        if name in existing: return name
+        for stale in existing:
+          try:
+            maintenance.execute_sql('DROP DATABASE IF EXISTS %s' % _quote(self.db, stale))
+          except pw.DatabaseError:
+            pass # still in use somewhere, leave it for next time
+        # built under another name, so a half evolved template is never cloned
+        building = name + '_building'
+        maintenance.execute_sql('DROP DATABASE IF EXISTS %s' % _quote(self.db, building))
+        maintenance.execute_sql('CREATE DATABASE %s' % _quote(self.db, building))
+        template_db = type(self.db)(building, **self.db.connect_params)
+        try:
+          self._evolve(template_db)
+        finally:
+          template_db.close()
+        maintenance.execute_sql('ALTER DATABASE %s RENAME TO %s' % (_quote(self.db, building), _quote(self.db, name)))
+        return name
+      finally:
+        maintenance.execute_sql('SELECT pg_advisory_unlock(hashtext(%s))', [self.prefix])
+
+  def _sqlite_templates(self):
+    return [name for name in os.listdir(self.directory) if name.startswith(self.prefix) and name.endswith('.db')]
+
+  def _sqlite_template(self):
+    name = '%s%s.db' % (self.prefix, self.fingerprint[:16])
+    path = os.path.join(self.directory, name)
+    if os.path.exists(path): return path
+    for stale in self._sqlite_templates():
+      try:
+        os.remove(os.path.join(self.directory, stale))
+      except OSError:
+        pass
+    # built under a temporary name and renamed into place, so a half evolved template is never cloned
+    fd, building = tempfile.mkstemp(prefix=self.prefix, suffix='.building', dir=self.directory)
+    os.close(fd)
+    template_db = type(self.db)(building)
+    try:
+      self._evolve(template_db)
+    finally:
+      template_db.close()
+    os.rename(building, path)
+    return path
+
+
 
 all_models = {}
 ignore_tables = set()
+# (database, schema) -> {model: None}, so evolving one database doesn't have to look at every other's models
+models_by_database = collections.defaultdict(dict)
+
+def _registry_key(model):
+  return (model._meta.database, getattr(model._meta, 'schema', None))
 
 def register(model):
   if model.__module__=='playhouse.sqlite_ext':
@@ -860,13 +3495,87 @@ def register(model):
     ignore_tables.add(_table_name(model))
   else:
     all_models[model] = []
+    models_by_database[_registry_key(model)][model] = None
 
 def unregister(model):
   del all_models[model]
+  _unindex(model)
+
+def _unindex(model):
+  for key, models in list(models_by_database.items()):
+    if model in models:
+      del models[model]
+      if not models: del models_by_database[key]
+
+def _reindex(model):
+  if model in all_models:
+    _unindex(model)
+    models_by_database[_registry_key(model)][model] = None
 
 def clear():
   all_models.clear()
   ignore_tables.clear()
+  models_by_database.clear()
+
+def models_for(db, schema=None):
+  # the models bound to db (directly or through a proxy) in schema, plus any not bound to a database at all.
+  # models without a schema (or evolves without one) match any schema, as they always have.  if no model is bound to
+  # db (a connection opened apart from the models' own, say) it's every registered model, as it was before models
+  # were told apart by database - planning without them would drop every table.
+  models, others, bound = [], [], False
+  for (database, model_schema), registered in list(models_by_database.items()):
+    if schema and model_schema and model_schema != schema: continue
+    if database is None:
+      models.extend(registered)
+    elif database is db or (isinstance(database, pw.Proxy) and database.obj is db):
+      models.extend(registered)
+      bound = True
+    else:
+      others.extend(registered)
+  return models if bound else models + others
+
+class Evolver(object):
+  # a model registry and options of its own, so a service can plan (or evolve) many databases from many threads at
+  # once.  planning doesn't touch the global registry, or mutate the models, their fields or the database object.
+
+  def __init__(self, db, models=None, ignore_tables=None, schema=None, diff_defaults=None, index_foreign_keys=None, skip_redundant_indexes=None):
+    self.db = db
+    self.schema = schema
+    self.diff_defaults = DIFF_DEFAULTS if diff_defaults is None else diff_defaults
+    self.index_foreign_keys = INDEX_FOREIGN_KEYS if index_foreign_keys is None else index_foreign_keys
+    self.skip_redundant_indexes = SKIP_REDUNDANT_INDEXES if skip_redundant_indexes is None else skip_redundant_indexes
+    self.models = collections.OrderedDict()
+    self.ignore_tables = set(ignore_tables or [])
+    if models is None:
+      # start from what the global registry has for this database
+      models = models_for(db, schema=schema)
+      self.ignore_tables |= globals()['ignore_tables']
+    for model in models:
+      self.register(model)
+
+  def register(self, model):
+    if hasattr(model._meta, 'evolve') and not model._meta.evolve:
+      self.ignore_tables.add(_table_name(model))
+    else:
+      self.models[model] = None
+
+  def unregister(self, model):
+    del self.models[model]
+
+  def _options(self):
+    return dict(
+      ignore_tables=self.ignore_tables, schema=self.schema, models=list(self.models), diff_defaults=self.diff_defaults,
+      index_foreign_keys=self.index_foreign_keys, skip_redundant_indexes=self.skip_redundant_indexes,
+    )
+
+  def calc_changes(self):
+    return calc_changes(self.db, **self._options())
+
+  def evolve(self, **kwargs):
+    return evolve(self.db, **dict(self._options(), **kwargs))
+
+  def resume(self, **kwargs):
+    return resume(self.db, **dict(self._options(), **kwargs))
 
 def _add_model_hook():
   ModelBase = pw.BaseModel if hasattr(pw, 'BaseModel') else pw.ModelBase
@@ -880,6 +3589,15 @@ def _add_model_hook():
     init(*args, **kwargs)
   ModelBase.__init__ = _init
 
+def _add_rebind_hook():
+  # Model.bind() and friends move a model to another database, so move it in the registry too
+  if not hasattr(pw, 'Metadata'): return
+  set_database = pw.Metadata.set_database
+  def _set_database(self, database):
+    set_database(self, database)
+    _reindex(self.model)
+  pw.Metadata.set_database = _set_database
+
 def _add_field_hook():
   init = pw.Field.__init__
   def _init(*args, **kwargs):
@@ -890,6 +3608,9 @@ def _add_field_hook():
         akas = [akas]
       self.akas = akas
       del kwargs['aka']
+    for option in COLUMN_OPTIONS:
+      if option in kwargs:
+        setattr(self, option, _check_column_option(option, kwargs.pop(option)))
     init(*args, **kwargs)
   pw.Field.__init__ = _init
 
@@ -908,6 +3629,7 @@ def add_evolve():
 
 if 'pw' in globals():
   _add_model_hook()
+  _add_rebind_hook()
   _add_field_hook()
   _add_fake_fk_field_hook()
   add_evolve()
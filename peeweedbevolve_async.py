@@ -0,0 +1,68 @@
+import asyncio, functools
+
+import peeweedbevolve
+
+
+# asyncio entry points for peeweedbevolve, so evolving at startup doesn't block the event loop.
+#
+#   to_run = await peeweedbevolve_async.calc_changes_async(db)
+#   await peeweedbevolve_async.evolve_async(db, interactive=False)
+#   await peeweedbevolve_async.evolve_all_async([db1, db2, db3], interactive=False)
+#
+# peewee is synchronous, so the catalog queries and statements run on an executor (the loop's default thread pool
+# unless you pass your own), each call on that thread's own connection.  the catalog queries that don't depend on each
+# other run concurrently, as do evolves of different databases.  the statements of one evolve all run on one thread,
+# in one transaction, just like evolve().  don't use it with in-memory sqlite databases - every thread gets its own.
+
+
+def _on_own_connection(db, fn, *args, **kwargs):
+  # peewee connections are per thread, so close whatever fn opened on the executor's thread once it's done
+  was_closed = db.is_closed()
+  try:
+    return fn(*args, **kwargs)
+  finally:
+    if was_closed and not db.is_closed():
+      db.close()
+
+def _run(db, executor, fn, *args, **kwargs):
+  loop = asyncio.get_running_loop()
+  return loop.run_in_executor(executor, functools.partial(_on_own_connection, db, fn, *args, **kwargs))
+
+def _get_indexes_by_table(db, tables, schema=None):
+  # every table's indexes in one job, on one connection - not a job (and a connection opened and closed) per table
+  return {table: peeweedbevolve.get_indexes_by_table(db, table, schema=schema) for table in tables}
+
+
+async def introspect_async(db, schema=None, executor=None):
+  tables = await _run(db, executor, peeweedbevolve.get_tables, db, schema=schema)
+  results = await asyncio.gather(
+    _run(db, executor, peeweedbevolve.get_columns_by_table, db, schema=schema),
+    _run(db, executor, peeweedbevolve.get_foreign_keys_by_table, db, schema=schema),
+    _run(db, executor, peeweedbevolve.get_partitions_by_table, db, schema=schema),
+    _run(db, executor, peeweedbevolve.get_table_options_by_table, db, schema=schema),
+    _run(db, executor, _get_indexes_by_table, db, tables, schema=schema),
+  )
+  columns_by_table, foreign_keys_by_table, partitions_by_table, table_options_by_table, indexes_by_table = results
+  return peeweedbevolve.Introspection(
+    tables, indexes_by_table, columns_by_table, foreign_keys_by_table, partitions_by_table, table_options_by_table,
+  )
+
+async def calc_changes_async(db, ignore_tables=None, schema=None, models=None, diff_defaults=None, index_foreign_keys=None, skip_redundant_indexes=None, executor=None):
+  introspection = await introspect_async(db, schema=schema, executor=executor)
+  return await _run(
+    db, executor, peeweedbevolve.calc_changes, db,
+    ignore_tables=ignore_tables, schema=schema, models=models, diff_defaults=diff_defaults, introspection=introspection,
+    index_foreign_keys=index_foreign_keys, skip_redundant_indexes=skip_redundant_indexes,
+  )
+
+async def evolve_async(db, interactive=True, ignore_tables=None, schema=None, models=None, diff_defaults=None, index_foreign_keys=None, skip_redundant_indexes=None, executor=None, **kwargs):
+  # kwargs (budget, throttle, journal, history) go on to evolve()
+  introspection = await introspect_async(db, schema=schema, executor=executor)
+  return await _run(
+    db, executor, peeweedbevolve.evolve, db, interactive=interactive,
+    ignore_tables=ignore_tables, schema=schema, models=models, diff_defaults=diff_defaults, introspection=introspection,
+    index_foreign_keys=index_foreign_keys, skip_redundant_indexes=skip_redundant_indexes, **kwargs
+  )
+
+async def evolve_all_async(databases, **kwargs):
+  return await asyncio.gather(*[evolve_async(db, **kwargs) for db in databases])
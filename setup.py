@@ -20,7 +20,7 @@ setup(
   author_email='public@kered.org',
   url='https://github.com/keredson/peewee-db-evolve',
   packages=[],
-  py_modules=['peeweedbevolve'],
+  py_modules=['peeweedbevolve', 'peeweedbevolve_async'],
   classifiers=[
     'Development Status :: 5 - Production/Stable',
     'Intended Audience :: Developers',
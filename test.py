@@ -1,4 +1,4 @@
-import datetime, decimal, os, unittest
+import datetime, decimal, os, tempfile, threading, unittest
 import peewee as pw
 import playhouse.postgres_ext as pwe
 import peeweedbevolve
@@ -506,6 +506,189 @@ class PostgreSQL(unittest.TestCase):
     self.evolve_and_check_noop()
     self.assertEqual(sorted(peeweedbevolve.normalize_indexes(peeweedbevolve.get_indexes_by_table(self.db,'somemodel'))), [(u'somemodel', (u'id',), True), (u'somemodel', (u'some_field',u'id'), False)])
 
+  def test_partial_expression_and_method_indexes(self):
+    def define(status):
+      class SomeModel(pw.Model):
+        email = pw.CharField()
+        status = pw.CharField()
+        tags = pwe.BinaryJSONField(null=True, index=True)
+        class Meta:
+          database = self.db
+      SomeModel.add_index(SomeModel.index(pw.fn.lower(SomeModel.email), unique=True, where=(SomeModel.status == status), name='somemodel_lower_email'))
+      SomeModel.add_index(SomeModel.index(SomeModel.status.desc(), name='somemodel_status_desc'))
+      SomeModel.add_index(pw.ModelIndex(SomeModel, (SomeModel.status,), using='hash', name='somemodel_status_hash'))
+      return SomeModel
+    define('active')
+    self.evolve_and_check_noop()
+    peeweedbevolve.clear()
+    define('pending')
+    to_run = peeweedbevolve.calc_changes(self.db)
+    self.assertEqual([sql.split()[0] for sql, params in to_run], ['DROP', 'CREATE'])
+    self.evolve_and_check_noop()
+
+  def test_covering_index(self):
+    def define(include):
+      class SomeModel(pw.Model):
+        customer = pw.IntegerField()
+        total = pw.IntegerField(null=True)
+        status = pw.CharField(null=True)
+        class Meta:
+          database = self.db
+      SomeModel.add_index(peeweedbevolve.CoveringIndex(SomeModel, (SomeModel.customer,), include=include))
+    define(('total', 'status'))
+    self.evolve_and_check_noop()
+    peeweedbevolve.clear()
+    define(('status', 'total'))
+    self.check_noop()
+    peeweedbevolve.clear()
+    define(('total',))
+    to_run = peeweedbevolve.calc_changes(self.db)
+    self.assertEqual([sql.split()[0] for sql, params in to_run], ['DROP', 'CREATE'])
+    self.evolve_and_check_noop()
+
+  def test_index_foreign_keys(self):
+    class Parent(pw.Model):
+      class Meta:
+        database = self.db
+    class Child(pw.Model):
+      parent = foreign_key(Parent, null=True, index=False)
+      class Meta:
+        database = self.db
+    self.evolve_and_check_noop()
+    self.assertEqual([(fk.table, fk.column, fk.references) for fk in peeweedbevolve.unindexed_foreign_keys(self.db)], [('child', 'parent_id', 'parent')])
+    to_run = peeweedbevolve.calc_changes(self.db, index_foreign_keys=True)
+    self.assertEqual([sql.split()[:3] for sql, params in to_run], [['CREATE', 'INDEX', 'CONCURRENTLY']])
+    self.db.evolve(interactive=INTERACTIVE, index_foreign_keys=True)
+    self.assertEqual(peeweedbevolve.calc_changes(self.db, index_foreign_keys=True), [])
+    self.assertEqual(peeweedbevolve.unindexed_foreign_keys(self.db), [])
+
+  def test_redundant_indexes(self):
+    class SomeModel(pw.Model):
+      some_field = pw.IntegerField(index=True)
+      other_field = pw.IntegerField()
+      class Meta:
+        database = self.db
+        indexes = ((('some_field', 'other_field'), False),)
+    to_run = peeweedbevolve.calc_changes(self.db, skip_redundant_indexes=True)
+    self.assertEqual(len([sql for sql, params in to_run if 'INDEX' in sql]), 1)
+    self.db.evolve(interactive=INTERACTIVE, skip_redundant_indexes=True)
+    self.assertEqual(peeweedbevolve.calc_changes(self.db, skip_redundant_indexes=True), [])
+    redundant = peeweedbevolve.redundant_indexes(self.db)
+    self.assertEqual([(r.name, r.covered_by, r.reason, r.exists) for r in redundant], [('somemodel_some_field', 'somemodel_some_field_other_field', 'prefix', False)])
+    self.evolve_and_check_noop()
+    redundant = peeweedbevolve.redundant_indexes(self.db)
+    self.assertEqual([(r.name, r.reason, r.exists) for r in redundant], [('somemodel_some_field', 'prefix', True)])
+    self.assertTrue(redundant[0].size > 0)
+
+  def test_index_usage(self):
+    class SomeModel(pw.Model):
+      some_field = pw.IntegerField(index=True)
+      class Meta:
+        database = self.db
+    self.evolve_and_check_noop()
+    usage = peeweedbevolve.index_usage(self.db)[('somemodel', 'somemodel_some_field')]
+    self.assertEqual(usage.scans, 0)
+    self.assertTrue(usage.size > 0)
+    peeweedbevolve.clear()
+    class SomeModel(pw.Model):
+      some_field = pw.IntegerField()
+      class Meta:
+        database = self.db
+    to_run = peeweedbevolve.annotate_index_usage(self.db, peeweedbevolve.calc_changes(self.db))
+    self.assertEqual(len(to_run), 2)
+    self.assertTrue(to_run[0][0].startswith('-- dropping index somemodel_some_field on somemodel: never used'))
+    self.evolve_and_check_noop()
+
+  def test_partitioned_table(self):
+    class Event(pw.Model):
+      created_at = pw.DateField()
+      name = pw.CharField(null=True, index=True)
+      class Meta:
+        database = self.db
+        primary_key = False
+        partition_by = peeweedbevolve.Partitioning('range', 'created_at', interval='month', ahead=2)
+    self.evolve_and_check_noop()
+    self.assertEqual(peeweedbevolve.get_tables(self.db), ['event'])
+    partitions = peeweedbevolve.get_partitions_by_table(self.db)['event'].partitions
+    this_month = datetime.date.today().replace(day=1)
+    self.assertEqual(len(partitions), 3)
+    self.assertTrue('event_p%s' % this_month.strftime('%Y_%m') in partitions)
+    Event.create(created_at=datetime.date.today(), name='woot')
+    self.assertEqual(Event.select().where(Event.name=='woot').count(), 1)
+    self.db.execute_sql('ALTER TABLE "event" DETACH PARTITION "event_p%s"' % this_month.strftime('%Y_%m'))
+    to_run = peeweedbevolve.calc_changes(self.db)
+    self.assertEqual([sql.split()[:3] for sql, params in to_run], [['CREATE', 'TABLE', 'IF']])
+    self.db.execute_sql('DROP TABLE "event_p%s"' % this_month.strftime('%Y_%m'))
+    self.evolve_and_check_noop()
+
+  def test_hash_partitioned_table(self):
+    class Account(pw.Model):
+      account_id = pw.IntegerField()
+      class Meta:
+        database = self.db
+        primary_key = False
+        partition_by = peeweedbevolve.Partitioning('hash', 'account_id', partitions=4)
+    self.evolve_and_check_noop()
+    self.assertEqual(len(peeweedbevolve.get_partitions_by_table(self.db)['account'].partitions), 4)
+    for i in range(10):
+      Account.create(account_id=i)
+    self.assertEqual(Account.select().count(), 10)
+
+  def test_storage_parameters(self):
+    class SomeModel(pw.Model):
+      some_field = pw.TextField(null=True)
+      class Meta:
+        database = self.db
+        storage_parameters = {'fillfactor': 70, 'toast.autovacuum_enabled': False}
+        unlogged = True
+    self.evolve_and_check_noop()
+    options = peeweedbevolve.get_table_options_by_table(self.db)['somemodel']
+    self.assertEqual((options['fillfactor'], options['toast.autovacuum_enabled'], options['unlogged']), ('70', 'false', True))
+    peeweedbevolve.clear()
+    class SomeModel(pw.Model):
+      some_field = pw.TextField(null=True)
+      class Meta:
+        database = self.db
+        storage_parameters = {'fillfactor': 90}
+        unlogged = False
+    to_run = peeweedbevolve.calc_changes(self.db)
+    self.assertEqual([sql for sql, params in to_run], [
+      'ALTER TABLE "somemodel" SET (fillfactor = 90)', 'ALTER TABLE "somemodel" RESET (toast.autovacuum_enabled)', 'ALTER TABLE "somemodel" SET LOGGED',
+    ])
+    self.evolve_and_check_noop()
+    peeweedbevolve.clear()
+    class SomeModel(pw.Model):
+      some_field = pw.TextField(null=True)
+      class Meta:
+        database = self.db
+    self.check_noop()
+
+  def test_column_options(self):
+    class SomeModel(pw.Model):
+      body = pw.TextField(null=True, storage='external')
+      status = pw.CharField(null=True, statistics=1000)
+      class Meta:
+        database = self.db
+    self.evolve_and_check_noop()
+    options = peeweedbevolve.get_column_options_by_table(self.db, ['somemodel'])['somemodel']
+    self.assertEqual((options['body']['storage'], options['status']['statistics']), ('e', 1000))
+    peeweedbevolve.clear()
+    class SomeModel(pw.Model):
+      body = pw.TextField(null=True, storage='main')
+      status = pw.CharField(null=True, statistics=-1)
+      class Meta:
+        database = self.db
+    to_run = peeweedbevolve.calc_changes(self.db)
+    self.assertEqual([sql for sql, params in to_run], ['ALTER TABLE "somemodel" ALTER COLUMN "body" SET STORAGE MAIN, ALTER COLUMN "status" SET STATISTICS -1'])
+    self.evolve_and_check_noop()
+    peeweedbevolve.clear()
+    class SomeModel(pw.Model):
+      body = pw.TextField(null=True)
+      status = pw.CharField(null=True)
+      class Meta:
+        database = self.db
+    self.check_noop()
+
   def test_change_integer_to_fake_fk_column(self):
     class Person(pw.Model):
       class Meta:
@@ -742,6 +925,327 @@ class PostgreSQL(unittest.TestCase):
     peeweedbevolve.clear()
     self.assertEqual(peeweedbevolve.calc_changes(self.db, ignore_tables=['somemodel']), [])
 
+  def test_models_for_other_databases_ignored(self):
+    other = pw.SqliteDatabase(':memory:')
+    class SomeModel(pw.Model):
+      some_field = pw.CharField(null=True)
+      class Meta:
+        database = self.db
+    class OtherModel(pw.Model):
+      some_field = pw.CharField(null=True)
+      class Meta:
+        database = other
+    self.assertEqual(peeweedbevolve.models_for(self.db), [SomeModel])
+    self.evolve_and_check_noop()
+    self.assertNotIn('othermodel', self.db.get_tables())
+    OtherModel.bind(self.db)
+    # nothing's bound to other now, so it gets every model - as evolving an unknown database always has
+    self.assertEqual(peeweedbevolve.models_for(other), [SomeModel, OtherModel])
+    self.evolve_and_check_noop()
+    self.assertIn('othermodel', self.db.get_tables())
+
+  def test_models_for_proxy(self):
+    proxy = pw.DatabaseProxy() if hasattr(pw, 'DatabaseProxy') else pw.Proxy()
+    class SomeModel(pw.Model):
+      some_field = pw.CharField(null=True)
+      class Meta:
+        database = proxy
+    class OtherModel(pw.Model):
+      some_field = pw.CharField(null=True)
+      class Meta:
+        database = self.db
+    self.assertEqual(peeweedbevolve.models_for(self.db), [OtherModel])
+    proxy.initialize(self.db)
+    self.assertEqual(peeweedbevolve.models_for(self.db), [SomeModel, OtherModel])
+    self.evolve_and_check_noop()
+
+  def test_evolver(self):
+    class SomeModel(pw.Model):
+      some_field = pw.CharField(null=True)
+      class Meta:
+        database = self.db
+    class OtherModel(pw.Model):
+      some_model = foreign_key(SomeModel)
+      class Meta:
+        database = self.db
+    evolver = peeweedbevolve.Evolver(self.db, models=[SomeModel])
+    evolver.evolve(interactive=INTERACTIVE)
+    self.assertEqual(evolver.calc_changes(), [])
+    self.assertNotIn('othermodel', self.db.get_tables())
+    evolver.register(OtherModel)
+    evolver.evolve(interactive=INTERACTIVE)
+    self.assertEqual(evolver.calc_changes(), [])
+    self.check_noop()
+    if PW3: self.assertFalse(OtherModel.some_model.deferred)
+
+  def test_evolver_threads(self):
+    class SomeModel(pw.Model):
+      some_field = pw.CharField(null=True)
+      class Meta:
+        database = self.db
+    class OtherModel(pw.Model):
+      some_model = foreign_key(SomeModel)
+      class Meta:
+        database = self.db
+    plans = []
+    def plan():
+      plans.append(peeweedbevolve.Evolver(self.db).calc_changes())
+      self.db.close()
+    threads = [threading.Thread(target=plan) for i in range(8)]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    self.assertEqual(len(plans), 8)
+    self.assertTrue(all(p==plans[0] for p in plans))
+    self.assertEqual(plans[0], peeweedbevolve.calc_changes(self.db))
+
+  def test_evolver_threads_add_column(self):
+    # one thread adds the column while another plans the table from scratch - which mustn't see it made nullable
+    self.db.execute_sql('create schema other')
+    self.db.execute_sql('create table somemodel (id serial primary key)')
+    adding, created = threading.Event(), threading.Event()
+    class PausingField(pw.CharField):
+      def ddl(self, ctx):
+        if threading.current_thread().name == 'adder':
+          adding.set()
+          created.wait(5)
+        return super(PausingField, self).ddl(ctx)
+    class SomeModel(pw.Model):
+      some_field = PausingField(default='woot')
+      class Meta:
+        database = self.db
+    plans = {}
+    def add():
+      plans['add'] = peeweedbevolve.Evolver(self.db).calc_changes()
+      self.db.close()
+    thread = threading.Thread(target=add, name='adder')
+    thread.start()
+    adding.wait(5)
+    to_run = peeweedbevolve.Evolver(self.db, schema='other').calc_changes()
+    created.set()
+    thread.join()
+    self.assertIn('"some_field" VARCHAR(255) NOT NULL', to_run[0][0])
+    self.assertEqual(plans['add'], peeweedbevolve.calc_changes(self.db))
+
+  def test_sql_cache(self):
+    peeweedbevolve.sql_cache.clear()
+    class SomeModel(pw.Model):
+      some_field = pw.CharField(null=True)
+      class Meta:
+        database = self.db
+    to_run = peeweedbevolve.calc_changes(self.db)
+    self.assertEqual(peeweedbevolve.sql_cache.hits, 0)
+    self.assertEqual(peeweedbevolve.calc_changes(self.db), to_run)
+    self.assertEqual(peeweedbevolve.sql_cache.hits, len(to_run))
+    peeweedbevolve.clear()
+    class SomeModel(pw.Model):
+      some_field = pw.CharField(null=True, max_length=10)
+      class Meta:
+        database = self.db
+    self.assertNotEqual(peeweedbevolve.calc_changes(self.db), to_run)
+    self.evolve_and_check_noop()
+    SomeModel.create(some_field='woot')
+    self.assertEqual(SomeModel.select().first().some_field, 'woot')
+
+  def test_evolve_schemas(self):
+    schemas = ['tenant_a', 'tenant_b', 'tenant_c']
+    for schema in schemas:
+      self.db.execute_sql('create schema %s' % schema)
+    class SomeModel(pw.Model):
+      some_field = pw.CharField(null=True)
+      class Meta:
+        database = self.db
+    report = peeweedbevolve.evolve_schemas(self.db, schemas[2:], interactive=INTERACTIVE)
+    self.assertEqual(report.applied, ['tenant_c'])
+    plans = peeweedbevolve.calc_changes_by_schema(self.db, schemas)
+    self.assertEqual(plans['tenant_a'], plans['tenant_b'])
+    self.assertEqual(plans['tenant_c'], [])
+    report = peeweedbevolve.evolve_schemas(self.db, schemas, interactive=INTERACTIVE)
+    self.assertEqual(report.applied, ['tenant_a', 'tenant_b'])
+    self.assertEqual(report.up_to_date, ['tenant_c'])
+    self.assertEqual(len(report.groups), 1)
+    for schema in schemas:
+      self.check_noop(schema=schema)
+    self.assertNotIn('somemodel', self.db.get_tables())
+
+  def test_evolve_schemas_concurrent_indexes(self):
+    schemas = ['tenant_a', 'tenant_b']
+    for schema in schemas:
+      self.db.execute_sql('create schema %s' % schema)
+      self.db.execute_sql('create table %s.parent (id serial primary key)' % schema)
+      self.db.execute_sql('create table %s.child (id serial primary key, parent_id integer references %s.parent (id))' % (schema, schema))
+    class Parent(pw.Model):
+      class Meta:
+        database = self.db
+    class Child(pw.Model):
+      parent = foreign_key(Parent, null=True, index=False)
+      class Meta:
+        database = self.db
+    plans = peeweedbevolve.calc_changes_by_schema(self.db, schemas, index_foreign_keys=True)
+    self.assertEqual([[sql.split()[:3] for sql, params in plans[schema]] for schema in schemas], [[['CREATE', 'INDEX', 'CONCURRENTLY']]] * 2)
+    search_path = self.db.execute_sql('SHOW search_path').fetchone()[0]
+    report = peeweedbevolve.evolve_schemas(self.db, schemas, interactive=INTERACTIVE, index_foreign_keys=True)
+    self.assertEqual(report.applied, schemas)
+    # built in each tenant's schema, not the default one - which is left as it was
+    self.assertEqual(peeweedbevolve.calc_changes_by_schema(self.db, schemas, index_foreign_keys=True), {schema: [] for schema in schemas})
+    self.assertEqual(self.db.execute_sql('SHOW search_path').fetchone()[0], search_path)
+
+  def test_evolve_schemas_stops_at_failure(self):
+    schemas = ['tenant_a', 'tenant_b']
+    for schema in schemas:
+      self.db.execute_sql('create schema %s' % schema)
+      self.db.execute_sql('create table %s.somemodel (id serial primary key)' % schema)
+    self.db.execute_sql('insert into tenant_a.somemodel default values')
+    class SomeModel(pw.Model):
+      some_field = pw.CharField()
+      class Meta:
+        database = self.db
+    report = peeweedbevolve.evolve_schemas(self.db, schemas, interactive=INTERACTIVE, batch_size=1)
+    self.assertEqual(report.failed, ['tenant_a'])
+    self.assertEqual(report.pending, ['tenant_b'])
+
+  def test_evolve_schemas_blames_failing_schema(self):
+    schemas = ['tenant_a', 'tenant_b']
+    for schema in schemas:
+      self.db.execute_sql('create schema %s' % schema)
+      self.db.execute_sql('create table %s.somemodel (id serial primary key)' % schema)
+    self.db.execute_sql('insert into tenant_b.somemodel default values')
+    class SomeModel(pw.Model):
+      some_field = pw.CharField()
+      class Meta:
+        database = self.db
+    report = peeweedbevolve.evolve_schemas(self.db, schemas, interactive=INTERACTIVE, batch_size=2)
+    self.assertEqual(report.failed, ['tenant_b'])
+    # rolled back with the rest of its batch
+    self.assertEqual(report.pending, ['tenant_a'])
+
+  def test_evolve_schemas_extension_types(self):
+    # hstore is installed in public, not in the tenant's schema
+    self.db.execute_sql('create schema tenant_a')
+    class SomeModel(pw.Model):
+      some_field = pwe.HStoreField(null=True)
+      class Meta:
+        database = self.db
+    report = peeweedbevolve.evolve_schemas(self.db, ['tenant_a'], interactive=INTERACTIVE)
+    self.assertEqual(report.applied, ['tenant_a'])
+    self.check_noop(schema='tenant_a')
+
+  def test_evolve_async_index_options(self):
+    import asyncio, peeweedbevolve_async
+    class SomeModel(pw.Model):
+      some_field = pw.IntegerField(index=True)
+      other_field = pw.IntegerField()
+      class Meta:
+        database = self.db
+        indexes = ((('some_field', 'other_field'), False),)
+    to_run = peeweedbevolve.calc_changes(self.db, skip_redundant_indexes=True)
+    self.assertEqual(asyncio.run(peeweedbevolve_async.calc_changes_async(self.db, skip_redundant_indexes=True)), to_run)
+    asyncio.run(peeweedbevolve_async.evolve_async(self.db, interactive=INTERACTIVE, skip_redundant_indexes=True))
+    self.assertEqual(peeweedbevolve.calc_changes(self.db, skip_redundant_indexes=True), [])
+
+  def test_evolve_async(self):
+    import asyncio, peeweedbevolve_async
+    class SomeModel(pw.Model):
+      some_field = pw.CharField(null=True, index=True)
+      class Meta:
+        database = self.db
+    to_run = peeweedbevolve.calc_changes(self.db)
+    self.assertEqual(asyncio.run(peeweedbevolve_async.calc_changes_async(self.db)), to_run)
+    asyncio.run(peeweedbevolve_async.evolve_async(self.db, interactive=INTERACTIVE))
+    self.check_noop()
+    SomeModel.create(some_field='woot')
+    self.assertEqual(SomeModel.select().first().some_field, 'woot')
+
+  def test_iter_changes(self):
+    class SomeModel(pw.Model):
+      some_field = pw.CharField(null=True)
+      class Meta:
+        database = self.db
+    self.evolve_and_check_noop()
+    peeweedbevolve.clear()
+    class SomeModel(pw.Model):
+      some_field = pw.CharField(null=True, index=True)
+      other_field = pw.IntegerField(null=True)
+      class Meta:
+        database = self.db
+    class OtherModel(pw.Model):
+      some_model = foreign_key(SomeModel)
+      class Meta:
+        database = self.db
+    to_run = peeweedbevolve.calc_changes(self.db)
+    self.assertEqual(sorted(peeweedbevolve.iter_changes(self.db)), sorted(to_run))
+    with self.db.atomic():
+      self.assertEqual(peeweedbevolve.stream_changes(self.db, peeweedbevolve.ExecuteSink(self.db)), len(to_run))
+    self.check_noop()
+
+  def test_database_template(self):
+    class SomeModel(pw.Model):
+      some_field = pw.CharField(null=True, index=True)
+      class Meta:
+        database = self.db
+    template = peeweedbevolve.DatabaseTemplate(self.db)
+    try:
+      first = template.template()
+      self.assertEqual(template.clone(), self.db)
+      self.check_noop()
+      SomeModel.create(some_field='woot')
+      template.clone()
+      self.assertEqual(SomeModel.select().count(), 0)
+      self.assertEqual(template.template(), first)
+      class OtherModel(pw.Model):
+        other_field = pw.IntegerField(null=True)
+        class Meta:
+          database = self.db
+      self.assertNotEqual(template.template(), first)
+      template.clone()
+      self.check_noop()
+    finally:
+      template.drop()
+
+  def fleet(self, count=3):
+    names = ['peeweedbevolve_test_shard%i' % i for i in range(count)]
+    for name in names:
+      os.system('dropdb %s 2> /dev/null; createdb %s' % (name, name))
+    self.addCleanup(lambda: [os.system('dropdb %s' % name) for name in names])
+    return names
+
+  def test_evolve_fleet(self):
+    class SomeModel(pw.Model):
+      some_field = pw.CharField(null=True)
+    names = self.fleet()
+    factory = lambda name: pwe.PostgresqlExtDatabase(name)
+    report = peeweedbevolve.evolve_fleet(names, factory=factory, models=[SomeModel], dry_run=True)
+    self.assertEqual(report.pending, names)
+    self.assertEqual(list(report.groups.values()), [names])
+    report = peeweedbevolve.evolve_fleet(names, factory=factory, models=[SomeModel])
+    self.assertEqual(report.applied, names)
+    self.assertTrue(report.ok)
+    report = peeweedbevolve.evolve_fleet(names, factory=factory, models=[SomeModel])
+    self.assertEqual(report.up_to_date, names)
+
+  def test_evolve_fleet_factory_needs_models(self):
+    class SomeModel(pw.Model):
+      some_field = pw.CharField(null=True)
+      class Meta:
+        database = self.db
+    names = self.fleet(count=1)
+    with self.assertRaises(Exception):
+      peeweedbevolve.evolve_fleet(names, factory=lambda name: pwe.PostgresqlExtDatabase(name), dry_run=True)
+
+  def test_evolve_fleet_halts_after_canary(self):
+    names = self.fleet()
+    canary = pwe.PostgresqlExtDatabase(names[0])
+    canary.execute_sql('create table somemodel (id serial primary key)')
+    canary.execute_sql('insert into somemodel default values')
+    canary.close()
+    class SomeModel(pw.Model):
+      some_field = pw.CharField()
+    factory = lambda name: pwe.PostgresqlExtDatabase(name)
+    report = peeweedbevolve.evolve_fleet(names, factory=factory, models=[SomeModel], canary=1)
+    self.assertEqual(report.failed, names[:1])
+    self.assertEqual(report.pending, names[1:])
+    self.assertEqual(len(report.groups), 2)
+    self.assertFalse(report.ok)
+
   def test_add_blob_column(self):
     self.test_create_table()
     peeweedbevolve.clear()
@@ -773,6 +1277,176 @@ class PostgreSQL(unittest.TestCase):
     SomeModel.create(some_field='woot')
     self.assertEqual(SomeModel.select().first().some_field, 'woot')
 
+  def test_schedule_cheap_first(self):
+    class SomeModel(pw.Model):
+      some_field = pw.CharField(index=True, null=True)
+      class Meta:
+        database = self.db
+    to_run = peeweedbevolve.calc_changes(self.db)
+    estimator = lambda sql: 100 if 'INDEX' in sql else 1
+    plan = peeweedbevolve.schedule(self.db, to_run, 50, estimator=estimator)
+    self.assertEqual([stmt.kind for stmt in plan.run], ['metadata'])
+    self.assertEqual([stmt.kind for stmt in plan.deferred], ['index'])
+
+  def test_evolve_with_budget_defers_remainder(self):
+    class SomeModel(pw.Model):
+      some_field = pw.CharField(null=True)
+      class Meta:
+        database = self.db
+    self.db.evolve(interactive=INTERACTIVE, budget=0)
+    self.assertEqual(len(peeweedbevolve.calc_changes(self.db)), 1)
+    self.assertEqual(peeweedbevolve._deferred_sql(self.db), [peeweedbevolve.calc_changes(self.db)[0][0]])
+    self.db.evolve(interactive=INTERACTIVE, budget=60)
+    self.check_noop()
+    self.assertEqual(peeweedbevolve._deferred_sql(self.db), [])
+
+  def test_throttle_waits_for_lag(self):
+    lags = [30, 20, 0, 0, 0, 0]
+    throttle = peeweedbevolve.Throttle(max_lag=5, lag=lambda: lags.pop(0), interval=0)
+    class SomeModel(pw.Model):
+      some_field = pw.CharField(index=True, null=True)
+      class Meta:
+        database = self.db
+    self.db.evolve(interactive=INTERACTIVE, throttle=throttle)
+    self.check_noop()
+    self.assertEqual(lags, [0, 0, 0])
+
+  def test_throttle_batches_backfill(self):
+    class SomeModel(pw.Model):
+      some_field = pw.CharField(null=True)
+      class Meta:
+        database = self.db
+    self.evolve_and_check_noop()
+    for i in range(5):
+      SomeModel.create(some_field=None)
+    peeweedbevolve.clear()
+    class SomeModel(pw.Model):
+      some_field = pw.CharField(null=False, default='woot')
+      class Meta:
+        database = self.db
+    checks = []
+    def lag():
+      checks.append(self.db.in_transaction())
+      return 0
+    throttle = peeweedbevolve.Throttle(max_lag=5, lag=lag, interval=0, batch_size=2)
+    self.db.evolve(interactive=INTERACTIVE, throttle=throttle)
+    self.check_noop()
+    self.assertEqual([m.some_field for m in SomeModel.select()], ['woot'] * 5)
+    # 2 full batches (then a short last one), and once before the not null is added - never waiting inside a transaction
+    self.assertEqual(checks, [False] * 3)
+
+  def test_history(self):
+    class SomeModel(pw.Model):
+      some_field = pw.CharField(null=True)
+      class Meta:
+        database = self.db
+    self.evolve_and_check_noop()
+    SomeModel.create(some_field='woot')
+    peeweedbevolve.clear()
+    class SomeModel(pw.Model):
+      some_field = pw.CharField(index=True, null=True)
+      class Meta:
+        database = self.db
+    self.db.evolve(interactive=INTERACTIVE, history=True)
+    self.check_noop()
+    history = peeweedbevolve.get_history(self.db, table='somemodel')
+    self.assertEqual([entry.kind for entry in history], ['index', 'metadata'])
+    self.assertEqual([entry.outcome for entry in history], ['ok', 'ok'])
+    self.assertTrue(history[0].size_before > 0)
+    self.assertTrue(history[0].duration >= 0)
+    self.assertEqual([stats.table for stats in peeweedbevolve.get_table_stats(self.db)], ['somemodel'])
+
+  def test_history_records_failures(self):
+    class SomeModel(pw.Model):
+      some_field = pw.CharField(null=True)
+      class Meta:
+        database = self.db
+    self.evolve_and_check_noop()
+    SomeModel.create(some_field=None)
+    peeweedbevolve.clear()
+    class SomeModel(pw.Model):
+      some_field = pw.CharField(null=False)
+      class Meta:
+        database = self.db
+    with self.assertRaises(Exception):
+      self.db.evolve(interactive=INTERACTIVE, history=True)
+    self.assertEqual([entry.outcome for entry in peeweedbevolve.get_history(self.db, table='somemodel', limit=1)], ['failed'])
+
+  def test_profile(self):
+    class SomeModel(pw.Model):
+      some_field = pw.CharField(index=True, null=True)
+      class Meta:
+        database = self.db
+    timings = []
+    class Statsd(object):
+      def timing(self, name, ms):
+        timings.append(name)
+    with peeweedbevolve.profile(listeners=[peeweedbevolve.StatsdListener(Statsd())]) as profiler:
+      self.evolve_and_check_noop()
+    for phase in ['calc_changes', 'get_tables', 'get_columns', 'get_foreign_keys', 'calc_index_changes', 'generate_sql', 'execute']:
+      self.assertTrue(phase in profiler.spans, phase)
+    self.assertEqual(profiler.spans['execute'][0], 1)
+    self.assertTrue(profiler.query_count > 0)
+    self.assertTrue('peeweedbevolve.calc_changes' in timings)
+    self.assertTrue('peeweedbevolve.catalog.tables' in timings)
+    self.assertTrue('calc_changes' in profiler.report())
+    self.assertEqual(peeweedbevolve.active_profiler(), None)
+
+  def interrupted_evolve(self):
+    # runs the first step of a journaled evolve, then "crashes" on the second
+    to_run = peeweedbevolve.calc_changes(self.db)
+    journal = peeweedbevolve.Journal(self.db, to_run)
+    with self.db.atomic():
+      journal.open()
+      self.db.execute_sql(*to_run[0])
+      journal.mark(0, 'done')
+      journal.mark(1, 'failed', error='boom')
+    return to_run
+
+  def test_journal_complete(self):
+    class SomeModel(pw.Model):
+      some_field = pw.CharField(index=True, null=True)
+      class Meta:
+        database = self.db
+    self.db.evolve(interactive=INTERACTIVE, journal=True)
+    self.check_noop()
+    self.assertEqual(peeweedbevolve.Journal.incomplete(self.db), None)
+
+  def test_journal_resume(self):
+    class SomeModel(pw.Model):
+      some_field = pw.CharField(index=True, null=True)
+      class Meta:
+        database = self.db
+    to_run = self.interrupted_evolve()
+    journal = peeweedbevolve.Journal.incomplete(self.db)
+    self.assertEqual(journal.offset, 1)
+    self.assertEqual([sql for sql, _ in journal.to_run], [sql for sql, _ in to_run[1:]])
+    peeweedbevolve.resume(self.db, interactive=INTERACTIVE)
+    self.check_noop()
+    self.assertEqual(peeweedbevolve.Journal.incomplete(self.db), None)
+
+  def test_journal_resume_already_up_to_date(self):
+    class SomeModel(pw.Model):
+      some_field = pw.CharField(index=True, null=True)
+      class Meta:
+        database = self.db
+    self.interrupted_evolve()
+    # finished some other way, so the journal's remaining steps would fail (or worse) if they ran again
+    self.evolve_and_check_noop()
+    peeweedbevolve.resume(self.db, interactive=INTERACTIVE)
+    self.check_noop()
+    self.assertEqual(peeweedbevolve.Journal.incomplete(self.db), None)
+
+  def test_journal_resume_schema_drift(self):
+    class SomeModel(pw.Model):
+      some_field = pw.CharField(index=True, null=True)
+      class Meta:
+        database = self.db
+    self.interrupted_evolve()
+    self.db.execute_sql('drop table somemodel')
+    with self.assertRaises(Exception):
+      peeweedbevolve.resume(self.db, interactive=INTERACTIVE)
+
 
 
 
@@ -795,7 +1469,160 @@ class SQLite(object): # change object to PostgreSQL to enable
 
   def test_drop_table(self):
     super().test_drop_table(ex=pw.OperationalError)
-    
+
+
+
+
+
+class SQLiteFile(unittest.TestCase):
+  # a temp file database, so these run without a database server (unlike SQLite above)
+
+  def setUp(self):
+    self.fn = tempfile.mktemp(suffix='.db')
+    self.db = pw.SqliteDatabase(self.fn)
+    self.db.connect()
+    peeweedbevolve.clear()
+
+  def tearDown(self):
+    self.db.close()
+    os.remove(self.fn)
+
+  def evolve_and_check_noop(self):
+    self.db.evolve(interactive=INTERACTIVE)
+    self.assertEqual(peeweedbevolve.calc_changes(self.db), [])
+
+  def rebuilds(self, to_run):
+    return [sql for sql, params in to_run if sql.startswith('CREATE TABLE "somemodel__tmp__"')]
+
+  def test_add_not_null_rebuilds_once(self):
+    class SomeModel(pw.Model):
+      some_field = pw.CharField(null=True)
+      class Meta:
+        database = self.db
+    self.evolve_and_check_noop()
+    SomeModel.create(some_field='a')
+    peeweedbevolve.clear()
+    class SomeModel(pw.Model):
+      some_field = pw.CharField(null=False)
+      class Meta:
+        database = self.db
+    to_run = peeweedbevolve.calc_changes(self.db)
+    self.assertEqual(self.rebuilds(to_run), ['CREATE TABLE "somemodel__tmp__" ("id" INTEGER NOT NULL PRIMARY KEY, "some_field" VARCHAR(255) NOT NULL)'])
+    self.assertEqual(to_run[-1][0], 'ALTER TABLE "somemodel__tmp__" RENAME TO "somemodel"')
+    self.evolve_and_check_noop()
+    self.assertEqual(list(SomeModel.select(SomeModel.some_field).tuples()), [('a',)])
+
+  def test_change_type_and_null_rebuilds_once(self):
+    class SomeModel(pw.Model):
+      some_field = pw.IntegerField(null=True)
+      class Meta:
+        database = self.db
+    self.evolve_and_check_noop()
+    SomeModel.create(some_field=None)
+    peeweedbevolve.clear()
+    class SomeModel(pw.Model):
+      some_field = pw.TextField(default='x')
+      class Meta:
+        database = self.db
+    to_run = peeweedbevolve.calc_changes(self.db)
+    self.assertEqual(self.rebuilds(to_run), ['CREATE TABLE "somemodel__tmp__" ("id" INTEGER NOT NULL PRIMARY KEY, "some_field" TEXT NOT NULL)'])
+    self.evolve_and_check_noop()
+    self.assertEqual(list(SomeModel.select(SomeModel.some_field).tuples()), [('x',)])
+
+  def test_schedule_keeps_rebuild_whole(self):
+    class SomeModel(pw.Model):
+      some_field = pw.IntegerField(null=True, index=True)
+      class Meta:
+        database = self.db
+    self.evolve_and_check_noop()
+    SomeModel.create(some_field=1)
+    peeweedbevolve.clear()
+    class SomeModel(pw.Model):
+      some_field = pw.TextField(null=True, index=True)
+      class Meta:
+        database = self.db
+    to_run = peeweedbevolve.calc_changes(self.db)
+    self.assertEqual(len(self.rebuilds(to_run)), 1)
+    # room for some of the rebuild, but not all of it
+    plan = peeweedbevolve.schedule(self.db, to_run, len(to_run) - 1, estimator=lambda sql: 1, margin=0)
+    self.assertEqual(plan.run, [])
+    self.db.evolve(interactive=INTERACTIVE, budget=60)
+    self.assertEqual(peeweedbevolve.calc_changes(self.db), [])
+    self.assertEqual(list(SomeModel.select(SomeModel.some_field).tuples()), [('1',)])
+
+  def test_budget_up_to_date(self):
+    self.db.evolve(interactive=INTERACTIVE, budget=60)
+    self.assertNotIn(peeweedbevolve.SCHEDULE_TABLE, self.db.get_tables())
+
+  def test_sql_cache_copies(self):
+    cache = peeweedbevolve.SQLCache()
+    generate = lambda: [('UPDATE "somemodel" SET "some_field" = ?', ['woot'])]
+    cache.get('key', generate)[0][1].append('changed')
+    cache.get('key', generate)[0][1].append('changed')
+    self.assertEqual(cache.get('key', generate), generate())
+    self.assertEqual(cache.hits, 2)
+
+  def test_sql_cache_index_safe(self):
+    class SomeModel(pw.Model):
+      some_field = pw.CharField(null=True)
+      class Meta:
+        database = self.db
+    safe = pw.ModelIndex(SomeModel, (SomeModel.some_field,), safe=True)
+    unsafe = pw.ModelIndex(SomeModel, (SomeModel.some_field,), safe=False)
+    self.assertNotEqual(peeweedbevolve._index_fingerprint(safe), peeweedbevolve._index_fingerprint(unsafe))
+
+  def test_index_foreign_keys_existing_index(self):
+    class Parent(pw.Model):
+      class Meta:
+        database = self.db
+    class Child(pw.Model):
+      parent = foreign_key(Parent, null=True, index=False)
+      some_field = pw.CharField(null=True)
+      class Meta:
+        database = self.db
+    # (peewee's own create_tables, which can declare sqlite's foreign keys inline)
+    self.db.create_tables([Parent, Child])
+    # an index only the database has, leading with the foreign key
+    self.db.execute_sql('create index child_parent_some_field on child (parent_id, some_field)')
+    self.assertEqual(peeweedbevolve.unindexed_foreign_keys(self.db), [])
+    self.assertEqual(peeweedbevolve.calc_changes(self.db, index_foreign_keys=True), [])
+
+  def test_models_for_unbound_database(self):
+    class SomeModel(pw.Model):
+      some_field = pw.CharField(null=True)
+      class Meta:
+        database = self.db
+    self.evolve_and_check_noop()
+    # the same file, but not the database object the model is bound to - that mustn't plan dropping its tables
+    other = pw.SqliteDatabase(self.fn)
+    self.assertEqual(peeweedbevolve.models_for(other), [SomeModel])
+    self.assertEqual(peeweedbevolve.calc_changes(other), [])
+    other.close()
+
+  def test_sqlite_table_options(self):
+    class SomeModel(pw.Model):
+      key = pw.IntegerField()
+      value = pw.TextField()
+      class Meta:
+        database = self.db
+        primary_key = pw.CompositeKey('key', 'value')
+        without_rowid = True
+        strict_tables = True
+    self.evolve_and_check_noop()
+    self.assertEqual(peeweedbevolve.get_table_options_by_table(self.db)['somemodel'], {'without_rowid': True, 'strict': True})
+    SomeModel.create(key=1, value='a')
+    peeweedbevolve.clear()
+    class SomeModel(pw.Model):
+      key = pw.IntegerField()
+      value = pw.TextField()
+      class Meta:
+        database = self.db
+        primary_key = pw.CompositeKey('key', 'value')
+    to_run = peeweedbevolve.calc_changes(self.db)
+    self.assertEqual(self.rebuilds(to_run), ['CREATE TABLE "somemodel__tmp__" ("key" INTEGER NOT NULL, "value" TEXT NOT NULL, PRIMARY KEY ("key", "value")) STRICT'])
+    self.evolve_and_check_noop()
+    self.assertEqual(peeweedbevolve.get_table_options_by_table(self.db)['somemodel'], {'without_rowid': False, 'strict': True})
+    self.assertEqual(list(SomeModel.select().tuples()), [(1, 'a')])
 
 
 
@@ -823,6 +1650,84 @@ class MySQL(PostgreSQL):
   def test_create_table_other_schema(self):
     pass
 
+  def test_evolver_threads_add_column(self):
+    pass
+
+  def test_evolve_schemas(self):
+    pass
+
+  def test_evolve_schemas_concurrent_indexes(self):
+    pass
+
+  def test_evolve_schemas_stops_at_failure(self):
+    pass
+
+  def test_evolve_schemas_blames_failing_schema(self):
+    pass
+
+  def test_evolve_schemas_extension_types(self):
+    pass
+
+  def test_database_template(self):
+    pass
+
+  def test_partial_expression_and_method_indexes(self):
+    pass
+
+  def test_covering_index(self):
+    pass
+
+  def test_index_foreign_keys(self):
+    pass
+
+  def test_redundant_indexes(self):
+    pass
+
+  def test_index_usage(self):
+    pass
+
+  def test_partitioned_table(self):
+    pass
+
+  def test_hash_partitioned_table(self):
+    pass
+
+  def test_storage_parameters(self):
+    pass
+
+  def test_column_options(self):
+    pass
+
+  def test_innodb_table_options(self):
+    class SomeModel(pw.Model):
+      some_field = pw.TextField(null=True)
+      class Meta:
+        database = self.db
+        engine = 'InnoDB'
+        row_format = 'COMPRESSED'
+        key_block_size = 8
+    self.evolve_and_check_noop()
+    options = peeweedbevolve.get_table_options_by_table(self.db)['somemodel']
+    self.assertEqual((options['row_format'], options['key_block_size']), ('Compressed', 8))
+    peeweedbevolve.clear()
+    class SomeModel(pw.Model):
+      some_field = pw.TextField(null=True)
+      class Meta:
+        database = self.db
+        row_format = 'DYNAMIC'
+        key_block_size = 0
+    to_run = peeweedbevolve.calc_changes(self.db)
+    self.assertEqual([sql for sql, params in to_run], ['ALTER TABLE `somemodel` ROW_FORMAT=DYNAMIC KEY_BLOCK_SIZE=0'])
+    self.assertEqual(peeweedbevolve.classify_statement(to_run[0][0]), 'rewrite')
+    self.assertTrue(peeweedbevolve.annotate_rewrite_cost(self.db, to_run)[0][0].startswith('-- rewrites somemodel'))
+    self.evolve_and_check_noop()
+    peeweedbevolve.clear()
+    class SomeModel(pw.Model):
+      some_field = pw.TextField(null=True)
+      class Meta:
+        database = self.db
+    self.check_noop()
+
 
 
 from playhouse.pool import PooledPostgresqlExtDatabase